@@ -71,6 +71,6 @@ pickle.dump(
     open(f"test_{DATA_NAME}_{N_SNE}_obs.pkl", "wb"),
 )
 pickle.dump(
-    {"x1": x1_true, "c": c_true, "mass": mass_true, "age": age_true, "mb": mb_true},
+    {"x1": x1_true, "c": c_true, "mb": mb_true},
     open(f"test_{DATA_NAME}_{N_SNE}_true.pkl", "wb"),
 )
@@ -6,29 +6,28 @@ Currently designed specifically for table 2 in Rose, Dixon, Rubin et al. 2019.
 __author__ = 'Benjamin Rose <brose@stsci.edu>'
 __python__ = '^3.6'
 
-import gzip
-import pickle
 from pathlib import Path
-import re
 
 import numpy as np
 import toml
 
+from unity.draws import load_draws, load_outlier_table
+
 FIL_DIR = Path(__file__).resolve().parent
 
 # Stan parameters of interest
 prefix = ""
-FILES = [FIL_DIR / (prefix + 'snemo7_00_err_lt1.0_fitparams.gzip.pkl'),
-         FIL_DIR / (prefix + 'snemo7_00_err_lt2.0_fitparams.gzip.pkl'),
-         FIL_DIR / (prefix + 'snemo7_01_err_lt1.0_fitparams.gzip.pkl'),
-         FIL_DIR / (prefix + 'snemo7_01_err_lt2.0_fitparams.gzip.pkl'),
-         FIL_DIR / (prefix + 'snemo7_02_err_lt1.0_fitparams.gzip.pkl'),
-         FIL_DIR / (prefix + 'snemo7_02_err_lt2.0_fitparams.gzip.pkl'),
-         FIL_DIR / 'salt2_00_passed_snemo7_02_fitparams.gzip.pkl',
-         FIL_DIR / 'salt2_00_passed_snemo2_02_fitparams.gzip.pkl',
-         FIL_DIR / (prefix + 'snemo2_00_err_lt2.0_fitparams.gzip.pkl'),
-         FIL_DIR / (prefix + 'snemo2_01_err_lt2.0_fitparams.gzip.pkl'),
-         FIL_DIR / (prefix + 'snemo2_02_err_lt2.0_fitparams.gzip.pkl')]
+FILES = [FIL_DIR / (prefix + 'snemo7_00_err_lt1.0_fitparams'),
+         FIL_DIR / (prefix + 'snemo7_00_err_lt2.0_fitparams'),
+         FIL_DIR / (prefix + 'snemo7_01_err_lt1.0_fitparams'),
+         FIL_DIR / (prefix + 'snemo7_01_err_lt2.0_fitparams'),
+         FIL_DIR / (prefix + 'snemo7_02_err_lt1.0_fitparams'),
+         FIL_DIR / (prefix + 'snemo7_02_err_lt2.0_fitparams'),
+         FIL_DIR / 'salt2_00_passed_snemo7_02_fitparams',
+         FIL_DIR / 'salt2_00_passed_snemo2_02_fitparams',
+         FIL_DIR / (prefix + 'snemo2_00_err_lt2.0_fitparams'),
+         FIL_DIR / (prefix + 'snemo2_01_err_lt2.0_fitparams'),
+         FIL_DIR / (prefix + 'snemo2_02_err_lt2.0_fitparams')]
 FIT_PARAMS = ['MB', 'sigma_int', 'coeff', 'outl_frac']
 TABLE_NAMES = [r'M$_B$', r'$\sigma_{\rm unexplained}$', r'$\beta$', r'$\alpha_1$', r'$\alpha_2$', r'$\alpha_3$',
                r'$\alpha_4$', r'$\alpha_5$', r'$\alpha_6$', r'$\gamma$', r'$f^{outl}$']
@@ -40,7 +39,7 @@ def table_data(f: Path) -> tuple:
     Parameters
     ----------
     f: Path
-        String of the file. For example, 'pub_snemo7_mcmc_jla+csp+foundation_02_err_lt2_fitparams.gzip.pkl'.
+        String of the file. For example, 'pub_snemo7_mcmc_jla+csp+foundation_02_err_lt2_fitparams'.
 
     Returns
     -------
@@ -56,8 +55,8 @@ def table_data(f: Path) -> tuple:
     outl_frac: tuple of 3 floats
         Floats are the 15.8655, 50.0, and 84.1345 percentiles of the samples.
     """
-    with gzip.open(f, 'rb') as stan_output:
-        data = pickle.load(stan_output)
+    # Memory-maps only the parameters used below, not `outl_loglike`.
+    data = load_draws(f)
 
     # print(data.keys())
     # print(data['MB'].shape)
@@ -76,28 +75,26 @@ def table_data(f: Path) -> tuple:
 def outlier_percent(f: Path) -> str:
     """Get the data to be put into the LaTeX table from the UNITY output file.
 
+    A SN is counted as an outlier if the posterior mean of its `outl_loglike`
+    is negative, read from the fit's per-SN outlier table.
+
     Parameters
     ----------
     f: Path
-        String of the file. For example, 'pub_snemo7_mcmc_jla+csp+foundation_02_err_lt2_fitparams.gzip.pkl'.
+        String of the file. For example, 'pub_snemo7_mcmc_jla+csp+foundation_02_err_lt2_fitparams'.
     """
-    # go from "snemo7_00_err_lt1.0_fitparams.gzip.pkl" to "snemo7_00_err_lt1.0.txt"
-    meta_data_file = f.parent / (f.name[:-19] + ".txt")
+    # go from "snemo7_00_err_lt1.0_fitparams" to "snemo7_00_err_lt1.0.txt"
+    meta_data_file = f.parent / (f.name[:-10] + ".txt")
     with open(meta_data_file, 'r') as f_:
         meta_data = toml.load(f_)
     N = meta_data['count']
 
-    # go from "snemo7_00_err_lt1.0_fitparams.gzip.pkl" to "snemo7_00_err_lt1.0_results.txt"
-    results_file = f.parent / (f.name[:-18] + "results.txt")
-    with open(results_file, 'r') as f_:
-        results = f_.read()
-    outliers = re.findall(r'outl_loglike\[\d*\]\s*-', results)
-    N_out = len(outliers)
+    N_out = int((load_outlier_table(f)['mean'] < 0).sum())
 
     return N, f'{N_out} ({N_out/N*100:.2}\\%)'
 
 
-# MB, sigma_int, coeff, outl_frac = table_data('pub_snemo7_mcmc_jla+csp+foundation_02_err_lt2_fitparams.gzip.pkl')
+# MB, sigma_int, coeff, outl_frac = table_data('pub_snemo7_mcmc_jla+csp+foundation_02_err_lt2_fitparams')
 print('Calculating SNEMO7 results.')
 MB_01, sigma_int_01, coeff_01 = table_data(FILES[0])
 MB_02, sigma_int_02, coeff_02 = table_data(FILES[1])
@@ -0,0 +1,21 @@
+""" test_benchmark.py """
+from unity import benchmark
+
+
+class TestBenchmark():
+    def test_cases(self):
+        """Cases a model can not fit are skipped."""
+        grid = benchmark.cases(['stan_code_fast.txt', 'stan_code_marginal.txt'], [100], [3, 4], [0, 3])
+        assert [case[2:] for case in grid] == [(3, 0), (4, 0), (4, 3), (3, 0), (4, 0)]
+        assert [case.model for case in grid] == ['stan_code_fast.txt']*3 + ['stan_code_marginal.txt']*2
+
+    def test_regressions(self):
+        """Only a comparable record past a threshold is a regression."""
+        case = benchmark.Case('stan_code_fast.txt', 100, 3, 0)
+        old = benchmark.result(case, {'gradient_seconds': 1e-3, 'min_ess_per_second': 10., 'peak_rss_mb': 100.},
+                               200, 2, 1)
+        new = benchmark.result(case, {'gradient_seconds': 2e-3, 'min_ess_per_second': 9., 'peak_rss_mb': 100.},
+                               200, 2, 1)
+        problems = benchmark.regressions(new, [old])
+        assert len(problems) == 1 and problems[0].startswith('gradient_seconds')
+        assert benchmark.regressions(new, [dict(old, settings={'steps': 400, 'chains': 2, 'seed': 1})]) == []
@@ -0,0 +1,26 @@
+""" test_cosmology.py """
+import numpy as np
+import pytest
+
+from unity import cosmology
+
+
+class TestModelMu():
+    def test_distance_modulus(self):
+        """The polynomial gives a Hubble law distance at low redshift."""
+        mu = cosmology.distance_modulus([0.01], [0.01])
+        assert np.isclose(mu, 5*np.log10(1.01*0.01*299792.458/70) + 25, atol=0.05)
+
+    def test_table(self, tmp_path):
+        """A fine table reproduces the polynomial, and an explicit table replaces data model_mu."""
+        z = np.linspace(0.005, 2, 2000)
+        np.savetxt(tmp_path/'mu.txt', np.column_stack((z, cosmology.distance_modulus(z, z))))
+        data = {'z_helio': [0.101, 0.5], 'z_CMB': [0.1, 0.502]}
+
+        mu = cosmology.model_mu(data, tmp_path/'mu.txt')
+        np.testing.assert_allclose(mu, cosmology.distance_modulus(data['z_helio'], data['z_CMB']), atol=1e-4)
+        np.testing.assert_array_equal(cosmology.model_mu(dict(data, model_mu=[1, 2]), tmp_path/'mu.txt'), mu)
+        np.testing.assert_array_equal(cosmology.model_mu(dict(data, model_mu=[1, 2])), [1, 2])
+
+        with pytest.raises(ValueError, match='outside'):
+            cosmology.model_mu({'z_helio': [3], 'z_CMB': [3]}, tmp_path/'mu.txt')
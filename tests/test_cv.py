@@ -0,0 +1,93 @@
+""" test_cv.py """
+import numpy as np
+import pytest
+
+from unity import cv, likelihood, simulate, unity
+
+
+def stan_data(n_sne=40, n_sn_set=2):
+    data, _ = simulate.simulate(n_sne, 3, n_sn_set=n_sn_set, seed=4)
+    return unity.prepare_data(data)
+
+
+def fit_draws(n_draws=10, n_sn_set=2, n_props=3):
+    rng = np.random.RandomState(6)
+    return {'coeff': rng.randn(n_draws, n_props - 1)*0.1, 'MB': rng.randn(n_draws, n_sn_set)*0.1 - 19,
+            'x1c_star': rng.randn(n_draws, n_sn_set, n_props - 1)*0.1,
+            'x1c_pop_cov_mat': np.tile(np.eye(n_props - 1), (n_draws, n_sn_set, 1, 1)),
+            'sigma_int': rng.uniform(0.05, 0.2, (n_draws, n_sn_set)),
+            'outl_frac': rng.uniform(0.01, 0.1, (n_draws, n_sn_set))}
+
+
+class TestFolds():
+    def test_kfold(self):
+        """Every SN is held out once, and every sample is in every fold."""
+        sn_set_inds = np.repeat([0, 1, 2], [10, 7, 13])
+        folds = cv.kfold(sn_set_inds, 5, seed=1)
+
+        assert np.array_equal(np.sort(np.concatenate(folds)), np.arange(30))
+        assert all(len(set(sn_set_inds[fold])) == 3 for fold in folds)
+        assert max(map(len, folds)) - min(map(len, folds)) <= 1
+        with pytest.raises(ValueError, match='too few'):
+            cv.kfold(sn_set_inds, 8)
+
+    def test_by_sample(self):
+        assert [list(fold) for fold in cv.by_sample([0, 1, 0, 1])] == [[0, 2], [1, 3]]
+        with pytest.raises(ValueError, match='one sample'):
+            cv.by_sample([0, 0])
+
+
+class TestSplit():
+    def test_recenter(self):
+        """The training SNe have a mean of 0 in a recentered column, the held-out SNe get the same shift."""
+        data = stan_data()
+        fold = cv.split(data, [0, 5, 9], 'fold1', recenter=[2])
+
+        assert fold.train['n_sne'] == 37 and fold.test['n_sne'] == 3
+        assert np.isclose(fold.train['obs_mBx1c'][:, 2].mean(), 0)
+        shift = data['obs_mBx1c'][0, 2] - fold.test['obs_mBx1c'][0, 2]
+        assert np.allclose(data['obs_mBx1c'][[0, 5, 9], 2] - shift, fold.test['obs_mBx1c'][:, 2])
+        # The full data is left alone.
+        assert not np.isclose(data['obs_mBx1c'][:, 2].mean(), 0)
+
+    def test_leave_sample_out(self):
+        """The remaining samples are renumbered, and the left out one can not be scored."""
+        data = stan_data(n_sn_set=3)
+        fold = cv.split(data, np.flatnonzero(data['sn_set_inds'] == 1), 'sample1')
+
+        assert fold.train['n_sn_set'] == 2 and set(fold.train['sn_set_inds']) == {0, 1}
+        assert fold.test is None
+
+    def test_unscorable(self):
+        """No test SNe with the full intrinsic covariance or a skewed population, `marginal_terms` assumes neither."""
+        data = stan_data()
+        assert cv.split(dict(data, do_fullDint=1), [0, 5], 'fold1').test is None
+        assert cv.split(dict(data, allow_alpha_S_N=1), [0, 5], 'fold1').test is None
+
+
+class TestScore():
+    def test_held_out(self):
+        """The mean predictive density over draws, read in blocks."""
+        data = stan_data()
+        fold = cv.split(data, [1, 2, 3], 'fold1')
+        draws = fit_draws()
+        terms = likelihood.marginal_terms(fold.test['obs_mBx1c'], fold.test['obs_mBx1c_cov'], draws['coeff'],
+                                          draws['MB'], fold.test['model_mu'], draws['x1c_star'],
+                                          draws['x1c_pop_cov_mat'], draws['sigma_int'], draws['outl_frac'],
+                                          fold.test['sn_set_inds'])
+        expected = np.log(np.exp(np.logaddexp(*terms)).mean(axis=0))
+
+        assert np.allclose(cv.held_out(draws, fold.test, block_size=3), expected)
+
+    def test_jackknife(self):
+        mean, se = cv.jackknife([[1.], [2.], [3.]])
+        assert np.allclose(mean, 2) and np.allclose(se, np.sqrt(2/3*2))
+
+    def test_score(self):
+        data = stan_data()
+        folds = [cv.split(data, index, f'fold{i + 1}') for i, index in enumerate(cv.kfold(data['sn_set_inds'], 2, 1))]
+        result = cv.score(folds, [fit_draws(), fit_draws()])
+
+        assert np.isclose(result.elpd, sum(scores.sum() for scores in result.scores))
+        assert np.allclose(result.jackknife_se['coeff'], 0)
+        assert 'Held-out elpd' in cv.to_text(result, folds)
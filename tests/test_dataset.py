@@ -0,0 +1,61 @@
+""" test_dataset.py """
+import pickle
+
+import numpy as np
+import pytest
+
+from unity import dataset
+
+
+def pickle_data(n_sne=4):
+    """The kind of dict UNITY's data pickles hold, with lists and an object array of names."""
+    return dict(n_sne=n_sne, n_props=3, n_non_gaus_props=1, sn_set_inds=[0]*n_sne, z_helio=np.linspace(0.1, 0.4, n_sne),
+                obs_mBx1c=np.arange(2.*n_sne).reshape((n_sne, 2)), obs_mBx1c_cov=np.tile(np.eye(2), (n_sne, 1, 1)),
+                age_gaus_A=np.arange(2.*n_sne).reshape((1, n_sne, 2)), outl_frac_prior_lnmean=-4.6,
+                names=np.array([f'sn{i}' for i in range(n_sne)], dtype=object))
+
+
+class TestDataset():
+    def test_round_trip(self, tmp_path):
+        """A dataset reads back like the pickle, memory-mapped and without pickle."""
+        data = pickle_data()
+        path = dataset.save_dataset(tmp_path/'data.unity', data)
+        loaded = dataset.load_dataset(path)
+
+        assert set(loaded) == set(data)
+        assert loaded['n_sne'] == 4 and loaded['outl_frac_prior_lnmean'] == -4.6
+        assert isinstance(loaded['obs_mBx1c_cov'], np.memmap)
+        np.testing.assert_array_equal(loaded['obs_mBx1c'], data['obs_mBx1c'])
+        assert list(loaded['names']) == list(data['names'])
+        for key in loaded.meta['arrays']:
+            np.load(path/f'{key}.npy', allow_pickle=False)
+        assert loaded.verify() and loaded.content_hash == dataset.content_hash(data)
+
+    def test_hash_changes(self, tmp_path):
+        """Changing one value changes the content hash."""
+        data = pickle_data()
+        before = dataset.content_hash(data)
+        data['z_helio'][2] += 1e-9
+        assert dataset.content_hash(data) != before
+
+    def test_refuses_objects(self, tmp_path):
+        """Anything that would need pickle is refused."""
+        with pytest.raises(ValueError, match='bad'):
+            dataset.save_dataset(tmp_path/'data.unity', dict(pickle_data(), bad=[{'a': 1}]))
+
+    def test_subset(self, tmp_path):
+        """Every per-SN input is cut along its SN axis."""
+        loaded = dataset.Dataset(dataset.save_dataset(tmp_path/'data.unity', pickle_data()))
+        cut = dataset.subset(loaded, [False, True, False, True])
+        assert cut['n_sne'] == 2
+        assert list(cut['names']) == ['sn1', 'sn3']
+        np.testing.assert_array_equal(cut['obs_mBx1c'], [[2, 3], [6, 7]])
+        np.testing.assert_array_equal(cut['age_gaus_A'], [[[2, 3], [6, 7]]])
+        assert cut['obs_mBx1c_cov'].shape == (2, 2, 2)
+
+    def test_convert(self, tmp_path):
+        with open(tmp_path/'data.pkl', 'wb') as f:
+            pickle.dump(pickle_data(), f)
+        path = dataset.convert(tmp_path/'data.pkl')
+        assert path == tmp_path/'data.unity'
+        assert dataset.Dataset(path).content_hash == dataset.content_hash(pickle_data())
@@ -0,0 +1,41 @@
+""" test_draws.py """
+import gzip
+import pickle
+
+import numpy as np
+
+from unity import draws
+
+
+class TestDrawStore():
+    def test_merge(self, tmp_path):
+        """Chunks are merged chain by chain, and read back memory-mapped."""
+        for chain_id in (1, 2):
+            writer = draws.DrawWriter(tmp_path, chain_id)
+            for chunk in range(3):
+                writer.append({'MB': np.full((4, 1), 10*chain_id + chunk),
+                               'coeff': np.zeros((4, 3))})
+        draws.merge(tmp_path)
+
+        fit = draws.load_draws(tmp_path)
+        assert set(fit) == {'MB', 'coeff'}
+        assert fit['coeff'].shape == (24, 3)
+        assert isinstance(fit['MB'], np.memmap)
+        np.testing.assert_array_equal(fit.by_chain('MB')[:, ::4, 0], [[10, 11, 12], [20, 21, 22]])
+        assert not list(tmp_path.glob('chain*'))
+
+    def test_writer_continues(self, tmp_path):
+        """A new writer on an existing chain keeps appending."""
+        draws.DrawWriter(tmp_path, 1).append({'MB': np.zeros((2, 1))})
+        draws.DrawWriter(tmp_path, 1).append({'MB': np.ones((2, 1))})
+        draws.merge(tmp_path)
+        np.testing.assert_array_equal(draws.load_draws(tmp_path)['MB'][:, 0], [0, 0, 1, 1])
+
+    def test_legacy_outlier_table(self, tmp_path):
+        """The outlier table of a legacy pickle is computed from its `outl_loglike` draws."""
+        outl_loglike = np.stack((np.linspace(-3, 1, 40), np.linspace(1, 5, 40)), axis=-1)
+        with gzip.open(tmp_path/'old_fitparams.gzip.pkl', 'wb') as f:
+            pickle.dump({'outl_loglike': outl_loglike}, f)
+        table = draws.load_outlier_table(tmp_path/'old_fitparams.gzip.pkl')
+        np.testing.assert_allclose(table['mean'], [-1, 3])
+        np.testing.assert_allclose(table['p_outlier'], [0.75, 0])
@@ -0,0 +1,60 @@
+""" test_incremental.py """
+import numpy as np
+import pytest
+
+from unity import incremental
+
+MODEL_CODE = '''
+parameters {
+    real MB;
+    simplex[3] mBx1c_int_variance;
+    vector [2] true_x1cs [n_sne];
+    vector [2] x1c_star [n_sn_set];
+    vector [2] log10_R_x1c [n_sn_set];
+    cholesky_factor_corr[2] x1c_Lmat [n_sn_set];
+}
+model { }
+'''
+
+
+def last_draw(n_sne):
+    return {'MB': np.array(-19.), 'mBx1c_int_variance': np.ones(3)/3,
+            'true_x1cs': np.arange(2.*n_sne).reshape((n_sne, 2)), 'x1c_star': np.array([[0., 0.], [5., 5.]]),
+            'log10_R_x1c': np.full((2, 2), -3.), 'x1c_Lmat': np.tile(np.eye(2), (2, 1, 1))}
+
+
+class TestIncremental():
+    def test_match_names(self):
+        """Shared SNe in any order, the added ones as -1."""
+        assert np.array_equal(incremental.match_names(['a', 'b'], ['b', 'c', 'a']), [1, -1, 0])
+        with pytest.raises(ValueError, match='not in the new dataset'):
+            incremental.match_names(['a', 'b'], ['a', 'c'])
+        with pytest.raises(ValueError, match='repeated'):
+            incremental.match_names(['a'], ['a', 'c', 'c'])
+
+    def test_start_point(self):
+        """Shared SNe keep their latents, added ones are drawn near their sample's population."""
+        index = np.array([2, -1, 0, -1])
+        init = incremental.start_point(last_draw(3), index, np.array([0, 1, 0, 0]), np.random.RandomState(1))
+
+        assert init['MB'] == -19.
+        assert np.array_equal(init['true_x1cs'][[0, 2]], [[4., 5.], [0., 1.]])
+        assert np.allclose(init['true_x1cs'][1], 5., atol=0.01)
+        assert np.allclose(init['true_x1cs'][3], 0., atol=0.01)
+
+    def test_inv_metric(self):
+        """The per-SN block is reordered, the added SNe get the median, and the rest is kept."""
+        # MB, 2 for the simplex, 3 SNe of 2, then 2*2, 2*2 and 2*1 for the population.
+        metric = np.concatenate(([1.], [2., 2.], [10., 11., 20., 21., 30., 31.], np.full(10, 3.)))
+        new = incremental.inv_metric(last_draw(3), metric, MODEL_CODE, np.array([2, -1, 0]))
+
+        assert np.array_equal(new[3:9], [30., 31., 20., 21., 10., 11.])
+        assert np.array_equal(new[:3], metric[:3]) and np.array_equal(new[9:], metric[9:])
+        # A metric of another size, or a dense one, can not be mapped.
+        assert incremental.inv_metric(last_draw(3), metric[:-1], MODEL_CODE, np.array([0])) is None
+        assert incremental.inv_metric(last_draw(3), np.eye(19), MODEL_CODE, np.array([0])) is None
+
+    def test_needs_refit(self):
+        """Only the hyperparameters past the threshold, the largest first."""
+        messages = incremental.needs_refit({'MB[0]': 0.1, 'sigma_int[0]': 2., 'coeff[0]': 0.7})
+        assert [message.split()[0] for message in messages] == ['sigma_int[0]', 'coeff[0]']
@@ -0,0 +1,49 @@
+""" test_inits.py """
+import numpy as np
+
+from unity import draws, inits, sampler
+
+MODEL_CODE = '''
+parameters {
+    real MB;
+    real <lower = 0> sigma_int;
+    vector <lower = 0, upper = 0.1> [2] outl_frac;
+    simplex[3] weights;
+}
+model { }
+'''
+
+
+class TestInits():
+    def test_parameter_bounds(self):
+        """Numeric bounds of real and vector parameters, nothing for a simplex."""
+        assert sampler.parameter_bounds(MODEL_CODE) == {'MB': (None, None), 'sigma_int': (0., None),
+                                                        'outl_frac': (0., 0.1)}
+
+    def test_jitter(self):
+        """Each chain gets its own start, within the bounds, even from a value on a bound."""
+        start = {'MB': np.array(-19.), 'sigma_int': np.array(0.), 'outl_frac': np.array([0.05, 0.1]),
+                 'weights': np.ones(3)/3}
+        starts = inits.jitter(start, sampler.parameter_bounds(MODEL_CODE), 4, seed=1)
+
+        assert len(starts) == 4
+        assert len({float(init['MB']) for init in starts}) == 4
+        assert all(init['sigma_int'] > 0 for init in starts)
+        assert all(np.all((init['outl_frac'] > 0) & (init['outl_frac'] < 0.1)) for init in starts)
+        assert all(init['weights'] is start['weights'] for init in starts)
+        assert np.allclose(inits.jitter(start, sampler.parameter_bounds(MODEL_CODE), 1, 0.)[0]['MB'], -19.)
+
+    def test_unflatten(self):
+        """Stan's flat names are gathered into arrays."""
+        arrays = inits._unflatten(['MB', 'x[1,1]', 'x[2,1]', 'x[1,2]', 'x[2,2]'], [1., 2., 3., 4., 5.])
+        assert arrays['MB'] == 1.
+        assert np.array_equal(arrays['x'], [[2., 4.], [3., 5.]])
+
+    def test_from_fit(self, tmp_path):
+        """A previous fit starts at its posterior means."""
+        writer = draws.DrawWriter(tmp_path/'data_fitparams', 1)
+        writer.append({'MB': np.array([[-19.], [-19.2]])})
+        draws.merge(tmp_path/'data_fitparams')
+
+        start = inits.from_fit(tmp_path/'data_fitparams')
+        assert np.allclose(start['MB'], [-19.1])
@@ -0,0 +1,62 @@
+""" test_likelihood.py """
+import numpy as np
+from scipy.integrate import trapezoid
+from scipy.stats import multivariate_normal
+
+from unity import likelihood
+
+
+class TestRank1Likelihood():
+    def test_matches_direct(self):
+        """The Sherman-Morrison terms match a full multivariate normal, as in stan_code_simple.txt."""
+        rng = np.random.RandomState(13048293)
+        n_draws, n_sne, n_sn_set, n_gaus = 4, 6, 2, 3
+        a = rng.randn(n_sne, n_gaus, n_gaus)*0.1
+        cov = a @ a.transpose(0, 2, 1) + np.eye(n_gaus)*0.01
+        obs = rng.randn(n_sne, n_gaus)
+        sn_set_inds = np.array([0, 1, 0, 1, 1, 0])
+        true_x1cs = rng.randn(n_draws, n_sne, n_gaus - 1)
+        coeff = rng.randn(n_draws, n_gaus - 1)
+        MB = rng.randn(n_draws, n_sn_set)
+        sigma_int = rng.uniform(0.05, 0.2, (n_draws, n_sn_set))
+        outl_frac = rng.uniform(0.001, 0.1, (n_draws, n_sn_set))
+        model_mu = rng.randn(n_sne)
+
+        resid = likelihood.residuals(obs, true_x1cs, coeff, MB, model_mu, sn_set_inds)
+        term1, term2 = likelihood.mixture_terms(resid, likelihood.obs_factors(cov),
+                                                sigma_int, outl_frac, sn_set_inds)
+
+        for d in range(n_draws):
+            for i in range(n_sne):
+                s = sn_set_inds[i]
+                inlier_cov = cov[i].copy()
+                inlier_cov[0, 0] += sigma_int[d, s]**2
+                outlier_cov = inlier_cov.copy()
+                outlier_cov[0, 0] += 0.25
+                assert np.isclose(term1[d, i], np.log(1 - outl_frac[d, s])
+                                  + multivariate_normal.logpdf(resid[d, i], cov=inlier_cov))
+                assert np.isclose(term2[d, i], np.log(outl_frac[d, s])
+                                  + multivariate_normal.logpdf(resid[d, i], cov=outlier_cov))
+
+
+class TestMarginalLikelihood():
+    def test_matches_integral(self):
+        """Integrating the conditional likelihood over x1 gives the marginal terms."""
+        obs = np.array([[-0.3, 0.5]])
+        cov = np.array([[[0.01, 0.002], [0.002, 0.09]]])
+        coeff, MB = np.array([[-0.14]]), np.array([[-19.3]])
+        x1c_star, x1c_pop_cov = np.array([[[0.2]]]), np.array([[[[1.1]]]])
+        sigma_int, outl_frac = np.array([[0.1]]), np.array([[0.05]])
+        model_mu, sn_set_inds = np.array([19.1]), np.array([0])
+
+        term1, term2 = likelihood.marginal_terms(obs, cov, coeff, MB, model_mu, x1c_star, x1c_pop_cov,
+                                                 sigma_int, outl_frac, sn_set_inds)
+
+        for term, extra in ((term1, 0), (term2, 0.25)):
+            model_cov = cov[0] + np.diag([sigma_int[0, 0]**2 + extra, 0])
+            x1 = np.linspace(-8, 8, 20001)
+            mean = np.stack((coeff[0, 0]*x1 + MB[0, 0] + model_mu[0], x1), axis=-1)
+            integrand = (multivariate_normal.pdf(obs[0] - mean, cov=model_cov)
+                         * multivariate_normal.pdf(x1, x1c_star[0, 0, 0], x1c_pop_cov[0, 0, 0, 0]))
+            frac = outl_frac[0, 0] if extra else 1 - outl_frac[0, 0]
+            assert np.isclose(term[0, 0], np.log(frac*trapezoid(integrand, x1)))
@@ -0,0 +1,93 @@
+""" test_loo.py """
+import numpy as np
+import pytest
+
+from unity import likelihood, loo, simulate, unity
+
+
+def normal_fit(n_draws=20000, n=20, scale=1.):
+    """Draws of y ~ normal(mu, 1) with a flat prior on mu, and the exact leave-one-out elpd."""
+    rng = np.random.RandomState(5)
+    y = rng.randn(n)*scale
+    mu = y.mean() + rng.randn(n_draws, 1)/np.sqrt(n)
+    log_lik = -0.5*np.log(2*np.pi) - (y - mu)**2/2
+    mean_others = (y.sum() - y)/(n - 1)
+    var = 1 + 1/(n - 1)
+    exact = -0.5*np.log(2*np.pi*var) - (y - mean_others)**2/(2*var)
+    return {'log_lik': log_lik.astype(np.float32)}, exact
+
+
+class TestLoo():
+    def test_normal(self):
+        """PSIS-LOO matches exact leave-one-out, and WAIC is close to it."""
+        draws, exact = normal_fit()
+        result = loo.loo(draws, block_size=7)
+
+        assert np.allclose(result.pointwise, exact, atol=0.01)
+        assert abs(result.elpd_loo - exact.sum()) < 0.05
+        assert abs(result.elpd_waic - result.elpd_loo) < 0.05
+        assert 0.5 < result.p_loo < 1.5 and np.all(result.k_hat < 0.5)
+
+    def test_blocks(self):
+        """Reading the SNe in blocks changes nothing."""
+        draws, _ = normal_fit(2000)
+        assert np.allclose(loo.loo(draws, block_size=3).pointwise, loo.loo(draws, block_size=100).pointwise)
+
+    def test_missing(self):
+        """No fallback to PointPosteriors, and the message names a model with log_lik."""
+        with pytest.raises(ValueError, match='stan_code_marginal.txt'):
+            loo.loo({'MB': np.zeros((10, 1)), 'PointPosteriors': np.zeros((10, 3))})
+
+    def test_marginal(self):
+        """The marginal predictive is `likelihood.marginal_terms`, computed in blocks of SNe and draws."""
+        data, _ = simulate.simulate(20, 3, n_sn_set=2, seed=4)
+        stan_data = unity.prepare_data(data)
+        rng = np.random.RandomState(6)
+        draws = {'coeff': rng.randn(30, 2)*0.1, 'MB': rng.randn(30, 2)*0.1 - 19,
+                 'x1c_star': rng.randn(30, 2, 2)*0.1, 'x1c_pop_cov_mat': np.tile(np.eye(2), (30, 2, 1, 1)),
+                 'sigma_int': rng.uniform(0.05, 0.2, (30, 2)), 'outl_frac': rng.uniform(0.01, 0.1, (30, 2))}
+        terms = likelihood.marginal_terms(stan_data['obs_mBx1c'], stan_data['obs_mBx1c_cov'], draws['coeff'],
+                                          draws['MB'], stan_data['model_mu'], draws['x1c_star'],
+                                          draws['x1c_pop_cov_mat'], draws['sigma_int'], draws['outl_frac'],
+                                          stan_data['sn_set_inds'])
+        expected = loo.loo({'log_lik': np.logaddexp(*terms)})
+
+        assert np.allclose(loo.loo(draws, block_size=7, stan_data=stan_data).pointwise, expected.pointwise)
+        with pytest.raises(ValueError, match='skewed'):
+            loo.loo(draws, stan_data=dict(stan_data, allow_alpha_S_N=1))
+
+
+class TestCompare():
+    def test_ranking(self):
+        """The better fit is first, with an elpd_diff of 0."""
+        good, bad = loo.loo(normal_fit(2000)[0]), loo.loo({'log_lik': normal_fit(2000)[0]['log_lik'] - 1})
+        rows = loo.compare({'bad': bad, 'good': good})
+
+        assert [row['name'] for row in rows] == ['good', 'bad']
+        assert rows[0]['elpd_diff'] == 0 and rows[0]['diff_se'] == 0
+        assert np.isclose(rows[1]['elpd_diff'], -20, atol=1e-3)
+        assert 'good' in loo.to_text(rows)
+
+    def test_different_sne(self):
+        one, other = loo.loo(normal_fit(2000)[0]), loo.loo(normal_fit(2000, n=10)[0])
+        with pytest.raises(ValueError, match='same SNe'):
+            loo.compare({'one': one, 'other': other})
+        with pytest.raises(ValueError, match='same order'):
+            loo.compare({'one': one, 'two': one}, {'one': np.arange(20), 'two': np.arange(20)[::-1]})
+
+    def test_different_likelihoods(self):
+        """Fits with another kind of log_lik, of other observations, or without a record, are refused."""
+        result = loo.loo(normal_fit(2000)[0])
+        data = {'obs_mBx1c': np.zeros((20, 3)), 'obs_mBx1c_cov': np.tile(np.eye(3), (20, 1, 1))}
+        marginal = loo.log_lik_info('stan_code_marginal.txt', data, marginal=True)
+        fast = loo.log_lik_info('stan_code_fast.txt', data, marginal=False)
+        other = loo.log_lik_info('stan_code_marginal.txt', dict(data, obs_mBx1c=np.ones((20, 3))), marginal=True)
+        results = {'one': result, 'two': result}
+
+        assert len(loo.compare(results, infos={'one': marginal, 'two': dict(marginal, model='other.txt')})) == 2
+        with pytest.raises(ValueError, match='kind'):
+            loo.compare(results, infos={'one': marginal, 'two': fast})
+        with pytest.raises(ValueError, match='observations'):
+            loo.compare(results, infos={'one': marginal, 'two': other})
+        with pytest.raises(ValueError, match='two saved no record'):
+            loo.compare(results, infos={'one': marginal, 'two': None})
@@ -0,0 +1,51 @@
+""" test_online.py """
+import numpy as np
+
+from unity import online
+
+
+class TestRunningSummary():
+    def test_matches_numpy(self):
+        """Chunked, per-chain summaries give the statistics of all of the draws."""
+        rng = np.random.RandomState(2390183)
+        chains = [rng.randn(250, 4) + np.arange(4), rng.randn(175, 4) + np.arange(4)]
+        summaries = []
+        for chain in chains:
+            summary = online.RunningSummary((4,), reservoir_size=100, seed=1)
+            for start in range(0, len(chain), 60):
+                summary.update(chain[start:start + 60])
+            summaries.append(summary)
+        combined = online.combine(summaries)
+        draws = np.concatenate(chains)
+
+        assert combined['n'] == len(draws)
+        assert np.allclose(combined['mean'], draws.mean(axis=0))
+        assert np.allclose(combined['sd'], draws.std(axis=0, ddof=1))
+        assert np.allclose(combined['p_negative'], (draws < 0).mean(axis=0))
+        assert combined['quantiles'].shape == (len(online.QUANTILES), 4)
+
+    def test_reservoir(self):
+        """The reservoir keeps at most `reservoir_size` whole draws, all taken from the chain."""
+        chain = np.arange(500.)[:, None]*[1, -1]
+        summary = online.RunningSummary((2,), reservoir_size=50, seed=4)
+        summary.update(chain[:30])
+        assert np.array_equal(summary.sample(), chain[:30])
+        summary.update(chain[30:])
+        sample = summary.sample()
+        assert sample.shape == (50, 2)
+        assert np.array_equal(sample[:, 1], -sample[:, 0])
+        assert len(np.unique(sample[:, 0])) == 50
+
+
+class TestOutlierTable():
+    def test_columns(self):
+        """One row per SN, from the summary of `outl_loglike`."""
+        rng = np.random.RandomState(84023)
+        outl_loglike = rng.randn(2000, 3) + [-2, 0.5, 4]
+        table = online.outlier_table(online.summarize(outl_loglike, chunk_size=300, seed=2))
+
+        assert table.dtype.names == tuple(online.OUTLIER_COLUMNS)
+        assert table.shape == (3,)
+        np.testing.assert_allclose(table['mean'], outl_loglike.mean(axis=0))
+        np.testing.assert_allclose(table['p_outlier'], (outl_loglike < 0).mean(axis=0))
+        assert np.all(table['lower95'] < table['median']) and np.all(table['median'] < table['upper95'])
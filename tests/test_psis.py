@@ -0,0 +1,34 @@
+""" test_psis.py """
+import numpy as np
+from scipy import stats
+
+from unity import psis
+
+
+class TestPsis():
+    def test_k_hat(self):
+        """k-hat estimates the shape of a Pareto tail of the weights, and the weights are normalized."""
+        rng = np.random.RandomState(1)
+        weights = stats.genpareto.rvs(0.5, size=(40000, 2), random_state=rng)
+        weights[:, 1] = rng.rand(40000)
+        lw, k_hat = psis.psis(np.log(weights))
+
+        assert abs(k_hat[0] - 0.5) < 0.15
+        assert k_hat[1] < 0.
+        assert np.allclose(np.exp(lw).sum(axis=0), 1.)
+
+    def test_constant_weights(self):
+        """Equal weights stay equal, with no tail to fit."""
+        lw, k_hat = psis.psis(np.zeros(100, dtype=np.float32))
+        assert k_hat == -np.inf
+        assert np.allclose(np.exp(lw), 0.01)
+
+    def test_gpd_fit(self):
+        """The shape and scale of generalized Pareto draws."""
+        x = np.sort(stats.genpareto.rvs(0.3, scale=2, size=4000, random_state=np.random.RandomState(2)))
+        k, sigma = psis._gpd_fit(x[:, None])
+        assert abs(k[0] - 0.3) < 0.1 and abs(sigma[0] - 2) < 0.2
+
+    def test_k_threshold(self):
+        assert psis.k_threshold(100) == 0.5
+        assert psis.k_threshold(10**6) == 0.7
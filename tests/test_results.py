@@ -0,0 +1,49 @@
+""" test_results.py """
+import json
+
+import numpy as np
+
+from unity import draws, results
+
+
+def fake_store(path):
+    writer = draws.DrawWriter(path, 1)
+    writer.append({'MB': np.arange(4.).reshape((4, 1))})
+    draws.merge(path)
+    return path
+
+
+class TestResults():
+    def test_fit_key(self):
+        """The key changes with the model, the data and every setting."""
+        data = dict(n_sne=2, z_helio=np.array([0.1, 0.2]))
+        key = results.fit_key('model', data, steps=100, seed=None)
+        assert key == results.fit_key('model', dict(data), steps=100, seed=None)
+        assert key != results.fit_key('model 2', data, steps=100, seed=None)
+        assert key != results.fit_key('model', dict(data, z_helio=np.array([0.1, 0.3])), steps=100, seed=None)
+        assert key != results.fit_key('model', data, steps=200, seed=None)
+        assert key != results.fit_key('model', data, steps=100, seed=1)
+
+    def test_save_restore(self, tmp_path):
+        """A cached store is hard-linked back, without its `fit.json`."""
+        store = fake_store(tmp_path/'data_fitparams')
+        assert not results.restore('ab12', tmp_path/'cache', tmp_path/'out_fitparams')
+
+        results.save('ab12', tmp_path/'cache', store, dict(data='data.pkl'))
+        entry = results.lookup('ab12', tmp_path/'cache')
+        assert entry == tmp_path/'cache'/'ab'/'ab12'
+        with open(entry/'fit.json') as f:
+            assert json.load(f)['data'] == 'data.pkl'
+
+        assert results.restore('ab12', tmp_path/'cache', tmp_path/'out_fitparams')
+        assert not (tmp_path/'out_fitparams'/'fit.json').exists()
+        assert (tmp_path/'out_fitparams'/'MB.npy').samefile(store/'MB.npy')
+        np.testing.assert_array_equal(draws.load_draws(tmp_path/'out_fitparams')['MB'][:, 0], [0, 1, 2, 3])
+
+    def test_cache_off(self, tmp_path):
+        """With no cache directory nothing is saved or restored."""
+        store = fake_store(tmp_path/'data_fitparams')
+        results.save('ab12', None, store)
+        assert results.lookup('ab12', None) is None
+        assert not results.restore('ab12', None, tmp_path/'out_fitparams')
+        assert (store/'MB.npy').exists()
@@ -0,0 +1,49 @@
+""" test_reweight.py """
+import numpy as np
+import pytest
+
+from unity import reweight
+
+STAN_DATA = dict(outl_frac_prior_lnmean=-4.6, outl_frac_prior_lnwidth=1., lognormal_intr_prior=0, n_non_gaus_props=0)
+
+
+def prior_draws(n=20000):
+    """Draws of the prior of sigma_int alone, as if the data said nothing."""
+    rng = np.random.RandomState(3)
+    return {'sigma_int': np.abs(rng.randn(n, 1))*reweight.SIGMA_INT_SCALE, 'outl_frac': rng.rand(n, 1)*0.1,
+            'PointPosteriors': rng.randn(n, 3)}
+
+
+class TestReweight():
+    def test_prior_change(self):
+        """A narrower half-normal prior on sigma_int."""
+        result = reweight.reweight(prior_draws(), STAN_DATA, {'sigma_int_scale': 0.1}, pars=['sigma_int'])
+
+        assert result.summary.labels == ['sigma_int[0]']
+        assert abs(result.summary.values[0, 0] - 0.1*np.sqrt(2/np.pi)) < 0.005
+        assert result.reliable and result.ess < 20000
+
+    def test_nothing_changed(self):
+        """The weights are equal, and the summary that of the draws."""
+        draws = prior_draws()
+        result = reweight.reweight(draws, STAN_DATA, pars=['sigma_int'])
+
+        assert result.k_hat == -np.inf and np.isclose(result.ess, 20000)
+        assert np.isclose(result.summary.values[0, 0], draws['sigma_int'].mean())
+        assert np.allclose(result.summary.values[0, 2:], np.percentile(draws['sigma_int'], [2.5, 25, 50, 75, 97.5]),
+                           atol=1e-3)
+
+    def test_drop(self):
+        """Leaving out an SN divides by its likelihood."""
+        draws = prior_draws(10)
+        lw = reweight.log_weights(draws, reweight.prior_settings(STAN_DATA), reweight.prior_settings(STAN_DATA), [0, 2])
+        assert np.allclose(lw, -draws['PointPosteriors'][:, [0, 2]].sum(axis=1))
+
+    def test_errors(self):
+        """Unknown settings, missing draws and age mixtures."""
+        with pytest.raises(ValueError, match='unknown prior settings'):
+            reweight.reweight(prior_draws(10), STAN_DATA, {'sigma_int': 1.})
+        with pytest.raises(ValueError, match='PointPosteriors'):
+            reweight.reweight({'sigma_int': np.ones((10, 1))}, STAN_DATA, drop=[1])
+        with pytest.raises(ValueError, match='age mixtures'):
+            reweight.reweight(prior_draws(10), dict(STAN_DATA, n_non_gaus_props=1), drop=[1])
@@ -0,0 +1,168 @@
+""" test_sampler.py """
+import json
+
+import numpy as np
+import pytest
+
+from unity import sampler, unity
+
+
+class TestParameterNames():
+    def test_simple_model(self):
+        """Only the `parameters` block is read, not `transformed parameters`."""
+        with open(unity.UNITY_DIR/'stan_code_simple.txt') as f:
+            names = sampler.parameter_names(f.read())
+        assert names[:3] == ['MB', 'coeff_angles', 'sigma_int']
+        assert 'true_x1cs' in names
+        assert 'coeff' not in names
+
+    def test_default_outputs(self):
+        """The default model outputs what the default preset saves, so a default run has an outlier table."""
+        with open(unity.UNITY_DIR/'stan_code_simple.txt') as f:
+            names = sampler.output_names(f.read())
+        pars, summarize = unity.resolve_pars()
+        assert set(pars + summarize) <= set(names)
+
+
+class FakeFit():
+    def __init__(self, n, warmup, chain_id):
+        self.draws = {'MB': np.full((n, 1, 1), float(chain_id)), 'coeff_angles': np.zeros((n, 1, 2)),
+                      'log_lik': np.full((n, 1, 4), -1.)}
+        self.sampler_params = {'n_leapfrog__': np.full(warmup + n, 7.), 'treedepth__': np.full(warmup + n, 3.),
+                               'divergent__': np.zeros(warmup + n), 'stepsize__': np.full(warmup + n, 0.1)}
+
+    def get_sampler_params(self, inc_warmup):
+        return [self.sampler_params]
+
+    def get_stepsize(self):
+        return [0.1]
+
+    def get_inv_metric(self):
+        return [np.array([1., 2., 3.])]
+
+    def extract(self, pars, permuted):
+        return {key: self.draws[key] for key in pars if key in self.draws}
+
+
+class FakeModel():
+    model_code = ('parameters { real MB; vector[2] coeff_angles; } model { } '
+                  'generated quantities { vector[4] log_lik; }')
+
+    def sampling(self, data, iter, warmup, chain_id, init='random', **kwargs):
+        # A list of one id, pystan 2.19 iterates over it.
+        [chain_id] = chain_id
+        fit = FakeFit(iter - warmup, warmup, chain_id)
+        if init != 'random':
+            # Stays where it starts, so the draws show the init.
+            fit.draws['MB'][:] = init[0]['MB']
+        return fit
+
+
+class RecordingModel(FakeModel):
+    """Writes the `control` of each call to `log`, as the workers are other processes.
+
+    It pops `inv_metric` out of `control`, as pystan 2.19 does.
+    """
+    def __init__(self, log):
+        self.log = log
+
+    def sampling(self, data, iter, warmup, chain_id, init='random', control=None, **kwargs):
+        inv_metric = None if control is None else control.pop('inv_metric', None)
+        with open(self.log, 'a') as f:
+            print(json.dumps({'warmup': warmup, 'control': None if control is None else sorted(control),
+                              'inv_metric': None if inv_metric is None else list(inv_metric)}), file=f)
+        return super().sampling(data, iter, warmup, chain_id, init, **kwargs)
+
+
+class CrashingModel(RecordingModel):
+    """Fails in the third segment of a one-chain fit, as an interrupted fit."""
+    def sampling(self, data, iter, warmup, chain_id, init='random', control=None, **kwargs):
+        if chain_id == [3]:
+            raise RuntimeError('interrupted')
+        return super().sampling(data, iter, warmup, chain_id, init, control, **kwargs)
+
+
+class TestRunFits():
+    def test_two_datasets(self, tmp_path):
+        """Every fit is merged into its own store."""
+        fits = [sampler.Fit('fake', {}, 20, chains, ['MB'], ['coeff_angles'], tmp_path/f'data{chains}_fitparams',
+                            1, 3, False, 1, 2)
+                for chains in (2, 3)]
+        results = {fit.store.name: draws for fit, draws in sampler.run_fits({'fake': FakeModel()}, fits, 4)}
+
+        assert set(results) == {'data2_fitparams', 'data3_fitparams'}
+        assert results['data2_fitparams'].draws_per_chain == [10, 10]
+        assert results['data3_fitparams'].by_chain('MB').shape == (3, 10, 1)
+        assert list(results['data3_fitparams']) == ['MB']
+        # `coeff_angles` is only kept as a streamed summary.
+        assert results['data3_fitparams'].summaries == ['coeff_angles']
+        assert results['data3_fitparams'].summary('coeff_angles')['n'] == 30
+        telemetry = results['data3_fitparams'].telemetry()
+        assert [chain['draws'] for chain in telemetry['chains']] == [10, 10, 10]
+        assert telemetry['total']['mean_treedepth'] == 3 and telemetry['total']['divergent'] == 0
+        # The end state of each chain is kept, see `incremental.py`.
+        assert [state['stepsize'] for state in results['data2_fitparams'].sampler_state()] == [0.1, 0.1]
+        # Seeded with 1, each chain with its own derived seed.
+        chain_seeds = [sampler.chain_seed(1, 1), sampler.chain_seed(1, 2)]
+        assert results['data2_fitparams'].seeds == {'seed': 1, 'chain_seeds': chain_seeds}
+
+    def test_chain_seed(self):
+        """Chain seeds are fixed, valid Stan seeds, and differ between chains and fits."""
+        seeds = {sampler.chain_seed(seed, chain_id) for seed in range(3) for chain_id in range(1, 5)}
+        assert len(seeds) == 12
+        assert all(0 <= seed < sampler.MAX_SEED for seed in seeds)
+        assert sampler.chain_seed(0, 1) == sampler.chain_seed(0, 1)
+
+    def test_init_warmup(self, tmp_path):
+        """Each chain starts at its own init, with the warmup asked for."""
+        fit = sampler.Fit('fake', {}, 20, 2, ['MB'], [], tmp_path/'data_fitparams', 1, 100, False, 1, 1,
+                          [{'MB': 5.}, {'MB': 6.}], 5)
+        [(_, results)] = sampler.run_fits({'fake': FakeModel()}, [fit], 1)
+
+        assert results.draws_per_chain == [15, 15]
+        assert np.array_equal(results.by_chain('MB')[:, 0, 0], [5., 6.])
+
+    def test_segments_keep_metric(self, tmp_path):
+        """Every segment after warmup samples with the metric warmup adapted."""
+        log = tmp_path/'calls.jsonl'
+        fit = sampler.Fit('fake', {}, 20, 1, ['MB'], [], tmp_path/'data_fitparams', 1, 3, False, 1, 1)
+        list(sampler.run_fits({'fake': RecordingModel(log)}, [fit], 1))
+        calls = [json.loads(line) for line in log.read_text().splitlines()]
+
+        assert len(calls) == 4 and calls[0]['warmup'] == 10
+        assert all(call['inv_metric'] == [1., 2., 3.] for call in calls[1:])
+
+    def test_resume_keeps_metric(self, tmp_path):
+        """The checkpoints, and the segments of a resumed chain, have the metric warmup adapted."""
+        log = tmp_path/'calls.jsonl'
+        fit = sampler.Fit('fake', {}, 20, 1, ['MB'], [], tmp_path/'data_fitparams', 1, 3, False, 1, 1)
+        with pytest.raises(RuntimeError, match='interrupted'):
+            list(sampler.run_fits({'fake': CrashingModel(log)}, [fit], 1))
+        checkpoint = sampler.load_checkpoint(fit.store, 1)
+        assert checkpoint['done'] == 6 and list(checkpoint['inv_metric']) == [1., 2., 3.]
+
+        log.unlink()
+        [(_, results)] = sampler.run_fits({'fake': RecordingModel(log)}, [fit._replace(resume=True)], 1)
+        calls = [json.loads(line) for line in log.read_text().splitlines()]
+        assert results.draws_per_chain == [10]
+        assert len(calls) == 2 and all(call['inv_metric'] == [1., 2., 3.] for call in calls)
+
+    def test_no_warmup(self, tmp_path):
+        """Without warmup, adaptation is off, as pystan refuses to adapt with warmup = 0."""
+        log = tmp_path/'calls.jsonl'
+        fit = sampler.Fit('fake', {}, 6, 1, ['MB'], [], tmp_path/'data_fitparams', 1, 3, False, 1, 1, warmup=0,
+                          adapt=[{'stepsize': 0.2, 'inv_metric': np.array([1., 2., 3.])}])
+        [(_, results)] = sampler.run_fits({'fake': RecordingModel(log)}, [fit], 1)
+        calls = [json.loads(line) for line in log.read_text().splitlines()]
+
+        assert results.draws_per_chain == [6]
+        assert calls[0]['warmup'] == 0 and calls[0]['control'] == ['adapt_engaged', 'stepsize']
+        assert calls[0]['inv_metric'] == [1., 2., 3.]
+
+    def test_single_precision(self, tmp_path):
+        """`log_lik` is saved as float32, everything else as Stan gives it."""
+        fit = sampler.Fit('fake', {}, 20, 2, ['MB', 'log_lik'], [], tmp_path/'data_fitparams', 1, 4, False, 1, 1)
+        [(_, results)] = sampler.run_fits({'fake': FakeModel()}, [fit], 1)
+
+        assert results['log_lik'].dtype == np.float32 and results['log_lik'].shape == (20, 4)
+        assert results['MB'].dtype == np.float64
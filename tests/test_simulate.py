@@ -0,0 +1,40 @@
+""" test_simulate.py """
+import numpy as np
+import pytest
+
+from unity import cosmology, dataset, simulate, unity
+
+
+class TestSimulate():
+    def test_valid(self):
+        """Every shape of dataset passes the checks of the data block."""
+        for n_props, n_sn_set, n_age_mix in [(3, 1, 0), (9, 3, 0), (5, 2, 3)]:
+            data, truth = simulate.simulate(200, n_props, n_sn_set, 0.1, n_age_mix, seed=1)
+            stan_data = unity.prepare_data(data)
+            assert stan_data['obs_mBx1c'].shape == (200, n_props - (n_age_mix > 0))
+            assert truth['props'].shape == (200, n_props - 1) and truth['MB'].shape == (n_sn_set,)
+            assert set(stan_data['sn_set_inds']) == set(range(n_sn_set))
+
+    def test_seeded(self):
+        first, _ = simulate.simulate(50, 5, n_age_mix=2, seed=3)
+        second, _ = simulate.simulate(50, 5, n_age_mix=2, seed=3)
+        assert dataset.content_hash(first) == dataset.content_hash(second)
+
+    def test_outliers(self):
+        """Outliers are scattered further from the relation."""
+        _, truth = simulate.simulate(20000, outl_frac=0.1, seed=0, sigma_int=0.1)
+        resid = (truth['mB'] - truth['MB'][0] - truth['props'] @ truth['coeff']
+                 - cosmology.distance_modulus(truth['z'], truth['z']))
+        assert np.isclose(resid[~truth['outlier']].std(), 0.1, rtol=0.05)
+        assert np.isclose(truth['outlier'].mean(), 0.1, atol=0.01)
+
+    def test_bad_settings(self):
+        with pytest.raises(ValueError, match='n_props'):
+            simulate.simulate(10, 3, n_age_mix=2)
+
+    def test_save(self, tmp_path):
+        data, truth = simulate.simulate(10, seed=0)
+        data_path, truth_path = simulate.save(tmp_path/'sim', data, truth)
+        assert data_path == tmp_path/'sim_obs.unity' and truth_path == tmp_path/'sim_true.npz'
+        assert dataset.load_dataset(data_path).content_hash == dataset.content_hash(data)
+        np.testing.assert_array_equal(np.load(truth_path)['mB'], truth['mB'])
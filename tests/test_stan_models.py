@@ -0,0 +1,99 @@
+""" test_stan_models.py - The Stan models against each other, skipped without pystan.
+
+Compiling the models takes minutes the first time, after that they come from
+the model cache, see `unity.cache_dir`.
+"""
+import os
+import pickle
+import runpy
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pystan')
+
+from unity import likelihood, sampler, simulate, unity    # noqa: E402
+
+SIMPLE_TEST_DATASET = Path(__file__).resolve().parents[1]/'docs'/'source'/'simple_test_dataset.py'
+SEED = 13048293
+
+
+@pytest.fixture(scope='module')
+def simple_data(tmp_path_factory):
+    """The data of `docs/source/simple_test_dataset.py`, which writes its pickles to the cwd."""
+    directory, cwd = tmp_path_factory.mktemp('simple'), Path.cwd()
+    os.chdir(directory)
+    try:
+        runpy.run_path(str(SIMPLE_TEST_DATASET))
+    finally:
+        os.chdir(cwd)
+    with open(directory/'test_simple_300_obs.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+@pytest.fixture(scope='module')
+def simple_model():
+    return unity.load_model(unity.UNITY_DIR/'stan_code_simple.txt')
+
+
+def log_prob_diffs(reference_sm, reference_data, sm, data, draws, n=5):
+    """`log_prob` of the reference model minus that of `sm`, at `n` of the `draws` of a fit of `sm`."""
+    # log_prob needs a fit of each model.
+    reference = reference_sm.sampling(data=reference_data, iter=2, warmup=1, chains=1, seed=SEED)
+    fit = sm.sampling(data=data, iter=2, warmup=1, chains=1, seed=SEED)
+    names = sampler.parameter_names(reference_sm.model_code)
+    diffs = []
+    for i in np.linspace(0, len(draws['lp__']) - 1, n).astype(int):
+        upars = reference.unconstrain_pars({key: draws[key][i] for key in names})
+        diffs.append(reference.log_prob(upars) - fit.log_prob(upars))
+    return np.array(diffs), draws['lp__']
+
+
+def assert_constant(diffs, lp):
+    """The log densities differ by a constant, to floating point."""
+    assert np.ptp(diffs) < 1e-8*np.abs(lp).max() + 1e-6
+
+
+class TestFastModel():
+    def test_log_prob(self, simple_data, simple_model):
+        """stan_code_fast.txt has the log density of stan_code_simple.txt, up to a constant, at several points."""
+        data = unity.prepare_data(simple_data)
+        fast_sm = unity.load_model(unity.UNITY_DIR/'stan_code_fast.txt')
+        draws = fast_sm.sampling(data=data, iter=200, chains=1, seed=SEED).extract(permuted=True)
+        assert_constant(*log_prob_diffs(simple_model, data, fast_sm, data, draws))
+
+
+class TestMapRectModel():
+    @pytest.fixture(scope='class')
+    def map_rect_model(self):
+        return unity.load_model(unity.UNITY_DIR/'stan_code_map_rect.txt', threads=True)
+
+    @pytest.mark.parametrize('threads', [1, 3])
+    def test_log_prob(self, simple_data, simple_model, map_rect_model, threads):
+        """stan_code_map_rect.txt has the log density of stan_code_simple.txt, whatever the shards."""
+        data = unity.prepare_data(simple_data, threads_per_chain=threads)
+        draws = map_rect_model.sampling(data=data, iter=200, chains=1, seed=SEED).extract(permuted=True)
+        assert_constant(*log_prob_diffs(simple_model, data, map_rect_model, data, draws))
+
+    def test_ages_skew(self, simple_model, map_rect_model):
+        """The same with age mixtures and a skewed population, both sampled in the shards."""
+        raw, _ = simulate.simulate(40, 4, n_sn_set=2, n_age_mix=2, seed=5)
+        # Shards of 14, 14 and 12 SNe, so the last one is padded.
+        data = unity.prepare_data(dict(raw, allow_alpha_S_N=1), threads_per_chain=3)
+        draws = map_rect_model.sampling(data=data, iter=200, chains=1, seed=SEED).extract(permuted=True)
+        assert_constant(*log_prob_diffs(simple_model, data, map_rect_model, data, draws))
+
+
+class TestMarginalModel():
+    def test_log_lik(self, simple_data):
+        """The log_lik of stan_code_marginal.txt is `likelihood.marginal_terms`, the true values integrated out."""
+        data = unity.prepare_data(simple_data)
+        sm = unity.load_model(unity.UNITY_DIR/'stan_code_marginal.txt')
+        draws = sm.sampling(data=data, iter=100, chains=1, seed=SEED).extract(permuted=True)
+        terms = likelihood.marginal_terms(np.asarray(data['obs_mBx1c']), np.asarray(data['obs_mBx1c_cov']),
+                                          draws['coeff'], draws['MB'], np.asarray(data['model_mu']),
+                                          draws['x1c_star'], draws['x1c_pop_cov_mat'], draws['sigma_int'],
+                                          draws['outl_frac'], np.asarray(data['sn_set_inds']))
+
+        assert np.allclose(draws['log_lik'], np.logaddexp(*terms), rtol=1e-8, atol=1e-8)
@@ -0,0 +1,50 @@
+""" test_summary.py """
+import json
+
+import numpy as np
+
+from unity import draws, summary
+
+
+class TestDiagnostics():
+    def test_independent_draws(self):
+        """Independent, well mixed, chains have R-hat near 1 and ESS near the number of draws."""
+        x = np.random.RandomState(5309142).randn(4, 1000, 2)
+        r_hat, ess_bulk, ess_tail = summary.diagnostics(x)
+        np.testing.assert_allclose(r_hat, 1, atol=0.01)
+        assert np.all(ess_bulk > 3000) and np.all(ess_bulk < 5000)
+        assert np.all(ess_tail > 3000)
+
+    def test_autocorrelated_draws(self):
+        """An AR(1) chain has an ESS of about draws*(1 - phi)/(1 + phi)."""
+        rng = np.random.RandomState(8731)
+        x = np.zeros((4, 4000, 1))
+        for t in range(1, x.shape[1]):
+            x[:, t] = 0.8*x[:, t - 1] + rng.randn(4, 1)
+        _, ess_bulk, _ = summary.diagnostics(x)
+        assert abs(ess_bulk[0]/(16000*0.2/1.8) - 1) < 0.25
+
+    def test_stuck_chain(self):
+        """A chain offset from the others has a large R-hat."""
+        x = np.random.RandomState(1).randn(4, 500, 1)
+        x[0] += 3
+        assert summary.diagnostics(x)[0, 0] > 1.1
+
+
+class TestSummarize():
+    def test_store(self, tmp_path):
+        """Per-SN parameters are only summarized when asked for."""
+        rng = np.random.RandomState(42)
+        for chain_id in (1, 2):
+            draws.DrawWriter(tmp_path, chain_id).append({'MB': rng.randn(100, 1) - 19,
+                                                         'outl_loglike': rng.randn(100, 100)})
+        draws.merge(tmp_path)
+        fit = draws.load_draws(tmp_path)
+
+        table = summary.summarize(fit)
+        assert table.labels == ['MB[0]']
+        assert np.isclose(table.values[0, 0], fit['MB'].mean())
+        assert len(summary.summarize(fit, ['outl_loglike']).labels) == 100
+
+        assert summary.to_csv(table).splitlines()[0] == ','.join(['name'] + summary.COLUMNS)
+        assert json.loads(summary.to_json(table))['MB[0]']['mean'] == table.values[0, 0]
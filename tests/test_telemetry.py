@@ -0,0 +1,65 @@
+""" test_telemetry.py """
+import multiprocessing
+import sys
+
+import numpy as np
+import pytest
+
+from unity import telemetry
+
+
+def sampler_params(n, n_leapfrog, treedepth, divergent=0):
+    return {'n_leapfrog__': np.full(n, n_leapfrog), 'treedepth__': np.full(n, treedepth),
+            'divergent__': np.arange(n) < divergent, 'stepsize__': np.linspace(1, 0.2, n)}
+
+
+class TestTelemetry():
+    def test_warmup_split(self):
+        """The first segment's time is split between warmup and sampling by their leapfrog steps."""
+        params = sampler_params(20, 4., 2.)
+        params['n_leapfrog__'][:10] = 12
+        totals = telemetry.update(telemetry.new(), params, 10, 8.)
+        assert np.isclose(totals['warmup_seconds'], 6) and np.isclose(totals['sampling_seconds'], 2)
+        assert totals['draws'] == 10 and totals['stepsize'] == 0.2
+
+    def test_segments_add_up(self):
+        totals = telemetry.update(telemetry.new(), sampler_params(10, 8., 3., divergent=1), 0, 1.)
+        totals = telemetry.update(totals, sampler_params(10, 8., 5., divergent=2), 0, 1.)
+        chain = telemetry.chain_report(totals)
+        assert chain['draws'] == 20 and chain['divergent'] == 3
+        assert chain['mean_treedepth'] == 4 and chain['max_treedepth'] == 5
+        assert chain['leapfrog_per_second'] == 80
+
+    def test_report(self):
+        chains = [telemetry.update(telemetry.new(), sampler_params(10, 8., 3.), 0, 2.) for _ in range(2)]
+        report = telemetry.report(chains)
+        assert report['total']['sampling_seconds'] == 4 and report['total']['draws'] == 20
+        assert len(report['chains']) == 2 and report['ess_bulk_per_second'] == {}
+        assert 'divergent' in telemetry.to_text(report)
+
+    def test_peak_memory_summed(self):
+        """The fit's peak memory is the sum of its chains', and unknown if any chain's is."""
+        chains = [telemetry.update(telemetry.new(), sampler_params(10, 8., 3.), 0, 2., peak) for peak in (10., 30.)]
+        chains[0] = telemetry.update(chains[0], sampler_params(10, 8., 3.), 0, 2., 5.)
+        assert chains[0]['peak_rss_mb'] == 10
+        assert telemetry.report(chains)['total']['peak_rss_mb'] == 40
+        assert telemetry.report(chains + [telemetry.new()])['total']['peak_rss_mb'] is None
+
+
+def _child_peak(connection):
+    base = telemetry.reset_peak_rss()
+    before = telemetry.peak_rss_mb(base)
+    block = np.ones(2**24)    # 128 MB
+    connection.send((before, telemetry.peak_rss_mb(base), block.size))
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='reads /proc/self')
+def test_forked_peak_is_its_own():
+    """A forked worker does not count the memory of its parent."""
+    parent = np.ones(2**25)    # 256 MB, inherited by the child
+    receiver, sender = multiprocessing.get_context('fork').Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(target=_child_peak, args=(sender,))
+    process.start()
+    before, after, _ = receiver.recv()
+    process.join()
+    assert parent.size and before < 16 and 100 < after < 200
@@ -3,7 +3,7 @@ from subprocess import check_output
 
 import pytest
 
-from unity import unity
+from unity import cli, unity
 
 
 class TestUnityCompile():
@@ -12,9 +12,66 @@ class TestUnityCompile():
         with pytest.raises(FileNotFoundError, match=r'alksufwl'):
             unity.compile('alksufwl')
 
+    def test_cache_dir(self, monkeypatch, tmp_path):
+        """The cache directory comes from the argument, then $UNITY_CACHE_DIR."""
+        monkeypatch.delenv('UNITY_CACHE_DIR', raising=False)
+        assert unity.cache_dir() == unity.UNITY_DIR/'model_cache'
+        monkeypatch.setenv('UNITY_CACHE_DIR', str(tmp_path))
+        assert unity.cache_dir() == tmp_path
+        assert unity.cache_dir(tmp_path/'other') == tmp_path/'other'
+
+    def test_results_dir(self, monkeypatch, tmp_path):
+        """Finished fits are cached outside the package unless told otherwise, and not at all if off."""
+        for name in ['UNITY_RESULTS_DIR', 'UNITY_CACHE_DIR']:
+            monkeypatch.delenv(name, raising=False)
+        monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path/'xdg'))
+        assert unity.results_dir() == tmp_path/'xdg'/'unity'/'results'
+        assert unity.results_dir(tmp_path) == tmp_path/'results'
+        monkeypatch.setenv('UNITY_CACHE_DIR', str(tmp_path/'cache'))
+        assert unity.results_dir() == tmp_path/'cache'/'results'
+        monkeypatch.setenv('UNITY_RESULTS_DIR', str(tmp_path/'fits'))
+        assert unity.results_dir(tmp_path) == tmp_path/'fits'
+        monkeypatch.setenv('UNITY_RESULTS_DIR', 'off')
+        assert unity.results_dir() is None
+
+    def test_cache_threads(self, tmp_path):
+        """A model compiled with STAN_THREADS is cached separately."""
+        assert unity._cache_file('model', tmp_path) != unity._cache_file('model', tmp_path, threads=True)
+
+    def test_marginal_refuses_ages(self):
+        """The marginalized model refuses data with age mixtures."""
+        unity.check_model_data('stan_code_marginal.txt', {'n_non_gaus_props': 0})
+        unity.check_model_data('stan_code_fast.txt', {'n_non_gaus_props': 1})
+        with pytest.raises(ValueError, match='age mixtures'):
+            unity.check_model_data('stan_code_marginal.txt', {'n_non_gaus_props': 1})
+
+    def test_fast_refuses_full_dint(self):
+        """The rank-1 models refuse do_fullDint = 1 before Stan does."""
+        unity.check_model_data('stan_code_simple_debug.txt', {'n_non_gaus_props': 0, 'do_fullDint': 1})
+        with pytest.raises(ValueError, match='do_fullDint = 0'):
+            unity.check_model_data('stan_code_fast.txt', {'n_non_gaus_props': 0, 'do_fullDint': 1})
+
+    def test_resolve_pars(self):
+        """Presets, or names, of the outputs saved as draws and as streamed summaries."""
+        assert unity.resolve_pars('outliers') == (unity.HYPER_PARS, ['outl_loglike'])
+        assert unity.resolve_pars('MB, coeff,outl_loglike', 'outl_loglike') == (['MB', 'coeff'], ['outl_loglike'])
+        assert unity.resolve_pars(['MB'], 'PointPosteriors') == (['MB'], ['PointPosteriors'])
+        with pytest.raises(ValueError, match='unknown pars'):
+            unity.resolve_pars('MB[0]')
+
 
 # TODO: move to its own file.
 class TestCLI():
     def test_installed(self):
         """Is the UNITY help menu accessible?"""
-        check_output('unity --help', shell=True)
\ No newline at end of file
+        check_output('unity --help', shell=True)
+
+    def test_load_config(self, tmp_path):
+        """A config file has a list of runs and a shared core budget."""
+        (tmp_path/'study.toml').write_text('max_cores = 8\n'
+                                           '[[run]]\ndata = "a.pkl"\n'
+                                           '[[run]]\ndata = "b.pkl"\ncores = 2\n')
+        config = cli.load_config(tmp_path/'study.toml')
+        assert config.max_cores == 8
+        assert config.run == [{'data': 'a.pkl'}, {'data': 'b.pkl', 'cores': 2}]
+        assert config.plot == {}
\ No newline at end of file
@@ -0,0 +1,61 @@
+""" test_validate.py """
+import numpy as np
+import pytest
+
+from unity import validate
+
+
+def good_data(n_sne=5):
+    """A small dataset, with lists as built by build_test_dataset.py."""
+    return dict(n_sne=n_sne, n_props=3, n_non_gaus_props=1, n_sn_set=2, sn_set_inds=[0, 1]*(n_sne//2) + [0]*(n_sne % 2),
+                z_helio=[0.1]*n_sne, z_CMB=[0.1]*n_sne, obs_mBx1c=[[19., 0.1]]*n_sne,
+                obs_mBx1c_cov=[np.diag([0.01, 0.1])]*n_sne, n_age_mix=2,
+                age_gaus_mean=np.ones((1, n_sne, 2)), age_gaus_std=np.ones((1, n_sne, 2)),
+                age_gaus_A=np.full((1, n_sne, 2), 0.5), do_fullDint=0, outl_frac_prior_lnmean=-4.6,
+                outl_frac_prior_lnwidth=0.5, lognormal_intr_prior=0, allow_alpha_S_N=0, names=['a']*n_sne)
+
+
+class TestValidate():
+    def test_good_data(self):
+        """Good data becomes contiguous arrays, with model_mu added and other keys dropped."""
+        data = validate.validate(good_data())
+        assert set(data) == set(validate.SCHEMA)
+        assert data['obs_mBx1c_cov'].dtype == np.float64 and data['obs_mBx1c_cov'].flags.c_contiguous
+        assert data['sn_set_inds'].dtype == np.int64
+        assert data['n_sne'] == 5 and isinstance(data['n_sne'], int)
+        assert np.all(np.isfinite(data['model_mu']))
+
+    def test_mu_table_replaces_model_mu(self, tmp_path):
+        """An explicit distance table wins over the model_mu of the data."""
+        np.savetxt(tmp_path/'mu.txt', [[0.01, 30.], [1., 40.]])
+        data = validate.validate(dict(good_data(), model_mu=[1.]*5), tmp_path/'mu.txt')
+        assert np.all(data['model_mu'] > 30)
+        assert np.array_equal(validate.validate(dict(good_data(), model_mu=[1.]*5))['model_mu'], [1.]*5)
+
+    def test_every_problem(self):
+        """Every problem is reported, with the SNe involved."""
+        data = good_data(12)
+        data['obs_mBx1c_cov'] = np.array(data['obs_mBx1c_cov'])
+        data['obs_mBx1c_cov'][[2, 9], 1, 1] = -1
+        data['sn_set_inds'][4] = 2
+        data['z_CMB'][7] = np.nan
+        data['age_gaus_A'][0, 3] = [0.5, 0.6]
+        data['obs_mBx1c'] = data['obs_mBx1c'][:11]
+        del data['do_fullDint']
+        _, problems = validate.check(data)
+        assert problems == [
+            'do_fullDint is missing.',
+            'z_CMB contains an infinity or NaN value for SN 7 (1 of 12).',
+            'obs_mBx1c has shape (11, 2), not (12, 2) (n_sne, n_gaus).',
+            'sn_set_inds must be less than n_sn_set (2), python index numbering, for SN 4 (1 of 12).',
+            'age_gaus_A must sum to one, it is a simplex, for SN 3 (1 of 12).']
+
+    def test_covariance(self):
+        """With do_fullDint = 0 each covariance must be positive definite."""
+        data = good_data()
+        data['obs_mBx1c_cov'] = np.array(data['obs_mBx1c_cov'])
+        data['obs_mBx1c_cov'][[1, 3], 1, 1] = 0
+        with pytest.raises(ValueError, match=r'not positive definite.*SNe 1, 3 \(2 of 5\)'):
+            validate.validate(data)
+        data['do_fullDint'] = 1
+        validate.validate(data)
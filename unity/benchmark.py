@@ -0,0 +1,198 @@
+""" benchmark.py - How UNITY fits scale with the data and the model.
+
+`run` fits synthetic datasets (see `simulate.py`) over a grid of N_SN,
+n_props (3 for SALT2, 9 for SNEMO7 with host mass and age), age-mixture
+components and Stan models. For each case it records
+
+* `compile_seconds` and `load_seconds` of the model,
+* `warmup_seconds` and `sampling_seconds`, summed over chains,
+* `gradient_seconds`, the wall time per leapfrog step (one gradient),
+* `min_ess_per_second`, the lowest bulk ESS per second of sampling of the
+  hyperparameters, with the divergences and mean tree depth,
+* `peak_rss_mb`, the peak resident memory of the fit's chains, summed over
+  the chains as they all run at once.
+
+The timings and the memory come from the fit's telemetry (see
+`telemetry.py`). Each chain counts only the memory it adds above what its
+worker inherited from the parent when it was forked, so the harness itself
+is not counted. The memory is only known on Linux. Each case runs in its own
+forked process.
+
+Every result is appended to a JSON lines history file. `regressions` compares
+a result with the last one of the same case, settings and host, against the
+relative `THRESHOLDS`.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from . import sampler, simulate, unity
+
+# The default grid, see `cases`.
+N_SNE = (100, 300, 1000, 3000, 5000)
+N_PROPS = (3, 5, 7, 9)
+N_AGE_MIX = (0, 3)
+MODELS = ('stan_code_fast.txt', 'stan_code_marginal.txt')
+
+HISTORY = 'benchmarks.jsonl'
+
+# The largest relative change of a metric that is not a regression, and whether
+# more is better. Timings vary from run to run, so these are generous.
+THRESHOLDS = {'gradient_seconds': (0.25, False), 'min_ess_per_second': (0.5, True), 'peak_rss_mb': (0.25, False)}
+
+Case = namedtuple('Case', 'model n_sne n_props n_age_mix')
+
+
+def cases(models=MODELS, n_sne=N_SNE, n_props=N_PROPS, n_age_mix=N_AGE_MIX) -> list:
+    """Every combination of the settings a model can fit.
+
+    With age mixtures, the age is one of the `n_props` properties. At least
+    mB, x1 and c must be Gaussian, and the marginalized models can not fit age
+    mixtures.
+    """
+    grid = []
+    for model, n, props, mix in itertools.product(models, n_sne, n_props, n_age_mix):
+        if props - (mix > 0) < 3 or (mix > 0 and model in unity.MARGINAL_MODELS):
+            continue
+        grid.append(Case(model, n, props, mix))
+    return grid
+
+
+def _fit_case(sm, case: Case, steps: int, chains: int, seed: int, connection):
+    """Fit one case and send its metrics through `connection`. Runs in a forked process."""
+    try:
+        data, _ = simulate.simulate(case.n_sne, case.n_props, n_age_mix=case.n_age_mix, seed=seed)
+        stan_data = unity.prepare_data(data)
+        with tempfile.TemporaryDirectory() as tmp:
+            draws = sampler.run_chains(sm, stan_data, steps, chains, chains, pars=unity.HYPER_PARS,
+                                       store=Path(tmp)/'benchmark_fitparams', seed=seed)
+            telemetry = draws.telemetry()
+        total, ess = telemetry['total'], telemetry['ess_bulk_per_second']
+        rate = total['leapfrog_per_second']
+        connection.send({'warmup_seconds': total['warmup_seconds'], 'sampling_seconds': total['sampling_seconds'],
+                         'gradient_seconds': 1/rate if rate else None,
+                         'min_ess_per_second': min(ess.values()) if ess else None,
+                         'divergent': total['divergent'], 'mean_treedepth': total['mean_treedepth'],
+                         'peak_rss_mb': total['peak_rss_mb']})
+    except Exception as err:
+        connection.send(err)
+    finally:
+        connection.close()
+
+
+def run(grid: list, steps: int = 200, chains: int = 2, seed: int = 13048293, cache=None,
+        recompile: bool = False, history: Path = None) -> list:
+    """Benchmark every case of `grid`, one at a time.
+
+    Parameters:
+        grid (list of Case):
+            See `cases`.
+
+        steps, chains (int):
+            Of each fit, the chains run at once.
+
+        seed (int):
+            Of the data and of the sampler.
+
+        cache (str):
+            The compiled model cache directory, see `unity.cache_dir`.
+
+        recompile (bool):
+            Compile each model, and time it, even if it is cached.
+
+        history (pathlib.Path):
+            A JSON lines file the results are appended to, if given.
+
+    Returns:
+        (list of dict):
+            One result per case, see `result`.
+    """
+    models = {}
+    for model in dict.fromkeys(case.model for case in grid):
+        compile_seconds = None
+        if recompile:
+            start = time.perf_counter()
+            unity.compile(unity.UNITY_DIR/model, cache)
+            compile_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        sm = unity.load_model(unity.UNITY_DIR/model, cache)
+        models[model] = sm, {'compile_seconds': compile_seconds, 'load_seconds': time.perf_counter() - start}
+
+    results = []
+    context = multiprocessing.get_context('fork')
+    for case in grid:
+        sm, model_metrics = models[case.model]
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_fit_case, args=(sm, case, steps, chains, seed, sender))
+        process.start()
+        sender.close()
+        metrics = receiver.recv()
+        process.join()
+        if isinstance(metrics, Exception):
+            raise metrics
+        results.append(result(case, dict(model_metrics, **metrics), steps, chains, seed))
+        if history is not None:
+            with open(history, 'a') as f:
+                f.write(json.dumps(results[-1]) + '\n')
+    return results
+
+
+def result(case: Case, metrics: dict, steps: int, chains: int, seed: int) -> dict:
+    """A history record, the case, the settings and host it ran with, and its metrics."""
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(), 'cpus': os.cpu_count(),
+            'case': case._asdict(), 'settings': {'steps': steps, 'chains': chains, 'seed': seed},
+            'metrics': metrics}
+
+
+def read_history(history: Path) -> list:
+    """The records of a history file, oldest first, none if it does not exist."""
+    try:
+        with open(history) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def regressions(record: dict, history: list, thresholds: dict = THRESHOLDS) -> list:
+    """How `record` is worse than the last comparable record of `history`.
+
+    Records are comparable if they have the same case, settings and host.
+
+    Returns:
+        (list of str):
+            One message per metric past its threshold.
+    """
+    previous = [old for old in history if (old['case'], old['settings'], old['host'])
+                == (record['case'], record['settings'], record['host'])]
+    if not previous:
+        return []
+    old, new = previous[-1]['metrics'], record['metrics']
+    problems = []
+    for metric, (threshold, higher_is_better) in thresholds.items():
+        if old.get(metric) is None or new.get(metric) is None or old[metric] == 0:
+            continue
+        change = new[metric]/old[metric] - 1
+        if (-change if higher_is_better else change) > threshold:
+            problems.append(f'{metric} went from {old[metric]:.4g} to {new[metric]:.4g} ({change:+.0%}), '
+                            f'since {previous[-1]["time"]}.')
+    return problems
+
+
+def to_text(results: list) -> str:
+    """A fixed width table of results."""
+    columns = ['gradient_seconds', 'min_ess_per_second', 'warmup_seconds', 'sampling_seconds', 'peak_rss_mb',
+               'divergent']
+    lines = [f"{'model':<24}{'n_sne':>7}{'props':>6}{'mix':>4}"
+             + ''.join(f'{column:>20}' for column in columns)]
+    for record in results:
+        case, metrics = record['case'], record['metrics']
+        lines.append(f"{case['model']:<24}{case['n_sne']:>7}{case['n_props']:>6}{case['n_age_mix']:>4}"
+                     + ''.join(f'{"-":>20}' if metrics[column] is None else f'{metrics[column]:>20.4g}'
+                               for column in columns))
+    return '\n'.join(lines)
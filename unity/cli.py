@@ -1,5 +1,7 @@
 '''cli.py -- The CLI to Unity
 '''
+import sys
+from glob import glob
 from pathlib import Path
 from collections import namedtuple
 
@@ -8,16 +10,41 @@ from numpy import array
 from toml import loads
 
 # from unity import unity, plot_stan
-from . import unity, plot_stan
+from . import benchmark, cv, dataset, incremental, inits, loo, unity, plot_stan, reweight, simulate, summary, validate
+from .draws import Draws, load_draws
 
 
 CWD = Path.cwd()  # cwd from where python was called
 
-config = namedtuple('config', 'run plot')
+config = namedtuple('config', 'run plot max_cores')
 
 
 def load_config(file_path):
     """Loads the config file into a config-namedtuple
+
+    A config file has a list of `[[run]]` tables, one per fit, with the keys
+    of `unity.JOB_DEFAULTS`, an optional `[plot]` table and an optional
+    top-level `max_cores`, the core budget shared by all of the runs.
+
+    .. code-block:: toml
+
+        max_cores = 32
+
+        [[run]]
+        data = "mass.pkl"
+        model = "stan_code_fast.txt"
+        steps = 40000
+        seed = 1234
+        cores = 4
+        output = "fits"
+
+        [[run]]
+        data = "mass_local.pkl"
+        chains = 8
+        init = "map"
+        warmup = 200
+        pars = ["MB", "coeff", "sigma_int"]
+        summarize = ["outl_loglike", "PointPosteriors"]
         
     Parameters:
         input (pathlib.Path):
@@ -26,12 +53,73 @@ def load_config(file_path):
     
     Returns:
         (namedtuple -- config):
-            Contains two sub-structures (run, plot) that will return a
-            dictionary of configuration options. You can get your desired
-            config-dictionary via `config.run` or `config.plot`.
+            Contains `run`, a list of dictionaries of the options of each
+            run, `plot`, a dictionary, and `max_cores`, an int or None.
     """
     with open(file_path) as f:
-        return config(**loads(f.read()))
+        options = loads(f.read())
+    unknown = set(options) - set(config._fields)
+    if unknown:
+        raise click.BadParameter(f"Unknown config options: {', '.join(sorted(unknown))}.")
+    runs = options.get('run', [])
+    # A single `[run]` table is one run.
+    if isinstance(runs, dict):
+        runs = [runs]
+    return config(runs, options.get('plot', {}), options.get('max_cores'))
+
+
+def _options(*options):
+    """One decorator applying each of the click `options`, in order, for options shared by commands."""
+    def decorate(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+    return decorate
+
+
+model_cache_option = click.option(
+    '--cache-dir', envvar='UNITY_CACHE_DIR',
+    help='Where compiled models are cached. Default is $UNITY_CACHE_DIR, or model_cache/ in the UNITY package.')
+
+fit_cache_option = click.option(
+    '--cache-dir', envvar='UNITY_CACHE_DIR',
+    help='Where compiled models, and finished fits, are cached. '
+         'Default is $UNITY_CACHE_DIR, or model_cache/ in the UNITY package.')
+
+# The sampler settings of unity run and unity sweep.
+sampling_options = _options(
+    click.option(
+        '--pars', default=unity.PARS,
+        help='The outputs saved as draws: a preset, summary-only (hyperparameters), outliers (hyperparameters, '
+             'with outl_loglike kept as a streamed summary), loo (also log_lik and the population, '
+             'for unity compare) or full, or comma separated Stan names. Default is outliers.'),
+    click.option(
+        '--summarize',
+        help='Comma separated Stan outputs, e.g. per-SN ones, kept only as a streamed summary '
+             '(mean, sd, quantiles and P(< 0)) rather than as draws.'),
+    click.option(
+        '--rerun', is_flag=True,
+        help='Sample again even if an identical fit is in the result cache, $UNITY_RESULTS_DIR '
+             '(default results/ in --cache-dir, or ~/.cache/unity/results). Delete it to clear it.'),
+    click.option(
+        '--seed', type=int,
+        help='Seed for the sampler, each chain gets its own seed derived from it. Default is a random seed, '
+             'saved with the draws.'),
+    click.option(
+        '--progress', is_flag=True,
+        help="Print each chain's leapfrog steps per second, divergences, tree depth and step size after every "
+             'chunk. They are saved in the telemetry.json of the draws either way.'),
+    click.option(
+        '--init', default='random',
+        help="Where the chains start: random (Stan's default), map (the posterior mode from the optimizer), "
+             "advi (the mean of a mean-field ADVI fit) or a previous fit's *_fitparams directory, its "
+             'posterior means. Each chain starts at its own jittered copy. Default is random.'),
+    click.option(
+        '--init-jitter', default=inits.JITTER,
+        help=f'How far apart the chains start around --init, on the unconstrained scale. Default is {inits.JITTER}.'),
+    click.option(
+        '--warmup', type=int,
+        help='Warmup iterations per chain, out of --steps. Default is half of --steps, a good --init needs much less.'))
 
 
 @click.group()
@@ -41,10 +129,11 @@ def cli():
 
 
 @cli.command()
-@click.argument('data')
-@click.option('--config', help='The path to a config file')
+@click.argument('data', required=False)
+@click.option('--config', help='The path to a TOML config file of [[run]] tables, run instead of DATA.')
 @click.option('--model', default='stan_code_simple.txt',
-              help='The file containing the Stan model to be used.')
+              help='The file containing the Stan model to be used. stan_code_fast.txt is faster when do_fullDint is 0, '
+                   'stan_code_marginal.txt is faster again when there are no age mixtures.')
 @click.option('--steps', default=1000,
               help='How many steps should the fit be performed for. Default is 1000. (pystan option `iter`)')
 @click.option('--chains', default=4,
@@ -52,18 +141,386 @@ def cli():
 @click.option('--interactive', is_flag=True,
               help='Drop into an interactive debugger when fit is done to explore results.')
 @click.option('--max_cores', default=1,
-              help='The maximum number of cores to use. Chains run in series if needed. Default is one. (pystan option `n_jobs`)')
-def run(data, config, model, steps, chains, interactive, max_cores):
-    """Run Unity on the pickle DATA file."""
+              help='The maximum number of cores to use, one chain per worker process. Chains run in series if '
+                   'needed. Default is one.')
+@click.option('--chunk-size', default=1000,
+              help='How many draws each chain samples, and writes to disk, at a time. '
+                   'A checkpoint is saved after each chunk. Default is 1000.')
+@click.option('--resume', is_flag=True,
+              help='Continue an interrupted run from its last checkpoints, skipping warmup.')
+@fit_cache_option
+@click.option('--threads-per-chain', default=1,
+              help='Threads within each chain, for --model stan_code_map_rect.txt. '
+                   'Chains share --max_cores, e.g. 32 cores run 4 chains of 8 threads. Default is one.')
+@click.option('--mu-table',
+              help='A text file of redshift and distance modulus columns to interpolate the SN distances from. '
+                   'Replaces any model_mu in the DATA file. Default is that model_mu, or else the polynomial '
+                   'distance in cosmology.py.')
+@sampling_options
+def run(data, config, model, steps, chains, interactive, max_cores, chunk_size, resume, cache_dir,
+        threads_per_chain, mu_table, pars, summarize, rerun, seed, progress, init, init_jitter, warmup):
+    """Run Unity on the DATA file, a pickle or .unity dataset, or on every run in a --config file.
+
+    The runs of a config file share max_cores from the file, or else --max_cores.
+    """
     # load config file if exists, or use cli/default values
     if config is not None:
         config = load_config(CWD/Path(config))
-        print(config.run)
-        import sys; sys.exit()
-        unity.run(**config.run)
+        if not config.run:
+            raise click.UsageError('The config file has no [[run]] tables.')
+        unity.run_jobs(config.run, config.max_cores or max_cores, cache_dir, progress)
+    elif data is None:
+        raise click.UsageError('Give a DATA file or a --config file.')
     else:
         # over ride with cli, for any argument given,
-        unity.run(model, data, steps, chains, interactive, max_cores)
+        unity.run(model, data, steps, chains, interactive, max_cores, chunk_size, resume, cache_dir,
+                  threads_per_chain, mu_table, pars, summarize, rerun, seed, progress, init, init_jitter, warmup)
+
+
+@cli.command()
+@click.argument('data', nargs=-1)
+@click.option('--manifest', help='A text file listing the data pickle files, one per line. # starts a comment.')
+@click.option('--model', default='stan_code_simple.txt',
+              help='The file containing the Stan model to be used for every dataset.')
+@click.option('--steps', default=1000,
+              help='How many steps each fit is performed for. Default is 1000. (pystan option `iter`)')
+@click.option('--chains', default=4,
+              help='The number of chains per dataset. Default is four.')
+@click.option('--max_cores', default=1,
+              help='The number of cores shared by every chain of every dataset. Default is one.')
+@click.option('--chunk-size', default=1000,
+              help='How many draws each chain samples, and writes to disk, at a time. Default is 1000.')
+@click.option('--resume', is_flag=True,
+              help='Continue interrupted fits from their last checkpoints, and skip finished ones.')
+@fit_cache_option
+@click.option('--threads-per-chain', default=1,
+              help='Threads within each chain, for --model stan_code_map_rect.txt. Default is one.')
+@click.option('--mu-table',
+              help='A text file of redshift and distance modulus columns to interpolate the SN distances from.')
+@sampling_options
+def sweep(data, manifest, model, steps, chains, max_cores, chunk_size, resume, cache_dir, threads_per_chain,
+          mu_table, pars, summarize, rerun, seed, progress, init, init_jitter, warmup):
+    """Run Unity on several pickle DATA files, or glob patterns, with the same settings.
+
+    The model is loaded once and every chain of every dataset shares one pool
+    of --max_cores cores. Each dataset gets its own output files, named after it.
+    """
+    datasets = []
+    if manifest is not None:
+        with open(CWD/manifest) as f:
+            data = data + tuple(line.split('#')[0].strip() for line in f)
+    for pattern in filter(None, data):
+        # Globs are expanded here too, so they can be quoted or listed in a manifest.
+        matches = sorted(glob(str(CWD/pattern))) if any(c in pattern for c in '*?[') else [pattern]
+        if not matches:
+            raise click.BadParameter(f'{pattern} matches no files.')
+        datasets += [str((CWD/m).resolve()) for m in matches if str((CWD/m).resolve()) not in datasets]
+    if not datasets:
+        raise click.UsageError('Give at least one DATA file or a --manifest.')
+    unity.sweep(model, datasets, steps, chains, max_cores, chunk_size, resume, cache_dir, threads_per_chain,
+                mu_table, pars, summarize, rerun, seed, progress, init, init_jitter, warmup)
+
+
+@cli.command()
+@click.argument('data')
+@click.option('--previous', required=True,
+              help="The previous fit's *_fitparams directory. DATA must have every SN of it, matched by name.")
+@click.option('--model', default='stan_code_simple.txt',
+              help='The Stan model of the previous fit.')
+@click.option('--steps', default=1000,
+              help='How many steps each chain runs, including --warmup. Default is 1000.')
+@click.option('--chains', default=4,
+              help='The number of chains. Default is four.')
+@click.option('--warmup', default=incremental.WARMUP,
+              help='Warmup iterations per chain, adapting from where the previous fit ended. '
+                   f'Default is {incremental.WARMUP}.')
+@click.option('--max_cores', default=1,
+              help='The maximum number of cores to use, one chain per worker process. Default is one.')
+@click.option('--chunk-size', default=1000,
+              help='How many draws each chain samples, and writes to disk, at a time. Default is 1000.')
+@model_cache_option
+@click.option('--threads-per-chain', default=1,
+              help='Threads within each chain, for --model stan_code_map_rect.txt. Default is one.')
+@click.option('--mu-table',
+              help='A text file of redshift and distance modulus columns to interpolate the SN distances from.')
+@click.option('--pars', default=unity.PARS,
+              help='The outputs saved as draws, as in unity run. Default is outliers.')
+@click.option('--summarize',
+              help='Comma separated Stan outputs kept only as a streamed summary, as in unity run.')
+@click.option('--seed', type=int,
+              help='Seed for the sampler and the start points of the added SNe. Default is a random seed.')
+@click.option('--progress', is_flag=True,
+              help="Print each chain's sampler statistics after every chunk.")
+@click.option('--max-shift', default=incremental.MAX_SHIFT,
+              help='Warn that a full refit is needed if a hyperparameter moves by more than this many '
+                   f'previous posterior standard deviations. Default is {incremental.MAX_SHIFT}.')
+def update(data, previous, model, steps, chains, warmup, max_cores, chunk_size, cache_dir, threads_per_chain,
+           mu_table, pars, summarize, seed, progress, max_shift):
+    """Update a previous fit with the SNe added to its dataset, DATA, which has every SN of the fit and the new ones.
+
+    Each chain starts where a chain of the previous fit ended, with the added
+    SNe drawn from its population, so only a short warmup is needed.
+    """
+    unity.update(previous, model, data, steps, chains, max_cores, warmup, chunk_size, cache_dir, threads_per_chain,
+                 mu_table, pars, summarize, seed, progress, max_shift)
+
+
+@cli.command(name='cv')
+@click.argument('data')
+@click.option('--folds', default=str(cv.K),
+              help='The number of folds of random SNe, stratified by sample, or "sample" to leave out one sample '
+                   f'(sn_set_inds) at a time. Default is {cv.K}.')
+@click.option('--model', default='stan_code_simple.txt',
+              help='The Stan model every fold is fit with.')
+@click.option('--steps', default=1000,
+              help='How many steps each chain runs, including warmup. Default is 1000.')
+@click.option('--chains', default=4,
+              help='The number of chains of each fold. Default is four.')
+@click.option('--max_cores', default=1,
+              help='The cores shared by every chain of every fold, one chain per worker process. Default is one.')
+@click.option('--chunk-size', default=1000,
+              help='How many draws each chain samples, and writes to disk, at a time. Default is 1000.')
+@model_cache_option
+@click.option('--threads-per-chain', default=1,
+              help='Threads within each chain, for --model stan_code_map_rect.txt. Default is one.')
+@click.option('--mu-table',
+              help='A text file of redshift and distance modulus columns to interpolate the SN distances from.')
+@click.option('--recenter',
+              help='Comma separated columns of obs_mBx1c, e.g. host mass, shifted by their mean over the training '
+                   'SNe of each fold, as rdr2019/cut_JLA.py does.')
+@click.option('--rerun', is_flag=True,
+              help='Sample every fold, even if an identical fit is in the result cache.')
+@click.option('--seed', type=int,
+              help='Seed of the folds and of the sampler. Default is a random seed.')
+@click.option('--progress', is_flag=True,
+              help="Print each chain's sampler statistics after every chunk.")
+def cross_validate(data, folds, model, steps, chains, max_cores, chunk_size, cache_dir, threads_per_chain, mu_table,
+                   recenter, rerun, seed, progress):
+    """Cross-validate a fit of DATA, fitting every fold at once and scoring the SNe each leaves out.
+
+    Prints the held-out log predictive density of each fold, their total with
+    its standard error, and the jackknife of the standardization coefficients.
+    """
+    if folds != 'sample' and not folds.isdigit():
+        raise click.BadParameter('must be a number of folds or "sample".', param_hint='--folds')
+    try:
+        recenter = [] if recenter is None else _ints(recenter)
+    except ValueError:
+        raise click.BadParameter('must be comma separated integers.', param_hint='--recenter')
+    unity.cross_validate(model, data, steps, chains, folds, max_cores, chunk_size, cache_dir, threads_per_chain,
+                         mu_table, recenter, rerun, seed, progress)
+
+
+@cli.command()
+@click.argument('data', nargs=-1, required=True)
+@click.option('--output-dir', help='Where to write the datasets. Default is next to each DATA file.')
+def convert(data, output_dir):
+    """Convert pickle DATA files to memory-mappable .unity datasets.
+
+    Each DATA.pkl becomes DATA.unity/, which `unity run` reads without unpickling anything.
+    """
+    for data_file in data:
+        output = Path(data_file).with_suffix(dataset.SUFFIX)
+        if output_dir is not None:
+            (CWD/output_dir).mkdir(parents=True, exist_ok=True)
+            output = Path(output_dir)/output.name
+        path = dataset.convert(CWD/data_file, CWD/output)
+        click.echo(f'{data_file} -> {output} (sha256 {dataset.Dataset(path).content_hash[:12]})')
+
+
+@cli.command(name='simulate')
+@click.argument('name')
+@click.option('--n-sne', default=300, help='The number of SNe. Default is 300.')
+@click.option('--n-props', default=3, help='mB, x1, c and then host properties. Default is 3.')
+@click.option('--n-sn-set', default=1, help='The number of samples, each with its own MB. Default is one.')
+@click.option('--outl-frac', default=0.02, help='The fraction of outliers, at most 0.1. Default is 0.02.')
+@click.option('--n-age-mix', default=0,
+              help='Components of the age mixture of the last host property, 0 for none. Default is 0.')
+@click.option('--seed', type=int, help='Seed of the generator. Default is a random seed.')
+@click.option('--format', 'output_format', type=click.Choice(['unity', 'pkl']), default='unity',
+              help='A .unity dataset or a pickle. Default is unity.')
+def simulate_data(name, n_sne, n_props, n_sn_set, outl_frac, n_age_mix, seed, output_format):
+    """Draw a synthetic dataset from the UNITY model, NAME_obs.unity, and its true values, NAME_true.npz."""
+    try:
+        data, truth = simulate.simulate(n_sne, n_props, n_sn_set, outl_frac, n_age_mix, seed)
+    except ValueError as err:
+        raise click.UsageError(str(err))
+    data_path, truth_path = simulate.save(CWD/name, data, truth, output_format)
+    click.echo(f'{data_path.name}, {truth_path.name}')
+
+
+@cli.command(name='validate')
+@click.argument('data', nargs=-1, required=True)
+@click.option('--model', help='Also check that the data can be fit by this model, e.g. stan_code_marginal.txt.')
+@click.option('--mu-table',
+              help='A text file of redshift and distance modulus columns to interpolate the SN distances from.')
+def validate_data(data, model, mu_table):
+    """Check pickle DATA files against the Stan data block, without loading a model.
+
+    Every problem is listed, with the indices of the SNe involved. Exits with
+    status 1 if any file has a problem.
+    """
+    failed = False
+    for data_file in data:
+        stan_data = unity.read_data(CWD/data_file)
+        _, problems = validate.check(stan_data, None if mu_table is None else CWD/mu_table)
+        if model is not None and not problems:
+            try:
+                unity.check_model_data(Path(model).name, stan_data)
+            except ValueError as err:
+                problems.append(str(err))
+        click.echo(f'{data_file}: ' + ('ok' if not problems else '\n  ' + '\n  '.join(problems)))
+        failed = failed or bool(problems)
+    if failed:
+        sys.exit(1)
+
+
+def _ints(text: str) -> list:
+    return [int(x) for x in text.split(',')]
+
+
+@cli.command(name='benchmark')
+@click.option('--n-sne', default=','.join(map(str, benchmark.N_SNE)),
+              help='Comma separated numbers of SNe. Default is 100 to 5000.')
+@click.option('--n-props', default=','.join(map(str, benchmark.N_PROPS)),
+              help='Comma separated numbers of properties, 3 for SALT2 up to 9 for SNEMO7.')
+@click.option('--n-age-mix', default=','.join(map(str, benchmark.N_AGE_MIX)),
+              help='Comma separated numbers of age-mixture components, 0 for none.')
+@click.option('--models', default=','.join(benchmark.MODELS),
+              help='Comma separated Stan models. Default is stan_code_fast.txt and stan_code_marginal.txt.')
+@click.option('--steps', default=200, help='Iterations per chain, including warmup. Default is 200.')
+@click.option('--chains', default=2, help='Chains per fit, run at once. Default is two.')
+@click.option('--seed', default=13048293, help='Seed of the data and the sampler.')
+@click.option('--recompile', is_flag=True, help='Compile each model, and time it, even if it is cached.')
+@click.option('--history', default=benchmark.HISTORY,
+              help=f'The JSON lines file results are appended to, and compared with. Default is {benchmark.HISTORY}.')
+@model_cache_option
+def run_benchmark(n_sne, n_props, n_age_mix, models, steps, chains, seed, recompile, history, cache_dir):
+    """Time fits of synthetic data over a grid of N_SN, n_props, age mixtures and models.
+
+    Records the compile time, time per gradient, ESS per second and peak memory
+    of each case. Exits with status 1 if a case regressed since its last
+    comparable run in the --history file.
+    """
+    grid = benchmark.cases(models.split(','), _ints(n_sne), _ints(n_props), _ints(n_age_mix))
+    if not grid:
+        raise click.UsageError('No case in the grid can be fit, see `benchmark.cases`.')
+    past = benchmark.read_history(CWD/history)
+    results = benchmark.run(grid, steps, chains, seed, cache_dir, recompile, CWD/history)
+    click.echo(benchmark.to_text(results))
+    failed = False
+    for record in results:
+        for problem in benchmark.regressions(record, past):
+            click.echo(f"Regression, {record['case']['model']} N_SN={record['case']['n_sne']} "
+                       f"n_props={record['case']['n_props']} n_age_mix={record['case']['n_age_mix']}: {problem}")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+@cli.command(name='summary')
+@click.argument('fit')
+@click.option('--pars',
+              help='Comma separated parameters to summarize, e.g. MB,outl_loglike. '
+                   f'Default is every parameter with at most {summary.MAX_SIZE} values per draw.')
+@click.option('--format', 'output_format', type=click.Choice(list(summary.FORMATS)), default='text',
+              help='The output format. Default is text.')
+@click.option('--output', help='Write the summary to this file rather than to the screen.')
+def summarize(fit, pars, output_format, output):
+    """Summarize the FIT, a *_fitparams directory: mean, sd, quantiles, R-hat and ESS.
+
+    Per-SN parameters, such as outl_loglike, are only summarized when they are given to --pars.
+    """
+    try:
+        table = summary.summarize(load_draws(CWD/fit), None if pars is None else pars.split(','))
+    except KeyError as err:
+        raise click.BadParameter(err.args[0], param_hint='--pars')
+    text = summary.FORMATS[output_format](table)
+    if output is None:
+        click.echo(text)
+    else:
+        with open(CWD/output, 'w') as f:
+            print(text, file=f)
+
+
+@cli.command(name='reweight')
+@click.argument('fit')
+@click.argument('data')
+@click.option('--set', 'changes', multiple=True,
+              help='A prior setting and its new value, e.g. --set outl_frac_prior_lnmean=-3. Any of '
+                   f"{', '.join(reweight.PRIORS)}, sigma_int_scale being the width of sigma_int ~ normal(0, "
+                   f'{reweight.SIGMA_INT_SCALE}). Can be given several times.')
+@click.option('--drop',
+              help='Comma separated names of SNe to leave out. Needs PointPosteriors draws, e.g. --pars full.')
+@click.option('--pars',
+              help='Comma separated parameters to summarize. Default is every parameter saved as draws with at '
+                   f'most {summary.MAX_SIZE} values per draw.')
+def reweight_fit(fit, data, changes, drop, pars):
+    """Reweight the FIT, a *_fitparams directory of the DATA file, to other priors or without some SNe.
+
+    The draws are reweighted with Pareto-smoothed importance sampling, no
+    refit is needed. Exits with 1 if the Pareto k-hat says only a refit will do.
+    """
+    settings = {}
+    for change in changes:
+        key, _, value = change.partition('=')
+        try:
+            settings[key.strip()] = float(value)
+        except ValueError:
+            raise click.BadParameter(f'{change} is not NAME=NUMBER.', param_hint='--set')
+    try:
+        stan_data = unity.read_data(CWD/data)
+        position = {str(name): i for i, name in enumerate(stan_data.get('names', []))}
+        drop = [] if drop is None else drop.split(',')
+        unknown = [name for name in drop if name not in position]
+        if unknown:
+            raise ValueError(f"{', '.join(unknown)} not in the names of {data}.")
+        result = reweight.reweight(load_draws(CWD/fit), stan_data, settings, [position[name] for name in drop],
+                                   None if pars is None else pars.split(','))
+    except (KeyError, ValueError) as err:
+        raise click.UsageError(str(err))
+    click.echo(reweight.to_text(result))
+    if not result.reliable:
+        sys.exit(1)
+
+
+@cli.command(name='compare')
+@click.argument('fits', nargs=-1, required=True)
+@click.option('--data',
+              help='The data file of the FITS, to score them with the marginal predictive, the true values of each '
+                   'SN integrated out against the population, instead of their log_lik. Needs draws of x1c_star and '
+                   'x1c_pop_cov_mat, e.g. --pars loo, and works for any model.')
+@click.option('--mu-table',
+              help='The --mu-table the FITS were run with, for --data.')
+def compare_fits(fits, data, mu_table):
+    """Rank FITS, *_fitparams directories of the same SNe, by PSIS-LOO.
+
+    Each fit needs log_lik draws, e.g. --model stan_code_marginal.txt --pars loo,
+    of the same kind: the marginal log_lik of stan_code_marginal.txt, or the
+    log_lik conditional on the true values of stan_code_fast.txt, which gives
+    most SNe a high k-hat. Use --data to score every fit with the marginal
+    predictive instead. The table has the expected log predictive density, its
+    difference from the best fit with standard errors, and how many SNe have
+    an unreliable, high k-hat.
+    """
+    results, sn_names, infos, high_k = {}, {}, {}, {}
+    try:
+        stan_data = None if data is None else unity.prepare_data(
+            unity.read_data(CWD/data), mu_table=None if mu_table is None else CWD/mu_table)
+        for fit in fits:
+            draws = load_draws(CWD/fit)
+            results[fit] = loo.loo(draws, stan_data=stan_data)
+            sn_names[fit] = draws.sn_names() if isinstance(draws, Draws) else None
+            infos[fit] = draws.log_lik_info() if isinstance(draws, Draws) else None
+            if stan_data is not None and infos[fit] is not None:
+                if infos[fit]['observations'] != loo.observations_hash(stan_data):
+                    raise ValueError(f'{data} is not the data of {fit}, its observations differ.')
+                infos[fit] = dict(infos[fit], source='population', kind='marginal')
+            high_k[fit] = loo.n_high_k(results[fit], len(draws['coeff']))
+        rows = loo.compare(results, sn_names, infos)
+    except (KeyError, OSError, ValueError) as err:
+        raise click.UsageError(str(err))
+    click.echo(loo.to_text(rows, high_k))
 
 
 @cli.command()
@@ -85,7 +542,7 @@ def plot(data, params, axlimits, kde):
     # passing no variadic argument passes an empty tuple. 
     if not data:
         latest = ('', 0)
-        for output in Path('.').glob('*_fitparams.gzip.pkl'):
+        for output in list(Path('.').glob('*_fitparams')) + list(Path('.').glob('*_fitparams.gzip.pkl')):
             if output.stat().st_mtime > latest[1]:
                 latest = (output, output.stat().st_mtime)
         data = (str(latest[0]),)
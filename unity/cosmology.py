@@ -0,0 +1,67 @@
+""" cosmology.py - The distance modulus of each SN, computed once before sampling.
+
+The Stan models take `model_mu` as data. By default it is the polynomial
+approximation UNITY has always used. A table of distance moduli can be given
+instead, e.g. a high-accuracy grid for another cosmology, and is interpolated
+in `z_CMB`.
+"""
+from pathlib import Path
+
+import numpy as np
+
+
+def distance_modulus(z_helio, z_CMB) -> np.ndarray:
+    """The polynomial distance modulus previously computed inside the Stan models.
+
+    Parameters:
+        z_helio (array-like):
+            Heliocentric redshifts.
+
+        z_CMB (array-like):
+            CMB frame redshifts.
+    """
+    z_helio = np.asarray(z_helio, dtype=float)
+    z = np.asarray(z_CMB, dtype=float)
+    return 5*np.log10((1 + z_helio)*(1.00038*z - 0.227753*z**2 - 0.0440361*z**3 + 0.0619502*z**4
+                                     - 0.0220087*z**5 + 0.00289242*z**6)) + 43.1586133146
+
+
+def read_mu_table(file_name: Path) -> (np.ndarray, np.ndarray):
+    """Read a two column text file of redshift and distance modulus.
+
+    The distance modulus is for a SN with z_helio equal to z_CMB. The
+    redshifts must be increasing.
+    """
+    z, mu = np.loadtxt(file_name, unpack=True, usecols=(0, 1))
+    if np.any(np.diff(z) <= 0):
+        raise ValueError(f'The redshifts in {file_name} must be increasing.')
+    return z, mu
+
+
+def interpolate_mu(z_helio, z_CMB, table) -> np.ndarray:
+    """The distance modulus from a table, see `read_mu_table`.
+
+    The luminosity distance scales with (1 + z_helio), not (1 + z_CMB), so
+    the table value is corrected by 5 log10((1 + z_helio)/(1 + z_CMB)).
+    """
+    z, mu = table
+    z_helio = np.asarray(z_helio, dtype=float)
+    z_CMB = np.asarray(z_CMB, dtype=float)
+    if z_CMB.min() < z[0] or z_CMB.max() > z[-1]:
+        raise ValueError(f'The SN redshifts, {z_CMB.min()} to {z_CMB.max()}, are outside of the '
+                         f'distance table, {z[0]} to {z[-1]}.')
+    return np.interp(z_CMB, z, mu) + 5*np.log10((1 + z_helio)/(1 + z_CMB))
+
+
+def model_mu(stan_data: dict, mu_table: Path = None) -> np.ndarray:
+    """The `model_mu` data of a fit.
+
+    In order of priority: interpolated from `mu_table`, `model_mu` already in
+    `stan_data`, then `distance_modulus`. An explicit table replaces the
+    `model_mu` of the data.
+    """
+    if mu_table is not None:
+        return interpolate_mu(stan_data['z_helio'], stan_data['z_CMB'], read_mu_table(mu_table))
+    if 'model_mu' in stan_data:
+        return np.asarray(stan_data['model_mu'], dtype=float)
+    return distance_modulus(stan_data['z_helio'], stan_data['z_CMB'])
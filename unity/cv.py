@@ -0,0 +1,226 @@
+""" cv.py - Cross-validation and jackknife folds of one dataset.
+
+`unity cv` fits every fold of a dataset at once, in one pool of workers with
+one compiled model, see `unity.cross_validate`. The folds are made here, in
+memory, instead of with cut scripts such as `rdr2019/cut_JLA.py`:
+
+* `kfold`, K folds of random SNe, stratified by sample (`sn_set_inds`) so
+  every sample is in every training set,
+* `by_sample`, leave one sample (survey) out, a jackknife over samples.
+
+The properties in `recenter`, e.g. host mass, are shifted by their mean over
+the training SNe of each fold, as `cut_JLA.py` does for the SNe it keeps. The
+held-out SNe get the same shift.
+
+A held-out SN is scored by its log predictive density under the training
+fit, with its true values integrated out against the population of its
+sample, as in `stan_code_marginal.txt` (see `likelihood.marginal_terms`).
+This needs `do_fullDint = 0` and no skew of the population
+(`allow_alpha_S_N = 0`), and SNe with age mixtures can not be scored, see
+`likelihood.marginal_unsupported`. Otherwise no fold is scored, only the
+jackknife is given. The SNe of a left out sample can not be scored either,
+their sample has no MB, so `by_sample` folds only give the jackknife of the
+parameters shared by every sample.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy import special
+
+from . import dataset, likelihood
+
+# The default number of folds.
+K = 5
+
+# The outputs a fold saves as draws, what `held_out` and `jackknife` need.
+PARS = ['MB', 'coeff_angles', 'sigma_int', 'outl_frac', 'coeff', 'x1c_star', 'x1c_pop_cov_mat']
+
+# The parameters shared by every sample, see `jackknife`.
+SHARED_PARS = ('coeff',)
+
+# How many draws are scored at once.
+BLOCK_SIZE = 256
+
+# `name`, e.g. `fold1`, the data of its `train`ing fit, and of its `test` SNe,
+# with `sn_set_inds` numbered as in `train`, or None if they can not be scored.
+# `index` is the held-out SNe, as indices into the full dataset.
+Fold = namedtuple('Fold', 'name index train test')
+
+
+def kfold(sn_set_inds, k: int = K, seed: int = None) -> list:
+    """The held-out SNe of each of `k` folds, every SN in one, as indices.
+
+    The SNe of each sample are shared out among the folds in a random order.
+
+    Raises:
+        ValueError: if a sample has fewer than `k` SNe, so a fold would leave it out.
+    """
+    sn_set_inds = np.asarray(sn_set_inds)
+    samples, counts = np.unique(sn_set_inds, return_counts=True)
+    if k < 2:
+        raise ValueError('cross-validation needs at least 2 folds.')
+    if counts.min() < k:
+        raise ValueError(f'sample {samples[counts.argmin()]} has {counts.min()} SNe, too few for {k} folds.')
+    rng = np.random.RandomState(seed)
+    fold = np.empty(len(sn_set_inds), dtype=int)
+    # Carry on where the last sample stopped, so the folds differ in size by one at most.
+    start = 0
+    for sample in samples:
+        members = rng.permutation(np.flatnonzero(sn_set_inds == sample))
+        fold[members] = (start + np.arange(len(members))) % k
+        start += len(members)
+    return [np.flatnonzero(fold == i) for i in range(k)]
+
+
+def by_sample(sn_set_inds) -> list:
+    """The held-out SNe of each leave-one-sample-out fold, as indices.
+
+    Raises:
+        ValueError: for a single sample.
+    """
+    sn_set_inds = np.asarray(sn_set_inds)
+    samples = np.unique(sn_set_inds)
+    if len(samples) < 2:
+        raise ValueError('the dataset has one sample (n_sn_set = 1), there is none to leave out.')
+    return [np.flatnonzero(sn_set_inds == sample) for sample in samples]
+
+
+def _recentered(data: dict, columns, train: np.ndarray) -> dict:
+    """`data` with the `obs_mBx1c` `columns` shifted by their mean over the SNe `train`."""
+    columns = list(columns)
+    if not columns:
+        return data
+    obs = np.array(data['obs_mBx1c'], dtype=float)
+    obs[:, columns] -= obs[train][:, columns].mean(axis=0)
+    return dict(data, obs_mBx1c=obs)
+
+
+def split(stan_data: dict, held_out, name: str, recenter=()) -> Fold:
+    """One fold of `stan_data`.
+
+    Parameters:
+        stan_data (dict):
+            The data of the full dataset, see `unity.prepare_data`.
+
+        held_out (array-like):
+            Indices of the SNe left out.
+
+        name (str):
+            Of the fold, e.g. `fold1`.
+
+        recenter (list of int):
+            Columns of `obs_mBx1c` to shift by their training mean, e.g. host mass.
+
+    Returns:
+        (Fold):
+            The training data has `sn_set_inds` and `n_sn_set` renumbered if
+            a sample is left out entirely. The test data is None if it can
+            not be scored, see the module docstring.
+
+    Raises:
+        ValueError: if a `recenter` column is not a Gaussian property.
+    """
+    n_gaus = stan_data['obs_mBx1c'].shape[1]
+    bad = [column for column in recenter if not 0 <= column < n_gaus]
+    if bad:
+        raise ValueError(f"recenter columns {', '.join(map(str, bad))} are not columns of obs_mBx1c "
+                         f'(0 to {n_gaus - 1}).')
+    held_out = np.sort(np.asarray(held_out, dtype=int))
+    train_index = np.setdiff1d(np.arange(stan_data['n_sne']), held_out)
+    data = _recentered(stan_data, recenter, train_index)
+    train, test = dataset.subset(data, train_index), dataset.subset(data, held_out)
+    samples = np.unique(train['sn_set_inds'])
+    if len(samples) < stan_data['n_sn_set']:
+        train['sn_set_inds'] = np.searchsorted(samples, train['sn_set_inds'])
+        train['n_sn_set'] = len(samples)
+    if np.isin(test['sn_set_inds'], samples).all() and not likelihood.marginal_unsupported(stan_data):
+        test['sn_set_inds'] = np.searchsorted(samples, test['sn_set_inds'])
+    else:
+        test = None
+    return Fold(name, held_out, train, test)
+
+
+def held_out(draws, test: dict, block_size: int = BLOCK_SIZE) -> np.ndarray:
+    """The log predictive density of each test SN under a training fit, see the module docstring.
+
+    Parameters:
+        draws (draws.Draws or dict):
+            The training fit, with draws of `PARS`.
+
+        test (dict):
+            The held-out SNe, see `split`.
+
+        block_size (int):
+            How many draws are scored at once.
+
+    Returns:
+        (numpy.ndarray):
+            Shape (n_test,).
+    """
+    n_draws = len(draws['coeff'])
+    sn_set_inds = np.asarray(test['sn_set_inds'])
+    blocks = []
+    for start in range(0, n_draws, block_size):
+        block = {key: np.asarray(draws[key][start:start + block_size], dtype=float)
+                 for key in ('coeff', 'MB', 'x1c_star', 'x1c_pop_cov_mat', 'sigma_int', 'outl_frac')}
+        terms = likelihood.marginal_terms(np.asarray(test['obs_mBx1c']), np.asarray(test['obs_mBx1c_cov']),
+                                          block['coeff'], block['MB'], np.asarray(test['model_mu']),
+                                          block['x1c_star'], block['x1c_pop_cov_mat'], block['sigma_int'],
+                                          block['outl_frac'], sn_set_inds)
+        blocks.append(special.logsumexp(np.logaddexp(*terms), axis=0))
+    return special.logsumexp(blocks, axis=0) - np.log(n_draws)
+
+
+def jackknife(means: np.ndarray) -> (np.ndarray, np.ndarray):
+    """The mean and the grouped jackknife standard error of per-fold estimates, shape (folds, ...)."""
+    means = np.asarray(means, dtype=float)
+    k = len(means)
+    return means.mean(axis=0), np.sqrt((k - 1)/k*((means - means.mean(axis=0))**2).sum(axis=0))
+
+
+# Per fold its posterior means of `SHARED_PARS`, and the log predictive density
+# of each held-out SN, or None; overall the `elpd` of the SNe scored, its `se`
+# and the jackknife mean and `jackknife_se` of the shared parameters.
+Result = namedtuple('Result', 'folds means scores elpd se jackknife_mean jackknife_se')
+
+
+def score(folds: list, fold_draws: list) -> Result:
+    """The held-out scores of fitted `folds` and the jackknife of `SHARED_PARS`.
+
+    Parameters:
+        folds (list of Fold):
+            See `split`.
+
+        fold_draws (list of draws.Draws):
+            The training fit of each fold.
+    """
+    means, scores = [], []
+    for fold, draws in zip(folds, fold_draws):
+        means.append({key: np.asarray(draws[key], dtype=float).mean(axis=0)
+                      for key in SHARED_PARS if key in draws})
+        scores.append(None if fold.test is None else held_out(draws, fold.test))
+    scored = [s for s in scores if s is not None]
+    pointwise = np.concatenate(scored) if scored else np.zeros(0)
+    elpd = float(pointwise.sum()) if scored else None
+    se = float(np.sqrt(len(pointwise)*np.var(pointwise))) if scored else None
+    shared = [key for key in SHARED_PARS if all(key in m for m in means)]
+    estimates = {key: jackknife([m[key] for m in means]) for key in shared}
+    return Result([fold.name for fold in folds], means, scores, elpd, se,
+                  {key: value[0] for key, value in estimates.items()},
+                  {key: value[1] for key, value in estimates.items()})
+
+
+def to_text(result: Result, folds: list) -> str:
+    """A fixed width table of each fold, then the totals."""
+    lines = [f"{'fold':<12}{'n_train':>8}{'n_test':>8}{'elpd':>10}  " + '  '.join(SHARED_PARS)]
+    for fold, means, scores in zip(folds, result.means, result.scores):
+        elpd = f"{'-':>10}" if scores is None else f'{scores.sum():>10.2f}'
+        shared = '  '.join(' '.join(f'{x:.3f}' for x in np.ravel(means[key])) for key in SHARED_PARS if key in means)
+        lines.append(f"{fold.name:<12}{fold.train['n_sne']:>8}{len(fold.index):>8}{elpd}  {shared}")
+    if result.elpd is not None:
+        n_scored = sum(len(s) for s in result.scores if s is not None)
+        lines.append(f'Held-out elpd {result.elpd:.2f} +- {result.se:.2f} over {n_scored} SNe.')
+    for key, mean in result.jackknife_mean.items():
+        pairs = zip(np.ravel(mean), np.ravel(result.jackknife_se[key]))
+        lines.append(f'Jackknife {key}: ' + ', '.join(f'{m:.3f} +- {s:.3f}' for m, s in pairs))
+    return '\n'.join(lines)
@@ -0,0 +1,204 @@
+""" dataset.py - A versioned, memory-mappable UNITY dataset.
+
+A dataset is a directory, `{name}.unity/`, with one `{key}.npy` per array
+input, e.g. `obs_mBx1c_cov.npy`, and `meta.json` with the format version, the
+scalar inputs, such as `n_sne`, and a SHA-256 hash of the content. Each array
+can be memory-mapped by itself, and reading never unpickles anything, unlike
+the `dict` pickles UNITY has used so far. `convert` turns such a pickle into a
+dataset.
+
+A `Dataset` reads like the `dict` of a pickle, so it can be passed to
+`unity.prepare_data` or `validate.validate` as it is.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+FORMAT = 'unity-dataset'
+VERSION = 1
+SUFFIX = '.unity'
+
+# The inputs with one entry per SN, and the axis of the SNe, see `subset`.
+SN_AXIS = {'names': 0, 'sn_set_inds': 0, 'z_helio': 0, 'z_CMB': 0, 'model_mu': 0, 'obs_mBx1c': 0,
+           'obs_mBx1c_cov': 0, 'age_gaus_mean': 1, 'age_gaus_std': 1, 'age_gaus_A': 1}
+
+
+def _as_array(key: str, value) -> np.ndarray:
+    """`value` as an array that can be saved without pickle."""
+    array = np.asarray(value)
+    if array.dtype == object:
+        # e.g. the SN names, an object array of str.
+        if not all(isinstance(x, str) for x in array.flat):
+            raise ValueError(f'{key} can not be saved, it is neither numbers nor strings.')
+        array = array.astype(str)
+    if array.dtype.kind not in 'biufU':
+        raise ValueError(f'{key} can not be saved, it has dtype {array.dtype}.')
+    # Scalars as the Python types they are saved as in `meta.json`, so they hash the same when read back.
+    return np.ascontiguousarray(array) if array.ndim else np.asarray(array.item())
+
+
+def content_hash(data: Mapping) -> str:
+    """A SHA-256 hash of the keys, types, shapes and values of a dataset.
+
+    The same data gives the same hash, whether as a `Dataset` or a `dict`.
+    """
+    sha = hashlib.sha256()
+    for key in sorted(data):
+        array = _as_array(key, data[key])
+        sha.update(json.dumps([key, array.dtype.str, array.shape]).encode('utf8'))
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+
+def save_dataset(path, data: Mapping) -> Path:
+    """Save `data`, the inputs of a fit, as a dataset.
+
+    Parameters:
+        path (pathlib.Path):
+            The dataset directory, e.g. `data.unity`. An existing dataset
+            there is replaced.
+
+        data (dict):
+            Input name to a number, string or array-like, e.g. the `dict` of a pickle.
+
+    Returns:
+        (pathlib.Path):
+            The dataset directory.
+    """
+    path = Path(path)
+    arrays = {key: _as_array(key, value) for key, value in data.items()}
+    meta = {'format': FORMAT, 'version': VERSION, 'hash': content_hash(arrays),
+            'scalars': {key: value.item() for key, value in arrays.items() if value.ndim == 0},
+            'arrays': {key: {'shape': list(value.shape), 'dtype': value.dtype.str}
+                       for key, value in arrays.items() if value.ndim}}
+
+    # Write to a temporary directory then rename, so a dataset is never half written.
+    tmp = path.with_name(path.name + '.tmp')
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+    for key in meta['arrays']:
+        np.save(tmp/f'{key}.npy', arrays[key], allow_pickle=False)
+    with open(tmp/'meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return path
+
+
+class Dataset(Mapping):
+    """Read-only, dict-like access to a dataset.
+
+    `dataset['obs_mBx1c_cov']` memory-maps only `obs_mBx1c_cov.npy`, the
+    scalars are read from `meta.json`.
+
+    Parameters:
+        path (pathlib.Path):
+            The dataset directory.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path/'meta.json') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT:
+            raise ValueError(f'{self.path} is not a UNITY dataset.')
+        if self.meta['version'] > VERSION:
+            raise ValueError(f"{self.path} is a version {self.meta['version']} dataset, "
+                             f'this UNITY reads up to version {VERSION}.')
+
+    def __getitem__(self, key):
+        if key in self.meta['scalars']:
+            return self.meta['scalars'][key]
+        if key not in self.meta['arrays']:
+            raise KeyError(key)
+        return np.load(self.path/f'{key}.npy', mmap_mode='r', allow_pickle=False)
+
+    def __iter__(self):
+        return iter(list(self.meta['scalars']) + list(self.meta['arrays']))
+
+    def __len__(self):
+        return len(self.meta['scalars']) + len(self.meta['arrays'])
+
+    @property
+    def content_hash(self) -> str:
+        """The hash saved with the dataset, see `content_hash`."""
+        return self.meta['hash']
+
+    def verify(self) -> bool:
+        """Whether the content still matches the saved hash."""
+        return content_hash(self) == self.content_hash
+
+
+def subset(data: Mapping, index) -> dict:
+    """The inputs for some of the SNe.
+
+    Only the selected rows of a `Dataset` are read.
+
+    Parameters:
+        data (Dataset or dict):
+            The inputs of a fit.
+
+        index (array-like):
+            The SNe to keep, as indices or a boolean mask of length `n_sne`.
+
+    Returns:
+        (dict):
+            The inputs, with `n_sne` updated.
+    """
+    index = np.asarray(index)
+    if index.dtype == bool:
+        index = np.flatnonzero(index)
+    out = {}
+    for key in data:
+        value = data[key]
+        if key in SN_AXIS:
+            value = np.take(value, index, axis=SN_AXIS[key])
+        out[key] = value
+    out['n_sne'] = len(index)
+    return out
+
+
+def load_dataset(path):
+    """Open the inputs of a fit.
+
+    Parameters:
+        path (pathlib.Path or str):
+            Either a dataset directory or a legacy pickle of a `dict`.
+            Only open pickles you trust, reading one can run any code.
+
+    Returns:
+        (Dataset or dict):
+            Input name to a number or an array.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return Dataset(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def convert(path, output=None) -> Path:
+    """Convert a legacy pickle to a dataset.
+
+    Parameters:
+        path (pathlib.Path):
+            The pickle file.
+
+        output (pathlib.Path):
+            The dataset directory, by default `{path}` with a `.unity` suffix.
+
+    Returns:
+        (pathlib.Path):
+            The dataset directory.
+    """
+    path = Path(path)
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    return save_dataset(output or path.with_suffix(SUFFIX), data)
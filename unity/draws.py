@@ -0,0 +1,295 @@
+""" draws.py - A columnar, chunked on-disk store for the posterior draws.
+
+A fit is saved as a directory, `{data_name}_fitparams/`. While the chains are
+running, each chain appends chunks of draws as they are sampled,
+
+    {data_name}_fitparams/chain{chain_id}/{param}.{chunk:05d}.npy
+
+Once every chain is done `merge` combines the chunks into one array per Stan
+parameter, `{param}.npy` of shape (chains*draws, *dims), and writes `meta.json`.
+Each array can then be memory-mapped by itself, so reading `MB` does not
+require reading `outl_loglike`.
+
+Parameters kept only as streamed summaries (see `online.py`) are saved as
+`summaries/{param}.npz` instead. Fits with `outl_loglike` also get
+`outlier_table.npy`, one row of outlier statistics per SN (see
+`online.outlier_table`). The sampler's performance statistics are saved as
+`telemetry.json` (see `telemetry.py`).
+
+For `unity update` (see `incremental.py`) a store also keeps the names of
+the SNe it was fit to, `sn_names.npy`, and the end state of each chain, its
+last draw, step size and inverse metric, `sampler_state.pkl`. For `unity
+compare` (see `loo.py`) it records what its `log_lik` is, `log_lik.json`.
+"""
+import gzip
+import json
+import os
+import pickle
+import shutil
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+from . import online
+
+FORMAT = 'unity-draws'
+VERSION = 1
+OUTLIER_TABLE = 'outlier_table.npy'
+TELEMETRY = 'telemetry.json'
+SN_NAMES = 'sn_names.npy'
+SAMPLER_STATE = 'sampler_state.pkl'
+LOG_LIK_INFO = 'log_lik.json'
+
+
+class DrawWriter():
+    """Appends chunks of draws for one chain.
+
+    Parameters:
+        path (pathlib.Path):
+            The store directory.
+
+        chain_id (int):
+            The Stan `chain_id`, starting at 1.
+    """
+    def __init__(self, path, chain_id):
+        self.path = Path(path)/f'chain{chain_id}'
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Continue the numbering of any chunks already on disk.
+        params = _chunk_params(self.path)
+        self.n_chunks = len(_chunk_files(self.path, params[0])) if params else 0
+
+    def append(self, draws: dict):
+        """Write one chunk, a dict of parameter name to an array of shape (draws, *dims)."""
+        for key, value in draws.items():
+            # write-then-rename so a killed process never leaves half a chunk.
+            chunk_file = self.path/f'{key}.{self.n_chunks:05d}.npy'
+            with open(chunk_file.with_suffix('.tmp'), 'wb') as f:
+                np.save(f, np.ascontiguousarray(value))
+            os.replace(chunk_file.with_suffix('.tmp'), chunk_file)
+        self.n_chunks += 1
+
+    def truncate(self, n_chunks: int):
+        """Delete every chunk after the first `n_chunks`, e.g. ones newer than a checkpoint."""
+        for chunk_file in self.path.glob('*.npy'):
+            if int(chunk_file.name.split('.')[1]) >= n_chunks:
+                chunk_file.unlink()
+        self.n_chunks = min(self.n_chunks, n_chunks)
+
+
+def _chunk_params(chain_dir: Path) -> list:
+    return sorted({f.name.split('.')[0] for f in chain_dir.glob('*.npy')})
+
+
+def _chunk_files(chain_dir: Path, key: str) -> list:
+    return sorted(chain_dir.glob(f'{key}.*.npy'))
+
+
+def _chain_dirs(path: Path) -> list:
+    return sorted(path.glob('chain*'), key=lambda chain_dir: int(chain_dir.name[5:]))
+
+
+def merge(path, seeds: dict = None):
+    """Combine the per-chain chunks of a store into one array per parameter.
+
+    The arrays are filled chunk by chunk through a memory map, so this never
+    holds more than one chunk in memory.
+
+    Parameters:
+        path (pathlib.Path):
+            The store directory.
+
+        seeds (dict):
+            The seeds the fit was sampled with, saved in `meta.json`.
+    """
+    path = Path(path)
+    chain_dirs = _chain_dirs(path)
+    if not chain_dirs:
+        raise FileNotFoundError(f'No chain chunks found in {path}.')
+    params = _chunk_params(chain_dirs[0])
+
+    draws_per_chain = [sum(np.load(f, mmap_mode='r').shape[0] for f in _chunk_files(chain_dir, params[0]))
+                       for chain_dir in chain_dirs]
+    meta = {'format': FORMAT, 'version': VERSION,
+            'draws_per_chain': draws_per_chain, 'params': {},
+            'summaries': sorted(f.stem for f in (path/'summaries').glob('*.npz')), 'seeds': seeds}
+
+    for key in params:
+        chunks = [f for chain_dir in chain_dirs for f in _chunk_files(chain_dir, key)]
+        first = np.load(chunks[0], mmap_mode='r')
+        merged = np.lib.format.open_memmap(path/f'{key}.npy', mode='w+', dtype=first.dtype,
+                                           shape=(sum(draws_per_chain),) + first.shape[1:])
+        start = 0
+        for chunk_file in chunks:
+            chunk = np.load(chunk_file, mmap_mode='r')
+            merged[start:start + chunk.shape[0]] = chunk
+            start += chunk.shape[0]
+        merged.flush()
+        del merged
+        meta['params'][key] = {'shape': list(first.shape[1:]), 'dtype': first.dtype.str}
+
+    with open(path/'meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    for chain_dir in chain_dirs:
+        shutil.rmtree(chain_dir)
+
+
+def save_summary(path, key: str, summary: dict):
+    """Save the streamed summary of `key`, see `online.combine`, in the store at `path`."""
+    summary_dir = Path(path)/'summaries'
+    summary_dir.mkdir(parents=True, exist_ok=True)
+    np.savez(summary_dir/f'{key}.npz', **summary)
+
+
+def save_outlier_table(path, table: np.ndarray):
+    """Save the per-SN outlier statistics, see `online.outlier_table`, in the store at `path`."""
+    np.save(Path(path)/OUTLIER_TABLE, table)
+
+
+def save_telemetry(path, telemetry: dict):
+    """Save the sampler statistics, see `telemetry.report`, in the store at `path`."""
+    with open(Path(path)/TELEMETRY, 'w') as f:
+        json.dump(telemetry, f, indent=2)
+
+
+def save_sn_names(path, names):
+    """Save the names of the SNe of the fit in the store at `path`."""
+    np.save(Path(path)/SN_NAMES, np.asarray(names).astype(str))
+
+
+def save_sampler_state(path, states: list):
+    """Save the end state of each chain, a dict of `last_draw`, `stepsize` and `inv_metric`, in the store at `path`."""
+    with open(Path(path)/SAMPLER_STATE, 'wb') as f:
+        pickle.dump(states, f)
+
+
+def save_log_lik_info(path, info: dict):
+    """Save what the `log_lik` of the fit is, see `loo.log_lik_info`, in the store at `path`."""
+    with open(Path(path)/LOG_LIK_INFO, 'w') as f:
+        json.dump(info, f, indent=2)
+
+
+class Draws(Mapping):
+    """Read-only, dict-like access to a merged store.
+
+    `draws['MB']` memory-maps only `MB.npy`, shape (chains*draws, *dims), the
+    same layout as pystan's `fit.extract()`.
+
+    Parameters:
+        path (pathlib.Path):
+            The store directory.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path/'meta.json') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT:
+            raise ValueError(f'{self.path} is not a UNITY draw store.')
+
+    def __getitem__(self, key):
+        if key not in self.meta['params']:
+            raise KeyError(key)
+        return np.load(self.path/f'{key}.npy', mmap_mode='r')
+
+    def __iter__(self):
+        return iter(self.meta['params'])
+
+    def __len__(self):
+        return len(self.meta['params'])
+
+    @property
+    def draws_per_chain(self) -> list:
+        return self.meta['draws_per_chain']
+
+    @property
+    def seeds(self) -> dict:
+        """`seed`, the seed of the fit, and `chain_seeds`, that of each chain, or None if not recorded."""
+        return self.meta.get('seeds')
+
+    @property
+    def summaries(self) -> list:
+        """The parameters kept only as streamed summaries."""
+        return self.meta.get('summaries', [])
+
+    def summary(self, key) -> dict:
+        """The streamed summary of `key`, see `online.combine`."""
+        if key not in self.summaries:
+            raise KeyError(key)
+        with np.load(self.path/'summaries'/f'{key}.npz', allow_pickle=False) as f:
+            return dict(f)
+
+    def outlier_table(self) -> np.ndarray:
+        """The per-SN outlier statistics, see `online.outlier_table`."""
+        return np.load(self.path/OUTLIER_TABLE)
+
+    def telemetry(self) -> dict:
+        """The sampler statistics, see `telemetry.report`, or None for a fit saved without them."""
+        try:
+            with open(self.path/TELEMETRY) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def sn_names(self) -> np.ndarray:
+        """The names of the SNe of the fit, or None if it was saved without them."""
+        try:
+            return np.load(self.path/SN_NAMES)
+        except FileNotFoundError:
+            return None
+
+    def log_lik_info(self) -> dict:
+        """What the `log_lik` of the fit is, see `loo.log_lik_info`, or None if it was saved without it."""
+        try:
+            with open(self.path/LOG_LIK_INFO) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def sampler_state(self) -> list:
+        """The end state of each chain, see `save_sampler_state`, or None if it was saved without it."""
+        try:
+            with open(self.path/SAMPLER_STATE, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def by_chain(self, key) -> np.ndarray:
+        """The draws of `key` split by chain, shape (chains, draws, *dims).
+
+        Requires every chain to have the same number of draws.
+        """
+        lengths = set(self.draws_per_chain)
+        if len(lengths) != 1:
+            raise ValueError('Chains have different numbers of draws.')
+        value = self[key]
+        return value.reshape((len(self.draws_per_chain), lengths.pop()) + value.shape[1:])
+
+
+def load_draws(path):
+    """Open the output of a UNITY fit.
+
+    Parameters:
+        path (pathlib.Path or str):
+            Either a draw store directory or a legacy `*_fitparams.gzip.pkl`.
+
+    Returns:
+        (Draws or dict):
+            Parameter name to an array of shape (draws, *dims).
+    """
+    path = Path(path)
+    if path.is_dir():
+        return Draws(path)
+    with gzip.open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_outlier_table(path) -> np.ndarray:
+    """The per-SN outlier statistics of a fit, see `online.outlier_table`.
+
+    A legacy `*_fitparams.gzip.pkl` has no saved table, so it is computed
+    from its `outl_loglike` draws.
+    """
+    draws = load_draws(path)
+    if isinstance(draws, Draws):
+        return draws.outlier_table()
+    return online.outlier_table(online.summarize(draws['outl_loglike']))
@@ -0,0 +1,202 @@
+""" incremental.py - Update a fit when SNe are added to its dataset.
+
+Refitting a compilation from scratch every time a few SNe are added spends
+most of its time in warmup, finding the typical set and adapting the metric
+all over again. `unity update` starts each chain where a chain of the previous
+fit ended instead:
+
+* the hyperparameters, and the latents (`true_x1cs`) of the SNe both fits
+  share, from the chain's last draw,
+* the latents of the added SNe drawn from the population model of that draw,
+* warmup adapting from the chain's step size and inverse metric, the added
+  SNe getting the median metric of the others, so a short warmup (`WARMUP`)
+  is enough.
+
+The SNe are matched by name, so the new dataset must have every SN of the
+previous one, in any order. The end state and the SN names of a fit are saved
+with its draws, see `draws.py`.
+
+This only holds while the added SNe barely move the posterior. `shifts`
+measures how far the hyperparameters moved, and past `MAX_SHIFT` previous
+posterior standard deviations the fit should be redone with `unity run`.
+"""
+import numpy as np
+
+from . import sampler, summary
+
+# Parameters with one entry per SN, along their first axis.
+PER_SN_PARS = ('true_x1cs',)
+
+# The warmup of an update, Stan's shortest full adaptation schedule (75 + 25 + 50).
+WARMUP = 150
+
+# How far, in previous posterior standard deviations, a hyperparameter may move before a refit is needed.
+MAX_SHIFT = 0.5
+
+
+def match_names(previous: np.ndarray, names: np.ndarray) -> np.ndarray:
+    """For each SN of `names`, the index of the same SN in `previous`, or -1 for an added one.
+
+    Raises:
+        ValueError: if a name repeats, or an SN of `previous` is missing from `names`.
+    """
+    previous, names = np.asarray(previous).astype(str), np.asarray(names).astype(str)
+    for label, values in (('previous fit', previous), ('new dataset', names)):
+        unique, counts = np.unique(values, return_counts=True)
+        if np.any(counts > 1):
+            raise ValueError(f"the {label} has repeated SN names, e.g. {', '.join(unique[counts > 1][:5])}.")
+    missing = np.setdiff1d(previous, names)
+    if missing.size:
+        raise ValueError(f'{missing.size} SNe of the previous fit are not in the new dataset, e.g. '
+                         f"{', '.join(missing[:5])}. Use unity run for a different sample.")
+    position = {name: i for i, name in enumerate(previous)}
+    return np.array([position.get(name, -1) for name in names], dtype=int)
+
+
+def population_draw(last_draw: dict, sn_set_inds: np.ndarray, rng: np.random.RandomState) -> np.ndarray:
+    """`true_x1cs` of SNe in samples `sn_set_inds`, from the population of a draw, ignoring any skew."""
+    x1c_star = np.asarray(last_draw['x1c_star'], dtype=float)
+    # diag_pre_multiply(R_x1c, x1c_Lmat), as in the Stan models.
+    chol = 10**np.asarray(last_draw['log10_R_x1c'], dtype=float)[:, :, None]*np.asarray(last_draw['x1c_Lmat'])
+    z = rng.randn(len(sn_set_inds), x1c_star.shape[1])
+    return x1c_star[sn_set_inds] + np.einsum('nij,nj->ni', chol[sn_set_inds], z)
+
+
+def start_point(last_draw: dict, index: np.ndarray, sn_set_inds: np.ndarray, rng: np.random.RandomState) -> dict:
+    """A chain's last draw, with the per-SN parameters of the SNe in `index` (see `match_names`)."""
+    init = dict(last_draw)
+    added = index < 0
+    for key in PER_SN_PARS:
+        if key not in last_draw:
+            continue
+        old = np.asarray(last_draw[key])
+        value = np.zeros((len(index),) + old.shape[1:])
+        value[~added] = old[index[~added]]
+        if added.any():
+            value[added] = population_draw(last_draw, sn_set_inds[added], rng)
+        init[key] = value
+    return init
+
+
+def _unconstrained_size(kind: str, shape: tuple):
+    """The number of unconstrained values of a parameter, None for a type this does not know."""
+    if kind in ('real', 'vector', 'row_vector', 'matrix', 'unit_vector', 'ordered', 'positive_ordered'):
+        return int(np.prod(shape, dtype=int))
+    if kind == 'simplex':
+        return int(np.prod(shape[:-1], dtype=int))*(shape[-1] - 1)
+    if kind in ('cholesky_factor_corr', 'corr_matrix'):
+        return int(np.prod(shape[:-2], dtype=int))*shape[-1]*(shape[-1] - 1)//2
+    if kind == 'cov_matrix':
+        return int(np.prod(shape[:-2], dtype=int))*shape[-1]*(shape[-1] + 1)//2
+    return None
+
+
+def inv_metric(last_draw: dict, inv_metric: np.ndarray, model_code: str, index: np.ndarray) -> np.ndarray:
+    """A diagonal inverse metric of a chain, for the SNe in `index` (see `match_names`).
+
+    The unconstrained values are in the order of the parameters block, and
+    those of an array parameter are in the order of its first axis. The added
+    SNe get the median of the other SNe.
+
+    Returns:
+        (numpy.ndarray):
+            The new inverse metric, or None if it can not be mapped, e.g. a
+            dense metric, for warmup to adapt from Stan's default.
+    """
+    inv_metric = np.asarray(inv_metric, dtype=float)
+    if inv_metric.ndim != 1:
+        return None
+    declarations = sampler._declarations(sampler._strip_comments(model_code), 'parameters')
+    sizes = [_unconstrained_size(kind, np.shape(last_draw[key])) if key in last_draw else None
+             for kind, _, key in declarations]
+    if None in sizes or sum(sizes) != inv_metric.size:
+        return None
+    blocks = np.split(inv_metric, np.cumsum(sizes)[:-1])
+    for i, (_, _, key) in enumerate(declarations):
+        if key in PER_SN_PARS:
+            rows = blocks[i].reshape((np.shape(last_draw[key])[0], -1))
+            new = np.tile(np.median(rows, axis=0), (len(index), 1))
+            new[index >= 0] = rows[index[index >= 0]]
+            blocks[i] = new.ravel()
+    return np.concatenate(blocks)
+
+
+def start(previous, names, model_code: str, stan_data: dict, chains: int, seed: int = None) -> (list, list):
+    """Where each chain of an update starts, for `sampler.run_chains`.
+
+    Parameters:
+        previous (draws.Draws):
+            The previous fit. With more chains than it had, its chains' end
+            states are used in turn.
+
+        names (numpy.ndarray):
+            The SN names of the new dataset.
+
+        model_code (str):
+            The Stan program of the update, the same as that of the previous fit.
+
+        stan_data (dict):
+            The new data, see `unity.prepare_data`.
+
+        chains (int):
+            The number of chains.
+
+        seed (int):
+            Seed of the population draws of the added SNe.
+
+    Returns:
+        (tuple of list):
+            `init` and `adapt`, the start point and the step size and inverse
+            metric of each chain.
+
+    Raises:
+        ValueError: if the previous fit can not be updated with this data and model.
+    """
+    states, previous_names = previous.sampler_state(), previous.sn_names()
+    if states is None or previous_names is None:
+        raise ValueError(f'{previous.path} was saved without its SN names or sampler state, '
+                         'fit it again with unity run --rerun before updating it.')
+    if names is None:
+        raise ValueError('the new dataset has no SN names to match with the previous fit.')
+    param_names = sampler.parameter_names(model_code)
+    if set(param_names) != set(states[0]['last_draw']):
+        raise ValueError(f'{previous.path} was not fit with this model.')
+    if 'x1c_star' in param_names and len(states[0]['last_draw']['x1c_star']) != stan_data['n_sn_set']:
+        raise ValueError('the new dataset has a different number of samples (n_sn_set), use unity run.')
+    index = match_names(previous_names, names)
+    rng = np.random.RandomState(seed)
+    sn_set_inds = np.asarray(stan_data['sn_set_inds'])
+    init, adapt = [], []
+    for chain in range(chains):
+        state = states[chain % len(states)]
+        init.append(start_point(state['last_draw'], index, sn_set_inds, rng))
+        metric = inv_metric(state['last_draw'], state['inv_metric'], model_code, index)
+        adapt.append({'stepsize': state['stepsize']} if metric is None
+                     else {'stepsize': state['stepsize'], 'inv_metric': metric})
+    return init, adapt
+
+
+def shifts(previous, draws) -> dict:
+    """How far each hyperparameter moved, in standard deviations of the previous posterior.
+
+    Parameters:
+        previous, draws (draws.Draws):
+            The previous and the updated fit. The scalars both summarize by
+            default are compared, see `summary.summarize`.
+
+    Returns:
+        (dict):
+            Label, e.g. `MB[0]`, to |new mean - old mean|/old sd.
+    """
+    old, new = summary.summarize(previous), summary.summarize(draws)
+    mean, sd = old.columns.index('mean'), old.columns.index('sd')
+    old_rows = dict(zip(old.labels, old.values))
+    return {label: abs(row[mean] - old_rows[label][mean])/old_rows[label][sd]
+            for label, row in zip(new.labels, new.values)
+            if label in old_rows and old_rows[label][sd] > 0}
+
+
+def needs_refit(shifts: dict, max_shift: float = MAX_SHIFT) -> list:
+    """One message per hyperparameter that moved by more than `max_shift`, see `shifts`."""
+    return [f'{label} moved by {shift:.2f} previous posterior sd.'
+            for label, shift in sorted(shifts.items(), key=lambda item: -item[1]) if shift > max_shift]
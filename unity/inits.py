@@ -0,0 +1,169 @@
+""" inits.py - Where the chains of a fit start.
+
+By default Stan starts each chain at a random point, uniform in (-2, 2) on
+the unconstrained scale. With thousands of `true_x1cs` latents warmup then
+spends much of its time just finding the typical set. The other strategies
+start every chain near the posterior instead:
+
+* `map`, the posterior mode from Stan's optimizer (L-BFGS),
+* `advi`, the mean of a mean-field ADVI approximation,
+* the path of a previous fit's `*_fitparams`, its posterior means.
+
+Each chain gets its own jittered copy of the start point (see `jitter`), so
+the chains still start apart and R-hat stays meaningful. Parameters a start
+point does not have, such as the `true_x1cs` of a fit that did not save them,
+are left for Stan to initialize randomly.
+"""
+import re
+from pathlib import Path
+
+import numpy as np
+
+from . import draws as draw_store
+from . import sampler
+
+STRATEGIES = ('random', 'map', 'advi')
+
+# The default standard deviation of the jitter, on the unconstrained scale.
+JITTER = 0.1
+
+
+def _unflatten(names: list, values) -> dict:
+    """Values named as Stan writes them, `true_x1cs[1,2]`, as one array per parameter."""
+    indices = {}
+    for name, value in zip(names, values):
+        match = re.fullmatch(r'(\w+)(?:\[([\d,]+)\])?', name)
+        key, index = match.group(1), match.group(2)
+        indices.setdefault(key, []).append((tuple(int(i) - 1 for i in index.split(',')) if index else (), value))
+    arrays = {}
+    for key, entries in indices.items():
+        shape = tuple(np.max([index for index, _ in entries], axis=0) + 1) if entries[0][0] else ()
+        array = np.zeros(shape)
+        for index, value in entries:
+            array[index] = value
+        arrays[key] = array
+    return arrays
+
+
+def from_optimizer(sm, stan_data: dict, seed: int = None) -> dict:
+    """The posterior mode, from `sm.optimizing`."""
+    return {key: np.asarray(value) for key, value in sm.optimizing(data=stan_data, seed=seed).items()}
+
+
+def from_advi(sm, stan_data: dict, seed: int = None) -> dict:
+    """The mean of a mean-field ADVI approximation, from `sm.vb`."""
+    result = sm.vb(data=stan_data, seed=seed)
+    names = result.get('mean_par_names') or [name for name in result['sampler_param_names'] if name != 'lp__']
+    return _unflatten(names, result['mean_pars'])
+
+
+def from_fit(path) -> dict:
+    """The posterior means of a previous fit, its draws or streamed summaries."""
+    draws = draw_store.load_draws(path)
+    means = {key: np.asarray(draws[key], dtype=float).mean(axis=0) for key in draws}
+    for key in getattr(draws, 'summaries', []):
+        means.setdefault(key, draws.summary(key)['mean'])
+    return means
+
+
+def _unconstrain(value, lower, upper):
+    if lower is not None and upper is not None:
+        x = (value - lower)/(upper - lower)
+        return np.log(x) - np.log1p(-x)
+    if lower is not None:
+        return np.log(value - lower)
+    if upper is not None:
+        return np.log(upper - value)
+    return value
+
+
+def _constrain(x, lower, upper):
+    if lower is not None and upper is not None:
+        return lower + (upper - lower)/(1 + np.exp(-x))
+    if lower is not None:
+        return lower + np.exp(x)
+    if upper is not None:
+        return upper - np.exp(x)
+    return x
+
+
+def jitter(start: dict, bounds: dict, chains: int, scale: float = JITTER, seed: int = None) -> list:
+    """A copy of `start` for each chain, jittered on the unconstrained scale.
+
+    Parameters:
+        start (dict):
+            Parameter name to value, only those in `bounds` are jittered.
+
+        bounds (dict):
+            See `sampler.parameter_bounds`. Values on or past a bound are moved
+            just inside it.
+
+        chains (int):
+            The number of copies.
+
+        scale (float):
+            The standard deviation of the jitter, 0 for none.
+
+        seed (int):
+            Seed of the jitter.
+
+    Returns:
+        (list of dict):
+            One start point per chain.
+    """
+    rng = np.random.RandomState(seed)
+    inits = [dict(start) for _ in range(chains)]
+    for key, (lower, upper) in bounds.items():
+        if key not in start:
+            continue
+        value = np.asarray(start[key], dtype=float)
+        # Keep a value from an optimizer that sits on a bound inside it, so it can be unconstrained.
+        span = (upper - lower) if lower is not None and upper is not None else max(np.abs(value).max(initial=0), 1)
+        value = np.clip(value, -np.inf if lower is None else lower + 1e-6*span,
+                        np.inf if upper is None else upper - 1e-6*span)
+        x = _unconstrain(value, lower, upper)
+        for init in inits:
+            init[key] = _constrain(x + scale*rng.randn(*x.shape), lower, upper)
+    return inits
+
+
+def initial_values(init: str, sm, stan_data: dict, chains: int, seed: int = None, scale: float = JITTER) -> list:
+    """The start point of each chain, for `sampler.run_chains`.
+
+    Parameters:
+        init (str):
+            `random`, `map`, `advi` or the path of a previous fit, see the module docstring.
+
+        sm (pystan.StanModel):
+            The model to be fit.
+
+        stan_data (dict):
+            The data of the fit.
+
+        chains (int):
+            The number of chains.
+
+        seed (int):
+            Seed of the optimizer or ADVI and of the jitter.
+
+        scale (float):
+            See `jitter`.
+
+    Returns:
+        (list of dict or None):
+            One start point per chain, None for Stan's random inits.
+    """
+    if init == 'random':
+        return None
+    if init == 'map':
+        start = from_optimizer(sm, stan_data, seed)
+    elif init == 'advi':
+        start = from_advi(sm, stan_data, seed)
+    elif Path(init).exists():
+        start = from_fit(init)
+    else:
+        raise ValueError(f"init must be one of {', '.join(STRATEGIES)} or a previous fit, not {init}.")
+    # Only the parameters block, Stan ignores anything else.
+    names = sampler.parameter_names(sm.model_code)
+    start = {key: value for key, value in start.items() if key in names}
+    return jitter(start, sampler.parameter_bounds(sm.model_code), chains, scale, seed)
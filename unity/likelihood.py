@@ -0,0 +1,191 @@
+""" likelihood.py - The UNITY observation likelihood in numpy.
+
+This mirrors the `transformed parameters` block of `stan_code_fast.txt`, so the
+rank-1 (Sherman-Morrison) form of the likelihood can be checked against the
+direct one in `stan_code_simple.txt`. It works on many draws at once.
+`marginal_terms` does the same for `stan_code_marginal.txt`.
+
+With `do_fullDint = 0` the covariance of SN i is
+
+    C_i = obs_mBx1c_cov[i] + v e1 e1'
+
+with `v = sigma_int**2` for an inlier and `v = sigma_int**2 + 0.25` for an
+outlier. Only the inverse and log determinant of `obs_mBx1c_cov` are needed,
+and those do not change during the fit.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# The parts of the observational covariance that are fixed for a fit.
+ObsFactors = namedtuple('ObsFactors', 'prec logdet prec_11')
+
+
+def obs_factors(obs_mBx1c_cov: np.ndarray) -> ObsFactors:
+    """Precompute the inverse and log determinant of each observational covariance.
+
+    Parameters:
+        obs_mBx1c_cov (np.ndarray):
+            Shape (n_sne, n_gaus_props, n_gaus_props).
+    """
+    chol = np.linalg.cholesky(obs_mBx1c_cov)
+    logdet = 2*np.log(np.diagonal(chol, axis1=-2, axis2=-1)).sum(axis=-1)
+    prec = np.linalg.inv(obs_mBx1c_cov)
+    return ObsFactors(prec, logdet, prec[:, 0, 0])
+
+
+def residuals(obs_mBx1c, true_x1cs, coeff, MB, model_mu, sn_set_inds):
+    """The observed minus the modeled mB, x1, c, ... for each draw and SN.
+
+    Parameters:
+        obs_mBx1c (np.ndarray):
+            Shape (n_sne, n_gaus_props).
+
+        true_x1cs (np.ndarray):
+            Shape (draws, n_sne, n_props - 1).
+
+        coeff (np.ndarray):
+            Shape (draws, n_props - 1).
+
+        MB (np.ndarray):
+            Shape (draws, n_sn_set).
+
+        model_mu (np.ndarray):
+            Shape (n_sne,).
+
+        sn_set_inds (np.ndarray):
+            Shape (n_sne,), python index numbering.
+
+    Returns:
+        (np.ndarray):
+            Shape (draws, n_sne, n_gaus_props).
+    """
+    n_gaus_props = obs_mBx1c.shape[-1]
+    model = np.empty(true_x1cs.shape[:2] + (n_gaus_props,))
+    model[..., 0] = (np.einsum('dnp,dp->dn', true_x1cs, coeff)
+                     + MB[:, sn_set_inds] + model_mu)
+    model[..., 1:] = true_x1cs[..., :n_gaus_props - 1]
+    return obs_mBx1c - model
+
+
+def _log_normal_rank1(resid, factors, var):
+    # log N(resid | 0, C_obs + var e1 e1'), by Sherman-Morrison.
+    prec_resid = np.einsum('nij,dnj->dni', factors.prec, resid)
+    quad_form = np.einsum('dni,dni->dn', resid, prec_resid)
+    denom = 1 + var*factors.prec_11
+    return -0.5*(resid.shape[-1]*np.log(2*np.pi) + factors.logdet + np.log(denom)
+                 + quad_form - var*prec_resid[..., 0]**2/denom)
+
+
+def mixture_terms(resid, factors, sigma_int, outl_frac, sn_set_inds):
+    """The inlier and outlier log likelihood of each SN, `term1` and `term2` in Stan.
+
+    Parameters:
+        resid (np.ndarray):
+            Shape (draws, n_sne, n_gaus_props), see `residuals`.
+
+        factors (ObsFactors):
+            From `obs_factors`.
+
+        sigma_int (np.ndarray):
+            Shape (draws, n_sn_set).
+
+        outl_frac (np.ndarray):
+            Shape (draws, n_sn_set).
+
+        sn_set_inds (np.ndarray):
+            Shape (n_sne,), python index numbering.
+
+    Returns:
+        (tuple of np.ndarray):
+            `term1` and `term2`, each of shape (draws, n_sne).
+    """
+    var_inl = sigma_int[:, sn_set_inds]**2
+    frac = outl_frac[:, sn_set_inds]
+    term1 = np.log1p(-frac) + _log_normal_rank1(resid, factors, var_inl)
+    term2 = np.log(frac) + _log_normal_rank1(resid, factors, var_inl + 0.25)
+    return term1, term2
+
+
+def point_posteriors(resid, factors, sigma_int, outl_frac, sn_set_inds):
+    """The log likelihood of each SN, `PointPosteriors` in Stan, shape (draws, n_sne)."""
+    return np.logaddexp(*mixture_terms(resid, factors, sigma_int, outl_frac, sn_set_inds))
+
+
+def outl_loglike(resid, factors, sigma_int, outl_frac, sn_set_inds):
+    """The inlier minus outlier log likelihood of each SN, shape (draws, n_sne)."""
+    term1, term2 = mixture_terms(resid, factors, sigma_int, outl_frac, sn_set_inds)
+    return term1 - term2
+
+
+def marginal_terms(obs_mBx1c, obs_mBx1c_cov, coeff, MB, model_mu, x1c_star, x1c_pop_cov_mat,
+                   sigma_int, outl_frac, sn_set_inds):
+    """`term1` and `term2` of `stan_code_marginal.txt`, with `true_x1cs` integrated out.
+
+    With A = [coeff'; identity] an inlier is
+    N(obs | [MB + model_mu, x1c_star], obs_mBx1c_cov + A x1c_pop_cov_mat A' + sigma_int^2 e1 e1'),
+    and an outlier has another 0.25 in the [1,1] element.
+
+    Parameters:
+        obs_mBx1c (np.ndarray):
+            Shape (n_sne, n_props), only Gaussian properties.
+
+        obs_mBx1c_cov (np.ndarray):
+            Shape (n_sne, n_props, n_props).
+
+        coeff (np.ndarray):
+            Shape (draws, n_props - 1).
+
+        MB, sigma_int, outl_frac (np.ndarray):
+            Shape (draws, n_sn_set).
+
+        model_mu (np.ndarray):
+            Shape (n_sne,).
+
+        x1c_star (np.ndarray):
+            Shape (draws, n_sn_set, n_props - 1).
+
+        x1c_pop_cov_mat (np.ndarray):
+            Shape (draws, n_sn_set, n_props - 1, n_props - 1).
+
+        sn_set_inds (np.ndarray):
+            Shape (n_sne,), python index numbering.
+
+    Returns:
+        (tuple of np.ndarray):
+            `term1` and `term2`, each of shape (draws, n_sne).
+    """
+    n_props = obs_mBx1c.shape[-1]
+    A = np.concatenate((coeff[:, None, :], np.broadcast_to(np.eye(n_props - 1), coeff.shape[:1] + (n_props - 1,)*2)),
+                       axis=1)
+    set_cov = A[:, None] @ x1c_pop_cov_mat @ A[:, None].transpose(0, 1, 3, 2)
+    set_cov[..., 0, 0] += sigma_int**2
+    set_mean = np.einsum('dij,dsj->dsi', A, x1c_star)
+    set_mean[..., 0] += MB
+
+    cov = obs_mBx1c_cov + set_cov[:, sn_set_inds]
+    resid = obs_mBx1c - set_mean[:, sn_set_inds]
+    resid[..., 0] -= model_mu
+    factors = obs_factors(cov.reshape((-1, n_props, n_props)))
+    factors = ObsFactors(*(f.reshape(cov.shape[:2] + f.shape[1:]) for f in factors))
+
+    prec_resid = np.einsum('dnij,dnj->dni', factors.prec, resid)
+    quad_form = np.einsum('dni,dni->dn', resid, prec_resid)
+    base = n_props*np.log(2*np.pi) + factors.logdet
+    frac = outl_frac[:, sn_set_inds]
+    term1 = np.log1p(-frac) - 0.5*(base + quad_form)
+    denom = 1 + 0.25*factors.prec_11
+    term2 = np.log(frac) - 0.5*(base + np.log(denom) + quad_form - 0.25*prec_resid[..., 0]**2/denom)
+    return term1, term2
+
+
+def marginal_unsupported(stan_data: dict) -> str:
+    """What of `stan_data` the marginal likelihood of `marginal_terms` ignores, or '' if nothing."""
+    problems = []
+    if stan_data.get('n_non_gaus_props', 0) != 0:
+        problems.append(f"age mixtures (n_non_gaus_props = {stan_data['n_non_gaus_props']})")
+    if stan_data.get('allow_alpha_S_N', 0) != 0:
+        problems.append('a skewed population (allow_alpha_S_N = 1)')
+    if stan_data.get('do_fullDint', 0) != 0:
+        problems.append('the full intrinsic covariance (do_fullDint = 1)')
+    return ', '.join(problems)
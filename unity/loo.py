@@ -0,0 +1,245 @@
+""" loo.py - Compare fits by how well they predict each SN, with PSIS-LOO and WAIC.
+
+The expected log predictive density of a left out SN is estimated from the
+draws of the full fit: the draws are reweighted by 1/p(SN | draw), smoothed
+with PSIS (see `psis.py`), Vehtari, Gelman & Gabry (2017), "Practical
+Bayesian model evaluation using leave-one-out cross-validation and WAIC",
+Statistics and Computing 27, 1413. WAIC comes from the same log likelihoods.
+
+This needs the pointwise log likelihood of each SN, `log_lik` in the Stan
+models, saved as draws (`--pars loo` or `full`). At N_SN = 1000 and 160k draws
+that is already 640 MB in float32 (see `sampler.SINGLE_PRECISION`), so it is
+read `BLOCK_SIZE` SNe at a time and only the block is ever float64.
+`stan_code_simple.txt` has no `log_lik`.
+
+The `log_lik` of `stan_code_marginal.txt` is marginal, the true values of the
+SN are integrated out against the population of its sample. That of the other
+models is conditional on the SN's own `true_x1cs`, which then move a lot
+without it, so most SNe get a high k-hat. A fit with draws of the population,
+`x1c_star` and `x1c_pop_cov_mat`, can be scored with the marginal predictive
+instead, computed here from its data (`stan_data`), as `cv.held_out` scores
+the held-out SNe. That ignores any skew and age mixtures, see
+`likelihood.marginal_unsupported`.
+
+The elpd of two fits are only comparable if they are of the same SNe, with
+the same observations, and the same kind of likelihood. Each fit records
+which in its store, see `log_lik_info`, and `compare` refuses fits that differ.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy import special
+
+from . import dataset, likelihood, psis
+
+# How many SNe are read at once.
+BLOCK_SIZE = 64
+
+# How many draws of the marginal predictive are computed at once.
+DRAW_BLOCK_SIZE = 256
+
+# The draws of the pointwise log likelihood.
+LOG_LIK = 'log_lik'
+
+# The draws the marginal predictive needs, see `likelihood.marginal_terms`.
+MARGINAL_PARS = ('coeff', 'MB', 'x1c_star', 'x1c_pop_cov_mat', 'sigma_int', 'outl_frac')
+
+# The data that `log_lik` is the likelihood of, hashed in `log_lik_info`.
+OBSERVATIONS = ('obs_mBx1c', 'obs_mBx1c_cov', 'age_gaus_mean', 'age_gaus_std', 'age_gaus_A')
+
+# What must match for two fits to be compared, see `log_lik_info`.
+COMPARED = ('source', 'kind', 'observations')
+
+# `elpd_loo`, `p_loo`, `elpd_waic`, `p_waic` and their `se`, and per SN the `pointwise` elpd_loo and `k_hat`.
+Loo = namedtuple('Loo', 'elpd_loo se p_loo elpd_waic se_waic p_waic pointwise k_hat')
+
+
+def _se(pointwise: np.ndarray) -> float:
+    return float(np.sqrt(len(pointwise)*np.var(pointwise)))
+
+
+def log_lik_info(model: str, stan_data: dict, marginal: bool) -> dict:
+    """What the `log_lik` of a fit is, saved in its store, see `draws.save_log_lik_info`.
+
+    Parameters:
+        model (str):
+            The Stan model of the fit.
+
+        stan_data (dict):
+            The data of the fit.
+
+        marginal (bool):
+            If `model` integrates out the true values, as `stan_code_marginal.txt` does.
+    """
+    return {'source': LOG_LIK, 'kind': 'marginal' if marginal else 'conditional', 'model': model,
+            'observations': observations_hash(stan_data)}
+
+
+def observations_hash(stan_data: dict) -> str:
+    """A hash of the `OBSERVATIONS` of `stan_data`, see `dataset.content_hash`."""
+    return dataset.content_hash({key: stan_data[key] for key in OBSERVATIONS if key in stan_data})
+
+
+def log_lik(draws):
+    """The pointwise log likelihood draws of a fit, shape (draws, N_SN).
+
+    Raises:
+        ValueError: if the fit has none.
+    """
+    if LOG_LIK not in draws:
+        raise ValueError('the fit has no log_lik draws, stan_code_simple.txt has none. Refit it with '
+                         '--model stan_code_marginal.txt (or stan_code_fast.txt) and --pars loo, '
+                         'or score it with the marginal predictive of its data, unity compare --data.')
+    value = draws[LOG_LIK]
+    return value.reshape((value.shape[0], -1))
+
+
+def marginal_log_lik(hyper: dict, stan_data: dict, block_size: int = DRAW_BLOCK_SIZE) -> np.ndarray:
+    """The marginal predictive log density of each SN of `stan_data`, shape (draws, n_sne).
+
+    Parameters:
+        hyper (dict):
+            The draws of `MARGINAL_PARS`.
+
+        stan_data (dict):
+            The data of a few SNe, e.g. a block of `BLOCK_SIZE`, see `dataset.subset`.
+
+        block_size (int):
+            How many draws are computed at once.
+    """
+    n_draws = len(hyper['coeff'])
+    blocks = []
+    for start in range(0, n_draws, block_size):
+        block = {key: value[start:start + block_size] for key, value in hyper.items()}
+        terms = likelihood.marginal_terms(np.asarray(stan_data['obs_mBx1c']), np.asarray(stan_data['obs_mBx1c_cov']),
+                                          block['coeff'], block['MB'], np.asarray(stan_data['model_mu']),
+                                          block['x1c_star'], block['x1c_pop_cov_mat'], block['sigma_int'],
+                                          block['outl_frac'], np.asarray(stan_data['sn_set_inds']))
+        blocks.append(np.logaddexp(*terms))
+    return np.concatenate(blocks)
+
+
+def _marginal_blocks(draws, stan_data: dict, block_size: int):
+    # The marginal predictive of `block_size` SNe at a time.
+    problem = likelihood.marginal_unsupported(stan_data)
+    if problem:
+        raise ValueError(f'the marginal predictive ignores {problem}.')
+    missing = [key for key in MARGINAL_PARS if key not in draws]
+    if missing:
+        raise ValueError(f"the fit has no {', '.join(missing)} draws, refit it with --pars loo.")
+    hyper = {key: np.asarray(draws[key], dtype=float) for key in MARGINAL_PARS}
+    if hyper['MB'].shape[1] != stan_data['n_sn_set']:
+        raise ValueError(f"the fit has {hyper['MB'].shape[1]} samples (MB), the data {stan_data['n_sn_set']}.")
+    for start in range(0, stan_data['n_sne'], block_size):
+        block = np.arange(start, min(start + block_size, stan_data['n_sne']))
+        yield marginal_log_lik(hyper, dataset.subset(stan_data, block))
+
+
+def pointwise(log_lik: np.ndarray) -> dict:
+    """The elpd_loo, p_loo, elpd_waic, p_waic and k-hat of each column of `log_lik`, shape (draws, n)."""
+    log_lik = np.asarray(log_lik, dtype=float)
+    lpd = special.logsumexp(log_lik, axis=0) - np.log(log_lik.shape[0])
+    lw, k_hat = psis.psis(-log_lik)
+    elpd_loo = special.logsumexp(lw + log_lik, axis=0)
+    p_waic = np.var(log_lik, axis=0, ddof=1)
+    return {'elpd_loo': elpd_loo, 'p_loo': lpd - elpd_loo, 'elpd_waic': lpd - p_waic, 'p_waic': p_waic,
+            'k_hat': k_hat}
+
+
+def loo(draws, block_size: int = BLOCK_SIZE, stan_data: dict = None) -> Loo:
+    """PSIS-LOO and WAIC of a fit.
+
+    Parameters:
+        draws (draws.Draws or dict):
+            The fit, with draws of `LOG_LIK`, or of `MARGINAL_PARS` with `stan_data`.
+
+        block_size (int):
+            How many SNe are read at once.
+
+        stan_data (dict):
+            The data of the fit, to score it with the marginal predictive
+            instead of its `log_lik`, see the module docstring.
+
+    Returns:
+        (Loo):
+            The totals over the SNe, with their standard errors, and the
+            pointwise elpd_loo and k-hat.
+    """
+    if stan_data is None:
+        values = log_lik(draws)
+        blocks = [pointwise(values[:, start:start + block_size]) for start in range(0, values.shape[1], block_size)]
+    else:
+        blocks = [pointwise(values) for values in _marginal_blocks(draws, stan_data, block_size)]
+    result = {key: np.concatenate([block[key] for block in blocks]) for key in blocks[0]}
+    return Loo(float(result['elpd_loo'].sum()), _se(result['elpd_loo']), float(result['p_loo'].sum()),
+               float(result['elpd_waic'].sum()), _se(result['elpd_waic']), float(result['p_waic'].sum()),
+               result['elpd_loo'], result['k_hat'])
+
+
+def n_high_k(result: Loo, n_draws: int) -> int:
+    """How many SNe have a k-hat above `psis.k_threshold`, whose elpd_loo is unreliable."""
+    return int(np.sum(result.k_hat > psis.k_threshold(n_draws)))
+
+
+def compare(results: dict, sn_names: dict = None, infos: dict = None) -> list:
+    """Rank fits by elpd_loo.
+
+    Parameters:
+        results (dict):
+            Fit name to its `Loo`.
+
+        sn_names (dict):
+            Fit name to its SN names, if saved, see `draws.Draws.sn_names`.
+
+        infos (dict):
+            Fit name to what its log likelihood is, see `log_lik_info`, or
+            None for a fit saved without it, which is refused.
+
+    Returns:
+        (list of dict):
+            One row per fit, best first: `name`, `elpd_loo`, `se`, `p_loo`,
+            and `elpd_diff` from the best fit with its standard error
+            `diff_se`, from the pointwise differences.
+
+    Raises:
+        ValueError: if the fits are not of the same SNe, or not of the same likelihood.
+    """
+    unknown = [name for name, info in (infos or {}).items() if info is None]
+    if unknown:
+        raise ValueError(f"{', '.join(unknown)} saved no record of what its log_lik is, refit it with --rerun.")
+    for key in COMPARED:
+        values = {name: info[key] for name, info in (infos or {}).items()}
+        if len(set(values.values())) > 1:
+            raise ValueError(f'the fits differ in the {key} of their log likelihood: '
+                             + ', '.join(f'{value[:12]} ({name})' for name, value in values.items()) + '.')
+    sizes = {name: len(result.pointwise) for name, result in results.items()}
+    if len(set(sizes.values())) > 1:
+        raise ValueError('the fits are not of the same SNe, they have '
+                         + ', '.join(f'{size} ({name})' for name, size in sizes.items()) + ' SNe.')
+    names = [np.asarray(value).astype(str) for value in (sn_names or {}).values() if value is not None]
+    if any(not np.array_equal(names[0], value) for value in names[1:]):
+        raise ValueError('the fits are not of the same SNe, in the same order.')
+    ranked = sorted(results, key=lambda name: -results[name].elpd_loo)
+    best = results[ranked[0]]
+    rows = []
+    for name in ranked:
+        result = results[name]
+        diff = result.pointwise - best.pointwise
+        rows.append({'name': name, 'elpd_loo': result.elpd_loo, 'se': result.se, 'p_loo': result.p_loo,
+                     'elpd_diff': float(diff.sum()), 'diff_se': _se(diff)})
+    return rows
+
+
+def to_text(rows: list, high_k: dict = None) -> str:
+    """A fixed width table of `compare`, with the number of SNe of each fit with a high k-hat."""
+    high_k = high_k or {}
+    width = max([len(row['name']) for row in rows] + [4]) + 2
+    columns = ['elpd_loo', 'se', 'elpd_diff', 'diff_se', 'p_loo']
+    lines = [f"{'fit':<{width}}" + ''.join(f'{column:>11}' for column in columns) + f"{'high k':>8}"]
+    for row in rows:
+        lines.append(f"{row['name']:<{width}}" + ''.join(f'{row[column]:>11.2f}' for column in columns)
+                     + f"{high_k.get(row['name'], 0):>8}")
+    if any(high_k.values()):
+        lines.append('The elpd_loo of SNe with a high k-hat (see psis.k_threshold) is unreliable, '
+                     'the fit moves too much without them.')
+    return '\n'.join(lines)
@@ -0,0 +1,128 @@
+""" online.py - Summary statistics of draws, updated one chunk at a time.
+
+Per-SN quantities such as `outl_loglike` have N_SN values per draw, so keeping
+every draw dominates the size of a fit. A `RunningSummary` is updated with
+each chunk as a chain samples it and keeps only
+
+* the count, mean and sum of squared deviations (Chan et al.'s parallel form
+  of Welford's algorithm), for the mean and standard deviation,
+* the number of negative draws, e.g. P(outl_loglike < 0) is the probability
+  that a SN is an outlier,
+* a uniform random sample (reservoir) of whole draws, for quantiles.
+
+The summaries of each chain are combined with `combine`. For `outl_loglike`,
+`outlier_table` turns the summary into one row per SN.
+"""
+import numpy as np
+
+QUANTILES = (2.5, 16, 25, 50, 75, 84, 97.5)
+
+
+class RunningSummary():
+    """Streamed summary statistics of one parameter.
+
+    Parameters:
+        shape (tuple):
+            The shape of one draw, e.g. `(n_sne,)`.
+
+        reservoir_size (int):
+            How many draws are kept for the quantiles.
+
+        seed (int):
+            Seed for choosing the draws kept in the reservoir.
+    """
+    def __init__(self, shape, reservoir_size=1000, seed=None):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.n_negative = np.zeros(shape, dtype=np.int64)
+        self.reservoir = np.zeros((reservoir_size,) + tuple(shape))
+        self.rng = np.random.RandomState(seed)
+
+    def update(self, chunk: np.ndarray):
+        """Add a chunk of draws, shape (draws, *shape)."""
+        n_chunk = chunk.shape[0]
+        if n_chunk == 0:
+            return
+        mean_chunk = chunk.mean(axis=0)
+        delta = mean_chunk - self.mean
+        n = self.n + n_chunk
+        self.m2 += ((chunk - mean_chunk)**2).sum(axis=0) + delta**2*self.n*n_chunk/n
+        self.mean += delta*n_chunk/n
+        self.n_negative += (chunk < 0).sum(axis=0)
+
+        # Reservoir sampling (Algorithm R) of whole draws. With repeated
+        # indices numpy keeps the last assignment, the same as a loop would.
+        size = self.reservoir.shape[0]
+        index = np.arange(self.n, n)
+        fill = index < size
+        self.reservoir[index[fill]] = chunk[fill]
+        if not fill.all():
+            slot = self.rng.randint(0, index[~fill] + 1)
+            keep = slot < size
+            self.reservoir[slot[keep]] = chunk[~fill][keep]
+        self.n = n
+
+    def sample(self) -> np.ndarray:
+        """The draws in the reservoir."""
+        return self.reservoir[:min(self.n, self.reservoir.shape[0])]
+
+
+def combine(summaries: list) -> dict:
+    """Combine the `RunningSummary` of each chain into the summary of the fit.
+
+    Returns:
+        (dict):
+            `n`, `mean`, `sd`, `p_negative`, `quantile_levels` and `quantiles`,
+            the last of shape (len(quantile_levels), *shape).
+    """
+    n = sum(s.n for s in summaries)
+    mean = sum(s.n*s.mean for s in summaries)/n
+    m2 = sum(s.m2 + s.n*(s.mean - mean)**2 for s in summaries)
+    n_negative = sum(s.n_negative for s in summaries)
+    sample = np.concatenate([s.sample() for s in summaries])
+    return {'n': np.array(n), 'mean': mean, 'sd': np.sqrt(m2/max(n - 1, 1)),
+            'p_negative': n_negative/n, 'quantile_levels': np.array(QUANTILES),
+            'quantiles': np.percentile(sample, QUANTILES, axis=0)}
+
+
+def summarize(draws, chunk_size: int = 1000, seed: int = None) -> dict:
+    """The summary, as from `combine`, of draws that were saved in full, e.g. memory-mapped.
+
+    Parameters:
+        draws (np.ndarray):
+            Shape (draws, *shape), read `chunk_size` draws at a time.
+    """
+    summary = RunningSummary(draws.shape[1:], seed=seed)
+    for start in range(0, draws.shape[0], chunk_size):
+        summary.update(np.asarray(draws[start:start + chunk_size]))
+    return combine([summary])
+
+
+# The columns of `outlier_table`, the bounds are the 2.5, 16, 84 and 97.5 percentiles.
+OUTLIER_COLUMNS = ['mean', 'sd', 'p_outlier', 'lower95', 'lower68', 'median', 'upper68', 'upper95']
+
+
+def outlier_table(summary: dict) -> np.ndarray:
+    """Per-SN outlier statistics from the summary of `outl_loglike`.
+
+    `outl_loglike` is the inlier minus the outlier log likelihood, so a draw
+    with `outl_loglike < 0` classifies the SN as an outlier.
+
+    Parameters:
+        summary (dict):
+            The summary of `outl_loglike`, from `combine` or `summarize`.
+
+    Returns:
+        (np.ndarray):
+            A structured array, one row per SN, with the fields of
+            `OUTLIER_COLUMNS`. `p_outlier` is the fraction of draws classified
+            as an outlier.
+    """
+    levels = list(summary['quantile_levels'])
+    quantiles = summary['quantiles'][[levels.index(q) for q in (2.5, 16, 50, 84, 97.5)]]
+    table = np.zeros(summary['mean'].shape, dtype=[(column, 'f8') for column in OUTLIER_COLUMNS])
+    table['mean'], table['sd'], table['p_outlier'] = summary['mean'], summary['sd'], summary['p_negative']
+    for column, quantile in zip(OUTLIER_COLUMNS[3:], quantiles):
+        table[column] = quantile
+    return table
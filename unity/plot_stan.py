@@ -1,15 +1,16 @@
 # from matplotlib import use
 # use("PDF")
-import gzip
 import corner
 import sys
-import pickle
+from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
 
 import kde_corner
 
+from .draws import load_draws
+
 def collect_plot_params(fit_params, params=None):
     # type: (dict) -> numpy.ndarray
     """Collect the parameters to be plotted from the full UNITY output
@@ -34,6 +35,15 @@ def collect_plot_params(fit_params, params=None):
     return params_to_plot
 
 
+def _fig_name(file_name):
+    # type: (str) -> str
+    """The figure name, the output name without any `.gzip.pkl` extension."""
+    file_name = str(Path(file_name))
+    if file_name.endswith('.gzip.pkl'):
+        file_name = file_name[:-9]
+    return file_name
+
+
 def plot(file_name, plot_labels, truths, plot_params=None, ax_limits=[], kde=True):
     # type: (Union(string, tuple), string, list, bool) -> None
     """Make a corner plot of the UNITY output data.
@@ -41,7 +51,8 @@ def plot(file_name, plot_labels, truths, plot_params=None, ax_limits=[], kde=Tru
     Parameters
     ----------
     file_name: tuple of strings
-        This is the string to the UNITY output file. If a tuple is passed, then 
+        This is the string to the UNITY output, a `*_fitparams/` draw store or
+        a legacy `*_fitparams.gzip.pkl`. If a tuple is passed, then 
     data_type: string
         This defines what standardization coefficients should label the
         axis.
@@ -49,13 +60,14 @@ def plot(file_name, plot_labels, truths, plot_params=None, ax_limits=[], kde=Tru
     print('Plotting ', file_name)  
 
     if len(file_name) > 1:
-        data_sets = [collect_plot_params(pickle.load(gzip.open(f, 'rb')), plot_params) for f in file_name]
-        FIG_NAME = file_name[0][:-9] + '_and_others'
+        # Only the plotted parameters are read from each file.
+        data_sets = [collect_plot_params(load_draws(f), plot_params) for f in file_name]
+        FIG_NAME = _fig_name(file_name[0]) + '_and_others'
         contours = [0.0455003]
     else:
-        fit_params = pickle.load(gzip.open(file_name[0], 'rb'))
+        fit_params = load_draws(file_name[0])
         data_sets = [collect_plot_params(fit_params, plot_params)]
-        FIG_NAME = file_name[0][:-9]
+        FIG_NAME = _fig_name(file_name[0])
         contours = [0.317311, 0.0455003, 0.0027]
 
     if kde:
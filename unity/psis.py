@@ -0,0 +1,83 @@
+""" psis.py - Pareto-smoothed importance sampling.
+
+Importance weights of posterior draws, e.g. for another prior (see
+`reweight.py`) or for leaving out an SN (see `loo.py`), can have a heavy
+right tail, and then a few draws dominate any estimate. PSIS (Vehtari et al.
+2024, "Pareto smoothed importance sampling", JMLR 25, 72) fits a generalized
+Pareto distribution to the largest weights and replaces them with its
+expected order statistics. The fitted shape, k-hat, is also the diagnostic:
+estimates are reliable while k-hat is below `k_threshold`.
+
+Everything works on many sets of weights at once, one per column, so the
+pointwise weights of every SN are smoothed a block of columns at a time.
+"""
+import numpy as np
+from scipy import special
+
+
+def k_threshold(n_draws: int) -> float:
+    """The largest k-hat with a reliable estimate from `n_draws` draws, at most 0.7."""
+    return min(1 - 1/np.log10(n_draws), 0.7)
+
+
+def _gpd_fit(x: np.ndarray) -> (np.ndarray, np.ndarray):
+    """The shape and scale of a generalized Pareto distribution fit to the sorted, positive values of each column.
+
+    The empirical Bayes estimate of Zhang & Stephens (2009), with the shape
+    shrunk towards 0.5 by a weak prior as in Vehtari et al.
+    """
+    n = x.shape[0]
+    m = 30 + int(np.sqrt(n))
+    # A grid of candidates of -shape/scale per column, shape (m, columns).
+    theta = 1/x[-1] + (1 - np.sqrt(m/(np.arange(1, m + 1) - 0.5)))[:, None]/(3*x[int(n/4 + 0.5) - 1])
+    k = np.log1p(-theta[:, None, :]*x[None]).mean(axis=1)
+    log_likelihood = n*(np.log(-theta/k) - k - 1)
+    weights = np.exp(log_likelihood - special.logsumexp(log_likelihood, axis=0))
+    theta = (theta*weights).sum(axis=0)
+    k = np.log1p(-theta*x).mean(axis=0)
+    sigma = -k/theta
+    return (n*k + 10*0.5)/(n + 10), sigma
+
+
+def _gpd_quantile(p: np.ndarray, k: np.ndarray, sigma: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(np.abs(k) < 1e-12, -sigma*np.log1p(-p), sigma*np.expm1(-k*np.log1p(-p))/k)
+
+
+def psis(log_weights: np.ndarray) -> (np.ndarray, np.ndarray):
+    """Smooth, and normalize, importance weights.
+
+    Parameters:
+        log_weights (numpy.ndarray):
+            Shape (draws,) or (draws, n), the log weights of the draws, one set
+            per column. Any dtype, each column is smoothed in float64.
+
+    Returns:
+        (tuple of numpy.ndarray):
+            The smoothed log weights, normalized to sum to 1 in each column,
+            and the k-hat of each column, -inf for constant weights and inf
+            for too few draws to fit the tail.
+    """
+    log_weights = np.asarray(log_weights)
+    lw = np.array(log_weights.reshape((log_weights.shape[0], -1)), dtype=float)
+    n_draws = lw.shape[0]
+    lw -= lw.max(axis=0)
+    # The tail is the largest 20% of the weights, at most 3 sqrt(draws) of them.
+    n_tail = int(np.ceil(min(0.2*n_draws, 3*np.sqrt(n_draws))))
+    k = np.full(lw.shape[1], np.inf)
+    if n_tail >= 5:
+        order = np.argsort(lw, axis=0)
+        tail_rows = order[-n_tail:]
+        cutoff = np.maximum(np.take_along_axis(lw, order[-n_tail - 1:-n_tail], axis=0)[0],
+                            np.log(np.finfo(float).tiny))
+        exceedance = np.maximum(np.exp(np.take_along_axis(lw, tail_rows, axis=0)) - np.exp(cutoff), 0)
+        k[:] = -np.inf
+        # Constant weights have no tail to fit.
+        fit = np.flatnonzero(exceedance[-1] > 0)
+        if fit.size:
+            k[fit], sigma = _gpd_fit(exceedance[:, fit])
+            sigma, fit = sigma[np.isfinite(k[fit])], fit[np.isfinite(k[fit])]
+            fitted = _gpd_quantile(((np.arange(n_tail) + 0.5)/n_tail)[:, None], k[fit], sigma)
+            lw[tail_rows[:, fit], fit] = np.minimum(np.log(fitted + np.exp(cutoff[fit])), 0)
+    lw -= special.logsumexp(lw, axis=0)
+    return lw.reshape(log_weights.shape), k if log_weights.ndim > 1 else k[0]
@@ -0,0 +1,110 @@
+""" results.py - A content-addressed cache of finished fits.
+
+A fit is keyed by a hash of everything that decides its draws: the Stan model
+source, the data passed to Stan (after `validate`), the sampler settings, the
+seed and the saved parameters. A finished draw store (see `draws.py`) is kept
+in the cache as
+
+    {directory}/{key[:2]}/{key}/
+
+with a `fit.json` describing it. On a hit `restore` hard-links the cached
+files into the fit's output directory, so nothing is sampled, or copied, again.
+The draw stores are never written to after they are merged, so sharing their
+files is safe.
+
+The cache directory is `unity.results_dir`: `$UNITY_RESULTS_DIR`, else
+`results/` in `--cache-dir` or `$UNITY_CACHE_DIR`, else
+`$XDG_CACHE_HOME/unity/results` (`~/.cache/unity/results`). Deleting it, or
+any entry in it, clears the cache; `UNITY_RESULTS_DIR=off` turns it off and
+`--rerun` skips it for one run.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from . import dataset
+from . import draws as draw_store
+
+
+def fit_key(model_code: str, stan_data: dict, **settings) -> str:
+    """The key of a fit.
+
+    Parameters:
+        model_code (str):
+            The Stan model source.
+
+        stan_data (dict):
+            The data passed to Stan, see `unity.prepare_data`.
+
+        **settings:
+            Anything else that changes the draws, e.g. `steps`, `chains`,
+            `seed` and `pars`. Must be JSON serializable.
+    """
+    key = json.dumps({'model': hashlib.sha256(model_code.encode('utf8')).hexdigest(),
+                      'data': dataset.content_hash(stan_data), 'draws_version': draw_store.VERSION,
+                      'settings': settings}, sort_keys=True)
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+
+def _entry(key: str, directory: Path) -> Path:
+    return Path(directory)/key[:2]/key
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)    # e.g. another file system
+
+
+def lookup(key: str, directory: Path) -> Path:
+    """The cached draw store of `key`, or None."""
+    if directory is None:
+        return None    # the cache is off
+    entry = _entry(key, directory)
+    return entry if (entry/'fit.json').exists() else None
+
+
+def restore(key: str, directory: Path, store: Path) -> bool:
+    """Put the cached draws of `key` at `store`, replacing anything there.
+
+    Returns:
+        (bool):
+            False if `key` is not in the cache, or `directory` is None.
+    """
+    entry = lookup(key, directory)
+    if entry is None:
+        return False
+    store = Path(store)
+    if store.exists():
+        shutil.rmtree(store)
+    shutil.copytree(entry, store, copy_function=_link_or_copy,
+                    ignore=lambda path, names: ['fit.json'] if Path(path) == entry else [])
+    return True
+
+
+def save(key: str, directory: Path, store: Path, info: dict = None):
+    """Add the merged draw store at `store` to the cache, as `key`.
+
+    Parameters:
+        info (dict):
+            Saved in `fit.json` with the key, e.g. the data file and settings.
+
+    Nothing is saved if `directory` is None.
+    """
+    if directory is None or lookup(key, directory) is not None:
+        return
+    entry = _entry(key, directory)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # Copy to a temporary directory then rename, so a cache entry is never half written.
+    tmp = entry.with_name(f'{key}.{os.getpid()}.tmp')
+    shutil.copytree(store, tmp, copy_function=_link_or_copy)
+    with open(tmp/'fit.json', 'w') as f:
+        json.dump(dict(info or {}, key=key, created=time.strftime('%Y-%m-%dT%H:%M:%S')), f, indent=2)
+    try:
+        os.replace(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp)    # another process cached it first
@@ -0,0 +1,171 @@
+""" reweight.py - A fit with another prior, or without some SNe, from its draws.
+
+Many variants of a fit only change a prior, or leave out a few SNe. Their
+posteriors are close to that of the original fit, so its draws can be
+reweighted instead of refitting: each draw gets the ratio of the new to the
+old posterior density, up to a constant, and the weights are smoothed with
+PSIS (see `psis.py`).
+
+The priors that can be changed, `PRIORS`, are the same in every Stan model:
+
+* `outl_frac ~ lognormal(outl_frac_prior_lnmean, outl_frac_prior_lnwidth)`,
+* `sigma_int ~ lognormal(-2.3, 0.5)` if `lognormal_intr_prior` is 1,
+* `sigma_int ~ normal(0, sigma_int_scale)`, with `sigma_int_scale` 0.2.
+
+Leaving out an SN divides by its `PointPosteriors`, the likelihood of its
+observations given its true values, so those have to be saved as draws (e.g.
+`--pars full`). Its true values are then only constrained by the population,
+as in a fit without it, so the reweighted hyperparameters are those of that
+fit. The age mixtures of an SN are not in `PointPosteriors`, so SNe of fits
+with them can not be left out.
+
+If k-hat is above `psis.k_threshold`, the new posterior is too far from the
+old one for its draws, and only a refit will do.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from . import psis, summary
+
+# The prior settings `reweight` can change, and those that are not data of the Stan models.
+PRIORS = ('outl_frac_prior_lnmean', 'outl_frac_prior_lnwidth', 'lognormal_intr_prior', 'sigma_int_scale')
+SIGMA_INT_SCALE = 0.2
+
+# How many draws of `PointPosteriors` are read at once.
+BLOCK_SIZE = 4096
+
+Reweighted = namedtuple('Reweighted', 'summary k_hat ess reliable')
+
+
+def _lognormal_lpdf(x, mu, sigma):
+    return -np.log(x*sigma*np.sqrt(2*np.pi)) - (np.log(x) - mu)**2/(2*sigma**2)
+
+
+def _normal_lpdf(x, mu, sigma):
+    return -np.log(sigma*np.sqrt(2*np.pi)) - (x - mu)**2/(2*sigma**2)
+
+
+def prior_settings(stan_data: dict, changes: dict = None) -> dict:
+    """The prior settings of `stan_data`, with `changes`.
+
+    Raises:
+        ValueError: for a setting not in `PRIORS`.
+    """
+    changes = changes or {}
+    unknown = set(changes) - set(PRIORS)
+    if unknown:
+        raise ValueError(f"unknown prior settings {', '.join(sorted(unknown))}, use {', '.join(PRIORS)}.")
+    settings = {key: float(stan_data[key]) for key in PRIORS if key in stan_data}
+    settings.setdefault('sigma_int_scale', SIGMA_INT_SCALE)
+    settings.update({key: float(value) for key, value in changes.items()})
+    if settings['lognormal_intr_prior'] not in (0, 1):
+        raise ValueError('lognormal_intr_prior must be 0 or 1.')
+    return settings
+
+
+def log_prior(draws, settings: dict) -> np.ndarray:
+    """The log density of each draw under the priors `PRIORS`, up to a constant."""
+    outl_frac = np.asarray(draws['outl_frac'], dtype=float).reshape((len(draws['outl_frac']), -1))
+    sigma_int = np.asarray(draws['sigma_int'], dtype=float).reshape((len(draws['sigma_int']), -1))
+    lp = _lognormal_lpdf(outl_frac, settings['outl_frac_prior_lnmean'], settings['outl_frac_prior_lnwidth']).sum(1)
+    if settings['lognormal_intr_prior'] == 1:
+        lp += _lognormal_lpdf(sigma_int, -2.3, 0.5).sum(axis=1)
+    return lp + _normal_lpdf(sigma_int, 0, settings['sigma_int_scale']).sum(axis=1)
+
+
+def log_weights(draws, old: dict, new: dict, drop=()) -> np.ndarray:
+    """The log importance weight of each draw, from the `old` prior settings to `new` and without the SNe `drop`.
+
+    Raises:
+        ValueError: if the fit does not have the draws this needs.
+    """
+    drop = np.asarray(drop, dtype=int)
+    missing = [key for key in ('outl_frac', 'sigma_int') if key not in draws and old != new]
+    if drop.size and 'PointPosteriors' not in draws:
+        missing.append('PointPosteriors')
+    if missing:
+        raise ValueError(f"the fit has no draws of {', '.join(missing)}, refit with them in --pars.")
+    n_draws = len(next(iter(draws.values())))
+    lw = np.zeros(n_draws) if old == new else log_prior(draws, new) - log_prior(draws, old)
+    if drop.size:
+        point = draws['PointPosteriors']
+        for start in range(0, n_draws, BLOCK_SIZE):
+            lw[start:start + BLOCK_SIZE] -= np.asarray(point[start:start + BLOCK_SIZE][:, drop], dtype=float).sum(1)
+    return lw
+
+
+def _weighted_quantiles(x: np.ndarray, weights: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """Quantiles `q` (in [0, 1]) of each column of `x`, shape (len(q), columns)."""
+    order = np.argsort(x, axis=0)
+    x, w = np.take_along_axis(x, order, axis=0), weights[order]
+    # Each draw at the middle of its weight, as `numpy.percentile` does for equal weights.
+    cumulative = (np.cumsum(w, axis=0) - w/2)/w.sum(axis=0)
+    return np.array([np.interp(q, cumulative[:, j], x[:, j]) for j in range(x.shape[1])]).T
+
+
+def weighted_summary(draws, weights: np.ndarray, pars: list = None) -> summary.Summary:
+    """The mean, sd and quantiles of each scalar, with normalized `weights` for the draws.
+
+    `pars` are as in `summary.summarize`, but must be saved as draws.
+    """
+    if pars is None:
+        pars = [key for key in draws if np.prod(draws[key].shape[1:], dtype=int) <= summary.MAX_SIZE]
+    labels, rows = [], []
+    for key in pars:
+        value = np.asarray(draws[key], dtype=float)
+        x = value.reshape((value.shape[0], -1))
+        mean = weights @ x
+        sd = np.sqrt(weights @ (x - mean)**2)
+        quantiles = _weighted_quantiles(x, weights, np.array(summary.QUANTILES)/100)
+        rows.append(np.vstack((mean, sd, quantiles)).T)
+        labels += summary._labels(key, value.shape[1:])
+    columns = summary.COLUMNS[:2 + len(summary.QUANTILES)]
+    return summary.Summary(labels, columns, np.concatenate(rows) if rows else np.zeros((0, len(columns))))
+
+
+def reweight(draws, stan_data: dict, changes: dict = None, drop=(), pars: list = None) -> Reweighted:
+    """Reweight a fit to other prior settings, or without some SNe.
+
+    Parameters:
+        draws (draws.Draws):
+            The fit.
+
+        stan_data (dict):
+            The data of the fit, for its prior settings.
+
+        changes (dict):
+            Prior setting, see `PRIORS`, to its new value.
+
+        drop (list of int):
+            The indices of the SNe to leave out.
+
+        pars (list of str):
+            The parameters to summarize, see `weighted_summary`.
+
+    Returns:
+        (Reweighted):
+            `summary`, the reweighted summary, `k_hat` and `ess`, the effective
+            sample size of the weights, and whether the summary is `reliable`.
+
+    Raises:
+        ValueError: if the fit can not be reweighted this way.
+    """
+    if len(drop) and stan_data.get('n_non_gaus_props', 0):
+        raise ValueError('SNe with age mixtures can not be left out by reweighting, refit without them.')
+    lw = log_weights(draws, prior_settings(stan_data), prior_settings(stan_data, changes), drop)
+    lw, k_hat = psis.psis(lw)
+    weights = np.exp(lw)
+    return Reweighted(weighted_summary(draws, weights, pars), float(k_hat), float(1/np.sum(weights**2)),
+                      bool(k_hat <= psis.k_threshold(len(weights))))
+
+
+def to_text(result: Reweighted) -> str:
+    """A fixed width table of the reweighted summary, and the diagnostics."""
+    lines = [f"{'':<20}" + ''.join(f'{column:>9}' for column in result.summary.columns)]
+    for label, row in zip(result.summary.labels, result.summary.values):
+        lines.append(f'{label:<20}' + ''.join(f'{x:>9.2f}' for x in row))
+    lines.append(f'Pareto k-hat {result.k_hat:.2f}, effective sample size of the weights {result.ess:.0f}.')
+    if not result.reliable:
+        lines.append('k-hat is too high for reweighting, the new posterior is too far from the fit. Refit it.')
+    return '\n'.join(lines)
@@ -0,0 +1,491 @@
+""" sampler.py - Run the Stan chains of a UNITY fit in separate worker processes.
+
+pystan's own `n_jobs` option sends each chain's full `PyStanHolder` back to
+the parent through a pickle. That hits the signed 32-bit length limit of
+multiprocessing once N_SN is larger than ~150. Here each chain runs in its own
+worker process and streams its draws to a draw store on disk (see `draws.py`),
+so nothing large is sent back to the parent.
+
+A chain is sampled in segments of `chunk_size` draws. The first segment
+includes warmup. Every later segment restarts from the last draw with the
+adapted step size and inverse metric, and with adaptation off, so the
+segments join into one continuous chain. Each segment is written to disk as
+soon as it is done.
+
+Pointwise log-likelihoods (`SINGLE_PRECISION`, see `loo.py`) are written as
+float32, half the disk of the draws that are usually the largest of a fit.
+
+Parameters in `summarize` are not written to disk. Each chain updates a
+streamed summary of them with every segment instead (see `online.py`).
+A fit with `outl_loglike` also gets a table of per-SN outlier statistics.
+Each chain also times its segments and totals their sampler diagnostics,
+saved as `telemetry.json` (see `telemetry.py`), and can print them as it goes.
+
+Every chain gets its own seed, derived from the seed of the fit and its
+`chain_id` (see `chain_seed`), so a seeded fit gives the same draws however
+its chains are scheduled. The seeds are saved in the store's `meta.json`.
+
+After every segment the chain also writes a checkpoint of its sampler state
+(step size, inverse metric, last draw, streamed summaries and how many draws
+are done). With
+`resume=True` an interrupted chain continues from its last checkpoint and
+skips warmup. A chain interrupted during warmup starts again. The last
+checkpoint of each chain is kept in the merged store (see
+`draws.save_sampler_state`), so a later fit can start where this one ended,
+from its last draw (`init`) with warmup adapting from its step size and
+inverse metric (`adapt`), see `incremental.py`.
+
+A model that uses `map_rect`, and is compiled with `STAN_THREADS`, can also
+use several threads within each chain, see `threads_per_chain`.
+
+`run_fits` samples several fits, e.g. one per dataset, in one pool of
+workers. Every chain of every fit is a task for the pool, and each fit is
+merged as soon as its last chain is done.
+"""
+import hashlib
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+import re
+import shutil
+import sys
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from . import draws as draw_store
+from . import online, telemetry
+
+# Everything a worker needs to run one chain.
+ChainTask = namedtuple('ChainTask', 'model data steps chains chain_id seed pars summarize param_names '
+                                    'chunk_size store resume threads progress init warmup adapt')
+
+# One fit for `run_fits`. `model` is a key of the `models` passed to `run_fits`,
+# `cores` is the most cores its chains may use at once, the other fields are as in `run_chains`.
+Fit = namedtuple('Fit', 'model data steps chains pars summarize store seed chunk_size resume threads cores '
+                        'init warmup adapt')
+Fit.__new__.__defaults__ = (None, None, None)
+
+# Outputs saved as float32, only ever summed over in log space, see `loo.py`.
+SINGLE_PRECISION = ('log_lik',)
+
+# Stan seeds are at most this, see `chain_seed`.
+MAX_SEED = 2**31 - 1
+
+# The compiled models, by name, are set in the parent before the pool is forked,
+# so the (large) StanModels are inherited by the workers rather than pickled to them.
+_MODELS = {}
+
+
+# The first word of a Stan variable declaration.
+_TYPES = {'int', 'real', 'vector', 'row_vector', 'matrix', 'simplex', 'unit_vector', 'ordered',
+          'positive_ordered', 'cholesky_factor_corr', 'cholesky_factor_cov', 'corr_matrix', 'cov_matrix'}
+
+
+def _declarations(code: str, block: str) -> list:
+    """The variables declared at the top of a block of a Stan program, without comments.
+
+    Returns:
+        (list of tuple):
+            The type, the bounds (e.g. `lower = 0`, or '') and the name of each.
+    """
+    start = re.search(rf'(?<!transformed )\b{block}\s*{{', code)
+    if start is None:
+        return []
+    # Keep only the outermost level of the block, dropping any nested `{ ... }`.
+    depth, body = 1, []
+    for char in code[start.end():]:
+        depth += (char == '{') - (char == '}')
+        if depth == 0:
+            break
+        if depth == 1 and char != '}':
+            body.append(char)
+    declarations = []
+    for declaration in ''.join(body).split(';'):
+        bounds = re.search(r'<([^>]*)>', declaration)
+        # Drop sizes and bounds, then the name is the last word.
+        words = re.sub(r'\[[^\]]*\]|<[^>]*>', ' ', declaration).split()
+        if not words or words[0] not in _TYPES:
+            break    # declarations come before statements
+        declarations.append((words[0], bounds.group(1).strip() if bounds else '', words[-1]))
+    return declarations
+
+
+def _block_names(code: str, block: str) -> list:
+    return [name for _, _, name in _declarations(code, block)]
+
+
+def _strip_comments(model_code: str) -> str:
+    return re.sub(r'/\*.*?\*/', '', re.sub(r'//.*', '', model_code), flags=re.S)
+
+
+def parameter_names(model_code: str) -> list:
+    """The names declared in the `parameters` block of a Stan program.
+
+    These are what a chain needs to restart from its last draw.
+    """
+    return _block_names(_strip_comments(model_code), 'parameters')
+
+
+def parameter_bounds(model_code: str) -> dict:
+    """The bounds of each parameter of a Stan program.
+
+    Returns:
+        (dict):
+            Name to (lower, upper), each None if unbounded, for the `real`,
+            `vector`, `row_vector` and `matrix` parameters with numeric
+            bounds. Other parameters, e.g. a `simplex` or bounds that are
+            expressions, are left out.
+    """
+    bounds = {}
+    for kind, text, name in _declarations(_strip_comments(model_code), 'parameters'):
+        if kind not in ('real', 'vector', 'row_vector', 'matrix'):
+            continue
+        limits = dict(re.findall(r'(lower|upper)\s*=\s*([^,]+)', text))
+        try:
+            bounds[name] = tuple(float(limits[key]) if key in limits else None for key in ('lower', 'upper'))
+        except ValueError:
+            continue
+    return bounds
+
+
+def output_names(model_code: str) -> list:
+    """The names of every output of a Stan program.
+
+    These are the parameters, transformed parameters and generated quantities.
+    """
+    code = _strip_comments(model_code)
+    return (_block_names(code, 'parameters') + _block_names(code, 'transformed parameters')
+            + _block_names(code, 'generated quantities'))
+
+
+def checkpoint_file(store: Path, chain_id: int) -> Path:
+    return Path(store)/f'chain{chain_id}'/'checkpoint.pkl'
+
+
+def load_checkpoint(store: Path, chain_id: int) -> dict:
+    """The last checkpoint of a chain, or None if it has not finished warmup."""
+    try:
+        with open(checkpoint_file(store, chain_id), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _save_checkpoint(store: Path, chain_id: int, state: dict):
+    # write-then-rename, a killed process keeps the previous checkpoint.
+    path = checkpoint_file(store, chain_id)
+    with open(path.with_suffix('.tmp'), 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path.with_suffix('.tmp'), path)
+
+
+def chain_seed(seed: int, chain_id: int) -> int:
+    """The seed of chain `chain_id` of a fit seeded with `seed`.
+
+    A hash, so nearby fit seeds do not give overlapping chain seeds.
+    """
+    digest = hashlib.sha256(f'{seed}:{chain_id}'.encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'little') % MAX_SEED
+
+
+def _sample_chain(task: ChainTask) -> str:
+    """Run a single chain, streaming its draws to `task.store`.
+
+    This runs inside a worker process. Only the store is returned.
+    """
+    model = _MODELS[task.model]
+    # Stan reads this when the model calls `map_rect`, it has no effect otherwise.
+    os.environ['STAN_NUM_THREADS'] = str(task.threads)
+    writer = draw_store.DrawWriter(task.store, task.chain_id)
+    # Sample the parameters block as well as `pars`, so there is a last draw to restart from.
+    sample_pars = list(dict.fromkeys(task.pars + task.summarize + task.param_names))
+
+    warmup = task.steps//2 if task.warmup is None else task.warmup    # pystan's default
+    n_draws = task.steps - warmup
+    # Only the memory this chain adds counts, not what the worker inherited, see `telemetry.py`.
+    base_rss = telemetry.reset_peak_rss()
+    checkpoint = load_checkpoint(task.store, task.chain_id) if task.resume else None
+    if checkpoint is None:
+        writer.truncate(0)
+        done, segment, seed = 0, 0, chain_seed(task.seed, task.chain_id)
+        summaries, totals = {}, telemetry.new()
+    else:
+        # Drop any chunk written after the checkpoint.
+        writer.truncate(checkpoint['n_chunks'])
+        done, segment, seed = checkpoint['done'], checkpoint['segment'], checkpoint['seed']
+        stepsize, inv_metric = checkpoint['stepsize'], checkpoint['inv_metric']
+        last_draw = checkpoint['last_draw']
+        summaries = checkpoint.get('summaries', {})
+        totals = checkpoint.get('telemetry', telemetry.new())
+
+    while done < n_draws:
+        n = min(task.chunk_size, n_draws - done)
+        start = time.perf_counter()
+        if segment == 0:
+            # Warmup adapts from the given step size and inverse metric, if any, rather than Stan's defaults.
+            control = {} if task.adapt is None else dict(task.adapt)
+            if warmup == 0:
+                # pystan refuses to adapt without warmup, the chain samples with the given (or default) metric.
+                control['adapt_engaged'] = False
+            # pystan 2.19 takes a list of chain ids, one per chain.
+            fit = model.sampling(data=task.data, iter=warmup + n, warmup=warmup, chains=1,
+                                 chain_id=[task.chain_id], seed=seed, n_jobs=1, pars=sample_pars,
+                                 init='random' if task.init is None else [task.init],
+                                 **({'control': control} if control else {}))
+            stepsize, inv_metric = fit.get_stepsize()[0], fit.get_inv_metric()[0]
+        else:
+            # A new `chain_id` per segment gives each segment its own random number stream.
+            # A new `control` per call, as pystan pops `inv_metric` out of it, and every segment needs the adapted one.
+            fit = model.sampling(data=task.data, iter=n, warmup=0, chains=1,
+                                 chain_id=[task.chain_id + segment*task.chains], seed=seed,
+                                 n_jobs=1, pars=sample_pars, init=[last_draw],
+                                 control=dict(adapt_engaged=False, stepsize=stepsize, inv_metric=inv_metric))
+        seconds = time.perf_counter() - start
+        # `permuted=False` keeps the draws in order, shape (draws, 1 chain, *dims).
+        extracted = fit.extract(pars=sample_pars, permuted=False)
+        chunk = {key: extracted[key][:, 0] for key in task.pars if key in extracted}
+        writer.append({key: value.astype(np.float32) if key in SINGLE_PRECISION else value
+                       for key, value in chunk.items()})
+        for key in task.summarize:
+            if key not in summaries:
+                summaries[key] = online.RunningSummary(extracted[key].shape[2:], seed=seed)
+            summaries[key].update(extracted[key][:, 0])
+        # The peak after the draws are extracted and written, which needs more memory than sampling alone.
+        totals = telemetry.update(totals, fit.get_sampler_params(inc_warmup=True)[0],
+                                  warmup if segment == 0 else 0, seconds, telemetry.peak_rss_mb(base_rss))
+        last_draw = {key: extracted[key][-1, 0] for key in task.param_names if key in extracted}
+        done += n
+        segment += 1
+        _save_checkpoint(task.store, task.chain_id,
+                         {'fit_seed': task.seed, 'seed': seed, 'done': done, 'segment': segment,
+                          'n_chunks': writer.n_chunks, 'stepsize': stepsize, 'inv_metric': inv_metric,
+                          'last_draw': last_draw, 'summaries': summaries, 'telemetry': totals})
+        if task.progress:
+            # One write per line, so the lines of chains in other workers do not interleave.
+            sys.stdout.write(telemetry.progress(Path(task.store).name, task.chain_id, done, n_draws, totals) + '\n')
+            sys.stdout.flush()
+    return str(task.store)
+
+
+def _available(pars: list, model_code: str) -> list:
+    """The `pars` the model outputs. pystan fails on any others, e.g. `log_lik` with stan_code_simple.txt."""
+    names = output_names(model_code)
+    missing = [key for key in pars if key not in names]
+    if missing:
+        print(f"Skipping {', '.join(missing)}, not an output of this model.")
+    return [key for key in pars if key in names]
+
+
+def _save_summaries(store: Path, checkpoints: list):
+    """Combine the streamed summaries in each chain's last checkpoint, and save them in `store`."""
+    for key in checkpoints[0]['summaries']:
+        draw_store.save_summary(store, key, online.combine([c['summaries'][key] for c in checkpoints]))
+
+
+def _finish(store: Path, chains: int) -> draw_store.Draws:
+    """Merge a fit whose chains are done, with its summaries, seeds, outlier table and telemetry."""
+    checkpoints = [load_checkpoint(store, chain_id) for chain_id in range(1, chains + 1)]
+    _save_summaries(store, checkpoints)
+    # The chain directories, and the checkpoints in them, go with the merge.
+    draw_store.save_sampler_state(store, [{key: c[key] for key in ('last_draw', 'stepsize', 'inv_metric')}
+                                          for c in checkpoints])
+    draw_store.merge(store, {'seed': checkpoints[0].get('fit_seed'),
+                             'chain_seeds': [c['seed'] for c in checkpoints]})
+    draws = draw_store.Draws(store)
+    _save_outlier_table(draws)
+    chain_totals = [c.get('telemetry', telemetry.new()) for c in checkpoints]
+    draw_store.save_telemetry(store, telemetry.report(chain_totals, draws))
+    return draws
+
+
+def _save_outlier_table(draws: draw_store.Draws):
+    """Save the per-SN outlier statistics of a fit with `outl_loglike`, as a summary or as draws."""
+    if 'outl_loglike' in draws.summaries:
+        summary = draws.summary('outl_loglike')
+    elif 'outl_loglike' in draws:
+        summary = online.summarize(draws['outl_loglike'])
+    else:
+        return
+    draw_store.save_outlier_table(draws.path, online.outlier_table(summary))
+
+
+def check_warmup(steps: int, warmup: int = None):
+    """Raises a ValueError unless `warmup` leaves at least one of `steps` to sample."""
+    if warmup is not None and not 0 <= warmup < steps:
+        raise ValueError(f'warmup must be at least 0 and less than steps ({steps}).')
+
+
+def fit_seed(seed, store: Path, chains: int, resume: bool = False) -> int:
+    """The seed a fit samples with: `seed`, else that of the interrupted fit it resumes, else a random one."""
+    if seed is None and resume:
+        # Keep the seed the interrupted fit chose.
+        checkpoints = filter(None, (load_checkpoint(store, chain_id) for chain_id in range(1, chains + 1)))
+        seed = next((c['fit_seed'] for c in checkpoints if 'fit_seed' in c), None)
+    if seed is None:
+        seed = random.randint(0, MAX_SEED - 1)
+    return seed
+
+
+def run_chains(sm, stan_data: dict, steps: int, chains: int, max_cores: int,
+               pars: list, store: Path, seed: int = None, chunk_size: int = 1000,
+               resume: bool = False, threads_per_chain: int = 1, summarize: list = (),
+               progress: bool = False, init: list = None, warmup: int = None,
+               adapt: list = None) -> draw_store.Draws:
+    """Sample `chains` chains of `sm`, with at most `max_cores` running at once.
+
+    Parameters:
+        sm (pystan.StanModel):
+            The compiled UNITY model.
+
+        stan_data (dict):
+            The data block values passed to Stan.
+
+        steps (int):
+            Iterations per chain, including warmup (pystan option `iter`).
+
+        chains (int):
+            The number of independent chains.
+
+        max_cores (int):
+            The number of cores to use, shared between the chains. Chains run
+            in series if this is smaller than `chains*threads_per_chain`.
+
+        pars (list of str):
+            The Stan parameters to keep.
+
+        store (pathlib.Path):
+            The draw store directory the chains write to.
+
+        seed (int):
+            The seed of the fit, each chain's seed is derived from it, see
+            `chain_seed`. A random seed is chosen if None.
+
+        chunk_size (int):
+            How many draws are sampled, and written, at a time. A checkpoint
+            is saved after each chunk.
+
+        resume (bool):
+            Continue the chains in `store` from their last checkpoints,
+            rather than starting a new fit.
+
+        threads_per_chain (int):
+            Threads for `map_rect` within each chain (`STAN_NUM_THREADS`).
+            Only useful if `sm` was compiled with `STAN_THREADS`.
+
+        summarize (list of str):
+            Stan parameters to keep as streamed summaries (see `online.py`),
+            rather than as draws.
+
+        progress (bool):
+            Print the telemetry of each chain after every chunk, see `telemetry.progress`.
+
+        init (list of dict):
+            The start point of each chain, see `inits.initial_values`. None for
+            Stan's random inits.
+
+        warmup (int):
+            Warmup iterations of each chain, out of `steps`. Half of `steps` if None.
+            With 0 there is no adaptation, the chains sample with `adapt`, or
+            with Stan's default step size and unit metric.
+
+        adapt (list of dict):
+            The `stepsize` and `inv_metric` each chain starts warmup from, see
+            `incremental.py`. None for Stan's defaults.
+
+    Returns:
+        (draws.Draws):
+            The merged draws, memory-mapped from `store`.
+    """
+    fit = Fit('model', stan_data, steps, chains, pars, list(summarize), store, seed, chunk_size, resume,
+              threads_per_chain, max_cores, init, warmup, adapt)
+    [(_, draws)] = run_fits({'model': sm}, [fit], max_cores, progress)
+    return draws
+
+
+def run_fits(models: dict, fits: list, max_cores: int, progress: bool = False):
+    """Sample several fits in one pool of at most `max_cores` cores.
+
+    Each worker runs one chain on `threads` cores. Chains are started in
+    order, as long as they fit in the free cores and their fit's own `cores`
+    limit, so a later, smaller chain can fill cores a larger one can not.
+
+    Parameters:
+        models (dict):
+            Name to compiled `pystan.StanModel`.
+
+        fits (list of Fit):
+            The fits, their `store`s must differ.
+
+        max_cores (int):
+            The number of cores shared by every fit.
+
+        progress (bool):
+            Print the telemetry of each chain after every chunk, see `telemetry.progress`.
+
+    Yields:
+        (tuple of Fit, draws.Draws):
+            Each fit and its merged draws, in the order they finish.
+    """
+    global _MODELS
+    _MODELS = models
+
+    pending, remaining, done = [], {}, []
+    for fit in fits:
+        store = Path(fit.store)
+        if fit.resume and (store/'meta.json').exists():
+            done.append(fit)    # already finished and merged
+            continue
+        model_code = models[fit.model].model_code
+        pars, summarize = _available(fit.pars, model_code), _available(fit.summarize, model_code)
+        if not pars:
+            raise ValueError(f'{store}: none of {fit.pars} are outputs of the model, there is nothing to save.')
+        try:
+            check_warmup(fit.steps, fit.warmup)
+        except ValueError as err:
+            raise ValueError(f'{store}: {err}') from None
+        if not fit.resume and store.exists():
+            shutil.rmtree(store)    # a fresh run, do not append to an old store
+        seed = fit_seed(fit.seed, store, fit.chains, fit.resume)
+        pending += [ChainTask(fit.model, fit.data, fit.steps, fit.chains, chain_id, seed, pars, summarize,
+                              parameter_names(model_code), fit.chunk_size, store, fit.resume, fit.threads,
+                              progress, None if fit.init is None else fit.init[chain_id - 1], fit.warmup,
+                              None if fit.adapt is None else fit.adapt[chain_id - 1])
+                    for chain_id in range(1, fit.chains + 1)]
+        remaining[str(store)] = fit
+    for fit in done:
+        yield fit, draw_store.Draws(fit.store)
+    if not pending:
+        return
+    chains_left = {store: fit.chains for store, fit in remaining.items()}
+    in_use = {store: 0 for store in remaining}    # cores used by each fit
+    free = max_cores
+    finished = queue.Queue()
+
+    # 'fork' so the workers inherit `_MODELS`. One task per worker process so a
+    # finished chain gives back all of its memory.
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes=max(1, min(len(pending), max_cores)), maxtasksperchild=1) as pool:
+        while pending or any(in_use.values()):
+            for task in list(pending):
+                store = str(task.store)
+                fits_free = task.threads <= free and in_use[store] + task.threads <= remaining[store].cores
+                # A chain larger than `max_cores` still runs, by itself.
+                if fits_free or not any(in_use.values()):
+                    pending.remove(task)
+                    free -= task.threads
+                    in_use[store] += task.threads
+                    pool.apply_async(_sample_chain, (task,), callback=finished.put,
+                                     error_callback=finished.put)
+            store = finished.get()
+            if isinstance(store, BaseException):
+                raise store
+            free += remaining[store].threads
+            in_use[store] -= remaining[store].threads
+            chains_left[store] -= 1
+            if chains_left[store] == 0:
+                yield remaining[store], _finish(store, remaining[store].chains)
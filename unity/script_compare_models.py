@@ -0,0 +1,55 @@
+""" script_compare_models.py - Check stan_code_fast.txt against stan_code_simple.txt.
+
+Run `docs/source/simple_test_dataset.py` first to make `test_simple_300_obs.pkl`,
+then `python -m unity.script_compare_models [data.pkl]` in its directory.
+
+The two models should have the same log density at every point, so both are
+evaluated at draws from a fit of the fast model. Then both models are fit and
+the posterior means compared.
+"""
+import pickle
+import sys
+import time
+
+import numpy as np
+
+from unity import cosmology, sampler, unity
+
+file_name = sys.argv[1] if len(sys.argv) > 1 else 'test_simple_300_obs.pkl'
+data = pickle.load(open(file_name, 'rb'))
+data['model_mu'] = cosmology.model_mu(data)
+PARS = ['MB', 'coeff', 'sigma_int', 'outl_frac']
+
+
+def se_mean(fit, key):
+    """The Monte Carlo error of the posterior mean of `key`, from its effective sample size."""
+    summary = fit.summary(pars=[key])
+    return summary['summary'][:, list(summary['summary_colnames']).index('se_mean')]
+
+
+models, fits, times = {}, {}, {}
+for model in ['stan_code_simple.txt', 'stan_code_fast.txt']:
+    sm = models[model] = unity.compile(unity.UNITY_DIR/model)
+    start = time.perf_counter()
+    fits[model] = sm.sampling(data=data, iter=2000, chains=4, seed=13048293)
+    times[model] = time.perf_counter() - start
+simple, fast = fits['stan_code_simple.txt'], fits['stan_code_fast.txt']
+
+# Same point, same log density (up to floating point).
+draws = fast.extract(permuted=True)
+diffs = []
+for i in range(0, len(draws['lp__']), 100):
+    point = {key: draws[key][i] for key in sampler.parameter_names(models['stan_code_simple.txt'].model_code)}
+    upars = simple.unconstrain_pars(point)
+    diffs.append(simple.log_prob(upars) - fast.log_prob(upars))
+print(f'Largest log density difference: {np.max(np.abs(diffs)):.2e}')
+
+
+# Same posterior, to within the Monte Carlo error.
+simple_draws, fast_draws = simple.extract(PARS), fast.extract(PARS)
+for key in PARS:
+    a, b = simple_draws[key], fast_draws[key]
+    z = (a.mean(axis=0) - b.mean(axis=0))/np.hypot(se_mean(simple, key), se_mean(fast, key))
+    print(f'{key:>10}: simple {a.mean(axis=0)}, fast {b.mean(axis=0)}, z = {z}')
+
+print(f'Sampling time: simple {times["stan_code_simple.txt"]:.0f} s, fast {times["stan_code_fast.txt"]:.0f} s')
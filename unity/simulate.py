@@ -0,0 +1,142 @@
+""" simulate.py - Synthetic UNITY datasets, drawn from the model itself.
+
+`simulate` draws the true properties of each SN from the population, its
+standardized magnitude from the Tripp-like relation of the Stan models with
+an intrinsic dispersion, and outliers from the broader distribution the models
+assume (0.25 mag^2 more variance in mB). Everything is drawn at once, per
+property, with a seeded `numpy.random.RandomState`, so 100k SNe take a small
+fraction of a second.
+
+The dataset and the true values are returned, and saved with `save`, together.
+"""
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+from . import cosmology, dataset
+
+# The measurement errors of mB, x1 and c, then of each host property.
+ERRORS = (0.05, 0.3, 0.04)
+HOST_ERROR = 0.3
+
+# The coefficients of x1 and c, then of each host property, in mB.
+COEFF = (-0.14, 3.)
+HOST_COEFF = 0.05
+
+# The extra mB variance of an outlier, as in the Stan models.
+OUTLIER_VARIANCE = 0.25
+
+
+def simulate(n_sne: int = 300, n_props: int = 3, n_sn_set: int = 1, outl_frac: float = 0.02, n_age_mix: int = 0,
+             seed: int = None, MB: float = -19.1, sigma_int: float = 0.1, z_range: tuple = (0.01, 1.)) -> (dict, dict):
+    """Draw a dataset.
+
+    Parameters:
+        n_sne (int):
+            The number of SNe.
+
+        n_props (int):
+            mB, x1, c and then host properties, e.g. 5 for host mass and age.
+            With `n_age_mix` > 0 the last one is an age, observed as a
+            Gaussian mixture.
+
+        n_sn_set (int):
+            The number of samples. Each SN is in a random one, and each sample
+            has its own MB, offset by 0.05 mag per sample.
+
+        outl_frac (float):
+            The fraction of outliers, at most 0.1 as in the Stan models.
+
+        n_age_mix (int):
+            Components of each age mixture, 0 for only Gaussian properties.
+
+        seed (int):
+            Seed of the generator.
+
+        MB, sigma_int (float):
+            The absolute magnitude of the first sample and the intrinsic dispersion.
+
+        z_range (tuple of float):
+            Redshifts are uniform in this range.
+
+    Returns:
+        (tuple of dict):
+            The dataset, e.g. for `unity run` or `dataset.save_dataset`, and the
+            true values: `MB`, `coeff`, `sigma_int`, `outl_frac`, `props`
+            (x1, c and host properties per SN), `mB`, `outlier` and `z`.
+    """
+    n_non_gaus = int(n_age_mix > 0)
+    if n_props - n_non_gaus < 3:
+        raise ValueError(f'n_props must be at least {3 + n_non_gaus}, mB, x1 and c are always observed.')
+    if not 0 <= outl_frac <= 0.1:
+        raise ValueError('outl_frac must be between 0 and 0.1, the bounds of the Stan models.')
+    rng = np.random.RandomState(seed)
+    n_gaus = n_props - n_non_gaus
+
+    # True values. x1, c and standardized host properties.
+    props = rng.randn(n_sne, n_props - 1)
+    props[:, 1] *= 0.1
+    coeff = np.concatenate((COEFF, np.full(n_props - 3, HOST_COEFF)))
+    sn_set_inds = rng.randint(0, n_sn_set, n_sne)
+    MB_set = MB + 0.05*np.arange(n_sn_set)
+    z = rng.uniform(*z_range, n_sne)
+    outlier = rng.rand(n_sne) < outl_frac
+    mB = (MB_set[sn_set_inds] + props @ coeff + cosmology.distance_modulus(z, z) + rng.randn(n_sne)*sigma_int
+          + outlier*rng.randn(n_sne)*np.sqrt(OUTLIER_VARIANCE))
+
+    # Observed values, with errors that vary by up to 50% between SNe.
+    errors = np.concatenate((ERRORS, np.full(n_props - 3, HOST_ERROR)))[:n_gaus]*rng.uniform(0.5, 1.5, (n_sne, 1))
+    obs = np.column_stack((mB, props[:, :n_gaus - 1])) + rng.randn(n_sne, n_gaus)*errors
+    cov = np.zeros((n_sne, n_gaus, n_gaus))
+    cov[:, np.arange(n_gaus), np.arange(n_gaus)] = errors**2
+
+    shape = (n_non_gaus, n_sne, n_age_mix)
+    if n_non_gaus:
+        # Each component is near the true age, with a weight from a flat Dirichlet.
+        age_gaus_mean = (props[:, -1:] + rng.randn(n_sne, n_age_mix)*HOST_ERROR)[None]
+        age_gaus_std = rng.uniform(0.5, 1.5, shape)*HOST_ERROR
+        age_gaus_A = rng.dirichlet(np.ones(n_age_mix), n_sne)[None]
+    else:
+        age_gaus_mean, age_gaus_std, age_gaus_A = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+
+    data = dict(n_sne=n_sne, n_props=n_props, n_non_gaus_props=n_non_gaus, n_sn_set=n_sn_set,
+                sn_set_inds=sn_set_inds, z_helio=z, z_CMB=z, obs_mBx1c=obs, obs_mBx1c_cov=cov,
+                n_age_mix=n_age_mix, age_gaus_mean=age_gaus_mean, age_gaus_std=age_gaus_std, age_gaus_A=age_gaus_A,
+                do_fullDint=0, outl_frac_prior_lnmean=-4.6, outl_frac_prior_lnwidth=1., lognormal_intr_prior=0,
+                allow_alpha_S_N=0, names=np.char.add('sim', np.arange(n_sne).astype(str)))
+    truth = dict(MB=MB_set, coeff=coeff, sigma_int=sigma_int, outl_frac=outl_frac, props=props, mB=mB,
+                 outlier=outlier, z=z)
+    return data, truth
+
+
+def save(name, data: dict, truth: dict, output_format: str = 'unity') -> (Path, Path):
+    """Save a dataset and its true values side by side.
+
+    Parameters:
+        name (pathlib.Path):
+            The prefix, the files are `{name}_obs.unity` (or `{name}_obs.pkl`)
+            and `{name}_true.npz`.
+
+        data, truth (dict):
+            From `simulate`.
+
+        output_format (str):
+            `unity` for a dataset, see `dataset.py`, or `pkl` for a pickle.
+
+    Returns:
+        (tuple of pathlib.Path):
+            The dataset and the true values.
+    """
+    name = str(name)
+    if output_format == 'unity':
+        data_path = dataset.save_dataset(f'{name}_obs{dataset.SUFFIX}', data)
+    elif output_format == 'pkl':
+        data_path = Path(f'{name}_obs.pkl')
+        with open(data_path, 'wb') as f:
+            pickle.dump(data, f)
+    else:
+        raise ValueError(f'Unknown format {output_format}, use unity or pkl.')
+    truth_path = Path(f'{name}_true.npz')
+    np.savez(truth_path, **truth)
+    return Path(data_path), truth_path
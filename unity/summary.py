@@ -0,0 +1,204 @@
+""" summary.py - Summary statistics and convergence diagnostics of a fit.
+
+A vectorized replacement for pystan's `print(fit)`, computed from the draws on
+disk (see `draws.py`). For each scalar it gives the mean, sd, quantiles,
+split R-hat and the bulk and tail effective sample sizes, following the
+rank-normalized diagnostics of Vehtari et al. (2021), the same as Stan's.
+
+Large parameters, such as the per-SN `outl_loglike`, are skipped unless they
+are asked for, see `summarize`. Their columns are then computed a block at a
+time from the memory-mapped draws.
+"""
+import csv
+import io
+import json
+from collections import namedtuple
+
+import numpy as np
+from scipy import special, stats
+
+QUANTILES = (2.5, 25, 50, 75, 97.5)
+COLUMNS = ['mean', 'sd'] + [f'{q}%' for q in QUANTILES] + ['r_hat', 'ess_bulk', 'ess_tail']
+
+# Parameters with more than this many values per draw are only summarized when asked for.
+MAX_SIZE = 64
+
+# How many scalars are read, and summarized, at once.
+BLOCK_SIZE = 64
+
+# One row per scalar, `labels` in pystan's zero-indexed `name[i,j]` style,
+# `values` of shape (len(labels), len(columns)).
+Summary = namedtuple('Summary', 'labels columns values')
+
+
+def _split(x: np.ndarray) -> np.ndarray:
+    """Split each chain in two, (chains, draws, n) to (2*chains, draws//2, n).
+
+    The middle draw of an odd length chain is dropped.
+    """
+    half = x.shape[1]//2
+    return np.concatenate((x[:, :half], x[:, x.shape[1] - half:]))
+
+
+def _rank_normalize(x: np.ndarray) -> np.ndarray:
+    """Normal scores of the ranks, pooled over chains, of each scalar."""
+    ranks = stats.rankdata(x.reshape((-1, x.shape[-1])), axis=0).reshape(x.shape)
+    return special.ndtri((ranks - 3/8)/(ranks.size/x.shape[-1] + 1/4))
+
+
+def _r_hat(x: np.ndarray) -> np.ndarray:
+    """The (not split) R-hat of each scalar, x of shape (chains, draws, n)."""
+    n = x.shape[1]
+    between = n*x.mean(axis=1).var(axis=0, ddof=1)
+    within = x.var(axis=1, ddof=1).mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(((n - 1)/n*within + between/n)/within)
+
+
+def _ess(x: np.ndarray) -> np.ndarray:
+    """The effective sample size of each scalar, x of shape (chains, draws, n).
+
+    Uses Geyer's initial monotone sequence on the autocorrelation, combined
+    over chains as in Stan.
+    """
+    chains, n = x.shape[:2]
+    centered = x - x.mean(axis=1, keepdims=True)
+    # Autocovariance of each chain through an FFT, zero padded to avoid wrapping.
+    size = 2**int(np.ceil(np.log2(2*n)))
+    spectrum = np.fft.rfft(centered, n=size, axis=1)
+    acov = np.fft.irfft(spectrum*np.conj(spectrum), n=size, axis=1)[:, :n]/n
+    mean_var = acov[:, 0].mean(axis=0)*n/(n - 1)
+    var_plus = mean_var*(n - 1)/n
+    if chains > 1:
+        var_plus = var_plus + x.mean(axis=1).var(axis=0, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = 1 - (mean_var - acov.mean(axis=0))/var_plus
+    rho[0] = 1
+    # Sums of adjacent pairs, kept until the first negative one, and made monotone.
+    pairs = rho[:n - n % 2:2] + rho[1:n - n % 2:2]
+    positive = np.cumprod(pairs > 0, axis=0).astype(bool)
+    pairs = np.minimum.accumulate(np.where(positive, pairs, np.inf), axis=0)
+    tau = -1 + 2*np.where(positive, pairs, 0).sum(axis=0)
+    # Bound it for antithetic chains, as Stan does.
+    tau = np.maximum(tau, 1/np.log10(chains*n))
+    return np.where(np.isfinite(var_plus) & (var_plus > 0), chains*n/tau, np.nan)
+
+
+def diagnostics(x: np.ndarray) -> np.ndarray:
+    """Rank-normalized split R-hat, bulk ESS and tail ESS of each scalar.
+
+    Parameters:
+        x (np.ndarray):
+            Shape (chains, draws, n).
+
+    Returns:
+        (np.ndarray):
+            Shape (3, n), R-hat, bulk ESS and tail ESS.
+    """
+    split = _split(x)
+    if split.shape[1] < 4:
+        return np.full((3, x.shape[-1]), np.nan)
+    folded = np.abs(split - np.median(split.reshape((-1, x.shape[-1])), axis=0))
+    r_hat = np.maximum(_r_hat(_rank_normalize(split)), _r_hat(_rank_normalize(folded)))
+    ess_bulk = _ess(_rank_normalize(split))
+    lower, upper = np.percentile(split.reshape((-1, x.shape[-1])), [5, 95], axis=0)
+    ess_tail = np.minimum(_ess((split <= lower).astype(float)), _ess((split <= upper).astype(float)))
+    return np.vstack((r_hat, ess_bulk, ess_tail))
+
+
+def _labels(key: str, shape: tuple) -> list:
+    return [f"{key}[{','.join(map(str, index))}]" if shape else key for index in np.ndindex(*shape)]
+
+
+def _summarize_draws(value, draws_per_chain: list) -> np.ndarray:
+    """The rows of one parameter saved as draws, shape (draws, *dims)."""
+    value = value.reshape((value.shape[0], -1))
+    # Diagnostics need chains of the same length, use the shortest.
+    n = min(draws_per_chain)
+    starts = np.cumsum([0] + list(draws_per_chain[:-1]))
+    rows = []
+    for block in range(0, value.shape[1], BLOCK_SIZE):
+        x = np.asarray(value[:, block:block + BLOCK_SIZE], dtype=float)
+        rows.append(np.vstack((x.mean(axis=0), x.std(axis=0, ddof=1), np.percentile(x, QUANTILES, axis=0),
+                               diagnostics(np.stack([x[start:start + n] for start in starts])))).T)
+    return np.concatenate(rows)
+
+
+def _summarize_streamed(summary: dict) -> np.ndarray:
+    """The rows of one parameter kept as a streamed summary, see `online.combine`.
+
+    The quantiles are from a subsample of the draws, there are no diagnostics.
+    """
+    levels = list(summary['quantile_levels'])
+    quantiles = summary['quantiles'][[levels.index(q) for q in QUANTILES]].reshape((len(QUANTILES), -1))
+    return np.vstack((summary['mean'].reshape((1, -1)), summary['sd'].reshape((1, -1)), quantiles,
+                      np.full((3, quantiles.shape[1]), np.nan))).T
+
+
+def summarize(draws, pars: list = None) -> Summary:
+    """Summarize a fit.
+
+    Parameters:
+        draws (draws.Draws or dict):
+            The fit, see `draws.load_draws`. A dict of arrays is treated as one chain.
+
+        pars (list of str):
+            The parameters to summarize, saved as draws or as streamed
+            summaries. By default every one with at most `MAX_SIZE` values
+            per draw.
+
+    Returns:
+        (Summary):
+            One row per scalar.
+    """
+    streamed = list(getattr(draws, 'summaries', []))
+    if pars is None:
+        pars = [key for key in draws if np.prod(draws[key].shape[1:], dtype=int) <= MAX_SIZE]
+        pars += [key for key in streamed if np.prod(draws.summary(key)['mean'].shape, dtype=int) <= MAX_SIZE]
+    unknown = [key for key in pars if key not in draws and key not in streamed]
+    if unknown:
+        raise KeyError(f"{', '.join(unknown)} not in the fit.")
+
+    draws_per_chain = getattr(draws, 'draws_per_chain', None)
+    labels, rows = [], []
+    for key in pars:
+        if key in draws:
+            value = draws[key]
+            rows.append(_summarize_draws(value, draws_per_chain or [value.shape[0]]))
+            labels += _labels(key, value.shape[1:])
+        else:
+            summary = draws.summary(key)
+            rows.append(_summarize_streamed(summary))
+            labels += _labels(key, summary['mean'].shape)
+    values = np.concatenate(rows) if rows else np.zeros((0, len(COLUMNS)))
+    return Summary(labels, COLUMNS, values)
+
+
+def to_text(summary: Summary) -> str:
+    """A fixed width table, similar to `print(fit)`."""
+    lines = [f"{'':<20}" + ''.join(f'{column:>9}' for column in summary.columns)]
+    for label, row in zip(summary.labels, summary.values):
+        # The ESS columns are counts.
+        lines.append(f'{label:<20}' + ''.join(f'{x:>9.2f}' for x in row[:-2])
+                     + ''.join(f'{x:>9.0f}' for x in row[-2:]))
+    return '\n'.join(lines)
+
+
+def to_csv(summary: Summary) -> str:
+    """A CSV table, with a `name` column, missing values are empty."""
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator='\n')
+    writer.writerow(['name'] + summary.columns)
+    for label, row in zip(summary.labels, summary.values):
+        writer.writerow([label] + ['' if np.isnan(x) else repr(float(x)) for x in row])
+    return text.getvalue()
+
+
+def to_json(summary: Summary) -> str:
+    """A JSON object of name to an object of column to value, missing values are null."""
+    table = {label: {column: None if np.isnan(x) else float(x) for column, x in zip(summary.columns, row)}
+             for label, row in zip(summary.labels, summary.values)}
+    return json.dumps(table, indent=2)
+
+
+FORMATS = {'text': to_text, 'csv': to_csv, 'json': to_json}
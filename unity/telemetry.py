@@ -0,0 +1,181 @@
+""" telemetry.py - Sampler performance statistics of a fit.
+
+Each chain keeps running totals of its sampler diagnostics, from pystan's
+`get_sampler_params`, and of the time spent in `sampling`, updated with every
+segment (see `sampler.py`) and saved in its checkpoints. Once the fit is done
+`report` combines them, with the effective sample sizes of the draws, into
+`telemetry.json` in the draw store:
+
+* the wall time of warmup and of sampling,
+* leapfrog steps (gradient evaluations) per second,
+* the mean and largest tree depth and the number of divergent transitions,
+* the adapted step size,
+* the peak memory of each chain, and their sum for the fit,
+* the bulk ESS per second of sampling of each hyperparameter.
+
+pystan does not time warmup by itself. The first segment of a chain includes
+warmup, so its time is split between warmup and sampling in proportion to
+their leapfrog steps.
+
+A chain runs in a worker process forked from the parent, and starts with
+the parent's pages, and its peak resident memory. So each chain resets its
+peak when it starts (see `reset_peak_rss`), and records only the memory it
+added above what it inherited. Summed over the chains, that is what the fit
+needs with all of its chains running at once, on top of the parent. This
+reads `/proc/self`, so it is only recorded on Linux.
+"""
+import numpy as np
+
+from . import summary
+
+
+def new() -> dict:
+    """The totals of a chain that has not sampled yet."""
+    return {'warmup_seconds': 0., 'sampling_seconds': 0., 'warmup_leapfrog': 0, 'sampling_leapfrog': 0,
+            'draws': 0, 'treedepth_sum': 0, 'max_treedepth': 0, 'divergent': 0, 'stepsize': None,
+            'peak_rss_mb': None}
+
+
+def _status_mb(field: str) -> float:
+    """A memory field of `/proc/self/status`, e.g. `VmHWM`, in MB, None if it can not be read."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])/2**10    # in kB
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> float:
+    """Reset the peak resident memory of this process to its current one, and return that in MB.
+
+    Returns None where this is not supported (not Linux).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return _status_mb('VmRSS')
+
+
+def peak_rss_mb(base: float) -> float:
+    """The peak resident memory of this process since `reset_peak_rss`, above its `base`, in MB."""
+    peak = _status_mb('VmHWM')
+    return None if base is None or peak is None else max(peak - base, 0.)
+
+
+def update(totals: dict, sampler_params: dict, n_warmup: int, seconds: float, peak_rss_mb: float = None) -> dict:
+    """Add one segment of a chain to its totals.
+
+    Parameters:
+        totals (dict):
+            From `new`, or a previous `update`.
+
+        sampler_params (dict):
+            The segment's `fit.get_sampler_params(inc_warmup=True)[0]`.
+
+        n_warmup (int):
+            How many of the segment's iterations were warmup.
+
+        seconds (float):
+            The wall time of the segment's `sampling` call.
+
+        peak_rss_mb (float):
+            The chain's peak memory so far, see `peak_rss_mb`, if known.
+
+    Returns:
+        (dict):
+            The new totals.
+    """
+    leapfrog = np.asarray(sampler_params['n_leapfrog__'], dtype=np.int64)
+    treedepth = np.asarray(sampler_params['treedepth__'], dtype=np.int64)[n_warmup:]
+    warmup_leapfrog, sampling_leapfrog = int(leapfrog[:n_warmup].sum()), int(leapfrog[n_warmup:].sum())
+    warmup_seconds = seconds*warmup_leapfrog/max(warmup_leapfrog + sampling_leapfrog, 1)
+    stepsize = np.asarray(sampler_params['stepsize__'])[n_warmup:]
+    peaks = [peak for peak in (totals.get('peak_rss_mb'), peak_rss_mb) if peak is not None]
+    return {'warmup_seconds': totals['warmup_seconds'] + warmup_seconds,
+            'sampling_seconds': totals['sampling_seconds'] + seconds - warmup_seconds,
+            'warmup_leapfrog': totals['warmup_leapfrog'] + warmup_leapfrog,
+            'sampling_leapfrog': totals['sampling_leapfrog'] + sampling_leapfrog,
+            'draws': totals['draws'] + treedepth.size,
+            'treedepth_sum': totals['treedepth_sum'] + int(treedepth.sum()),
+            'max_treedepth': max(totals['max_treedepth'], int(treedepth.max(initial=0))),
+            'divergent': totals['divergent'] + int(np.sum(np.asarray(sampler_params['divergent__'])[n_warmup:])),
+            'stepsize': float(stepsize[-1]) if stepsize.size else totals['stepsize'],
+            'peak_rss_mb': max(peaks) if peaks else None}
+
+
+def _rate(count, seconds):
+    return count/seconds if seconds > 0 else None
+
+
+def chain_report(totals: dict) -> dict:
+    """The statistics of one chain, from its totals."""
+    return {'warmup_seconds': totals['warmup_seconds'], 'sampling_seconds': totals['sampling_seconds'],
+            'draws': totals['draws'],
+            'leapfrog_per_second': _rate(totals['warmup_leapfrog'] + totals['sampling_leapfrog'],
+                                         totals['warmup_seconds'] + totals['sampling_seconds']),
+            'mean_treedepth': totals['treedepth_sum']/totals['draws'] if totals['draws'] else None,
+            'max_treedepth': totals['max_treedepth'], 'divergent': totals['divergent'],
+            'stepsize': totals['stepsize'], 'peak_rss_mb': totals.get('peak_rss_mb')}
+
+
+def report(chains: list, draws=None) -> dict:
+    """The statistics of a fit.
+
+    Parameters:
+        chains (list of dict):
+            The totals of each chain, see `update`.
+
+        draws (draws.Draws):
+            The fit, for the ESS per second of the parameters `summary.summarize`
+            includes by default.
+
+    Returns:
+        (dict):
+            `chains`, the statistics of each chain, `total`, those of the fit
+            with the times and peak memory summed over chains, and `ess_bulk_per_second`,
+            scalar label to the bulk ESS of the fit per second of sampling.
+    """
+    total = new()
+    for totals in chains:
+        for key in ('warmup_seconds', 'sampling_seconds', 'warmup_leapfrog', 'sampling_leapfrog', 'draws',
+                    'treedepth_sum', 'divergent'):
+            total[key] += totals[key]
+        total['max_treedepth'] = max(total['max_treedepth'], totals['max_treedepth'])
+    peaks = [totals.get('peak_rss_mb') for totals in chains]
+    total['peak_rss_mb'] = None if None in peaks or not peaks else sum(peaks)
+    fit = chain_report(total)
+    del fit['stepsize']
+    ess = {}
+    if draws is not None and len(draws):
+        fit_summary = summary.summarize(draws)
+        column = fit_summary.columns.index('ess_bulk')
+        ess = {label: _rate(float(row[column]), total['sampling_seconds'])
+               for label, row in zip(fit_summary.labels, fit_summary.values) if np.isfinite(row[column])}
+    return {'chains': [chain_report(totals) for totals in chains], 'total': fit, 'ess_bulk_per_second': ess}
+
+
+def progress(name: str, chain_id: int, done: int, n_draws: int, totals: dict) -> str:
+    """A one line progress report of a chain of the fit `name`."""
+    stats = chain_report(totals)
+    rate = stats['leapfrog_per_second']
+    return (f'{name} chain {chain_id}: {done}/{n_draws} draws, '
+            f"{'-' if rate is None else f'{rate:.0f}'} leapfrog/s, {stats['divergent']} divergent, "
+            f"tree depth {stats['mean_treedepth'] or 0:.1f}, step size {stats['stepsize'] or 0:.3g}")
+
+
+def to_text(telemetry: dict) -> str:
+    """A short summary of the `report` of a fit."""
+    total = telemetry['total']
+    rate = total['leapfrog_per_second']
+    lines = [f"Warmup {total['warmup_seconds']:.1f} s, sampling {total['sampling_seconds']:.1f} s over "
+             f"{len(telemetry['chains'])} chains, {'-' if rate is None else f'{rate:.0f}'} leapfrog/s, "
+             f"{total['divergent']} divergent, mean tree depth {total['mean_treedepth'] or 0:.1f}."]
+    if telemetry['ess_bulk_per_second']:
+        slowest = min(telemetry['ess_bulk_per_second'].items(), key=lambda item: item[1] or 0)
+        lines.append(f'Lowest bulk ESS per second: {slowest[0]}, {slowest[1] or 0:.2f}.')
+    return '\n'.join(lines)
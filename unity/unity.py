@@ -1,29 +1,96 @@
 """ unity.py - The main code to run the Unity stan model.
 """
-import gzip
+import fcntl
+import os
 import pickle
-#TODO transition from os.path fully to pathlib
-from os import path, makedirs, sys
+import platform
+import subprocess
+import sysconfig
+from contextlib import contextmanager
+from os import makedirs, sys
 from pathlib import Path
 from hashlib import sha1
 
 import pystan
-import numpy as np
+
+from . import cv, dataset, incremental, inits, loo, results, sampler, summary, telemetry, validate
+from . import draws as draw_store
 
 CWD = Path.cwd()
 UNITY_DIR = Path(__file__).resolve().parent
 
+# Models that integrate out `true_x1cs`, so every property must be Gaussian.
+MARGINAL_MODELS = {'stan_code_marginal.txt'}
+
+# Models with only sigma_int in the [1,1] element of the model covariance, see `likelihood.py`.
+RANK1_MODELS = {'stan_code_fast.txt', 'stan_code_map_rect.txt', 'stan_code_marginal.txt'}
+
+# The data passed to Stan.
+STAN_VARS = list(validate.SCHEMA)
+
+# The Stan outputs that are saved, see `resolve_pars`.
+# Per-SN outputs (N_SN values per draw) dominate the size of a fit, so by default
+# `outl_loglike` is only kept as a streamed summary (mean, quantiles and P(outlier)), see `online.py`.
+HYPER_PARS = ['MB', 'coeff_angles', 'sigma_int', 'outl_frac', 'coeff']
+# Preset name to (pars saved as draws, pars kept as streamed summaries).
+PARS_PRESETS = {
+    'summary-only': (HYPER_PARS, []),
+    'outliers': (HYPER_PARS, ['outl_loglike']),
+    'full': (HYPER_PARS + ['x1c_star', 'x1c_pop_cov_mat', 'R_x1c', 'outl_loglike', 'PointPosteriors', 'log_lik'], []),
+    'loo': (HYPER_PARS + ['x1c_star', 'x1c_pop_cov_mat', 'log_lik'], ['outl_loglike']),
+}
+PARS = 'outliers'
+
+
+def _par_list(pars) -> list:
+    # A list, or a comma separated string, of names.
+    if isinstance(pars, str):
+        pars = pars.split(',')
+    return [par.strip() for par in pars if par.strip()]
+
+
+def resolve_pars(pars=PARS, summarize=None) -> (list, list):
+    """The Stan outputs to save as draws, and those to keep as streamed summaries.
+
+    Parameters:
+        pars (str or list of str):
+            A preset of `PARS_PRESETS`, or the Stan outputs to save as draws,
+            as a list or a comma separated string.
+
+        summarize (str or list of str):
+            Stan outputs to keep only as streamed summaries, in addition to
+            those of the preset. These are not also saved as draws.
+
+    Returns:
+        (tuple of list):
+            The parameters to save as draws, and those to summarize.
+    """
+    if isinstance(pars, str) and pars in PARS_PRESETS:
+        pars, preset_summarize = PARS_PRESETS[pars]
+    else:
+        pars, preset_summarize = _par_list(pars), []
+        unknown = [par for par in pars if not par.isidentifier()]
+        if unknown:
+            raise ValueError(f"unknown pars {', '.join(unknown)}, use Stan output names or one of "
+                             f"{', '.join(PARS_PRESETS)}.")
+    summarize = list(dict.fromkeys(preset_summarize + _par_list(summarize or [])))
+    return [par for par in pars if par not in summarize], summarize
+
+
 # todo if the datasets are stored in another directory, how do we just
 # get the file name to store matching fit files?
 #TODO type annotate and add doc strings
-def run(model, data, steps, chains, interactive, max_cores=1):
+def run(model, data, steps, chains, interactive, max_cores=1, chunk_size=1000, resume=False,
+        cache=None, threads_per_chain=1, mu_table=None, pars=PARS, summarize=None, rerun=False, seed=None,
+        progress=False, init='random', init_jitter=inits.JITTER, warmup=None):
     """
     Parameters:
         model (str):
             A string represintation of the relative path of the stan model from the Unity directory.
         
         data (str):
-            A string representation of the relative path of the data pickel file from the cwd.
+            A string representation of the relative path of the data pickel file, or
+            `.unity` dataset (see `dataset.py`), from the cwd.
             
         steps (int):
         
@@ -34,113 +101,649 @@ def run(model, data, steps, chains, interactive, max_cores=1):
             interactively explore the space after the model has been fit.
 
         max_cores (int):
+            How many chains are sampled at once, each in its own worker process.
+
+        chunk_size (int):
+            How many draws each chain samples, and writes to disk, at a time.
+            Each chain saves a checkpoint after every chunk.
+
+        resume (bool):
+            Continue an interrupted fit from the checkpoints in `{data}_fitparams/`,
+            without redoing warmup.
+
+        cache (str):
+            The compiled model cache directory, see `cache_dir`.
+
+        threads_per_chain (int):
+            Threads used within each chain, for models that use `map_rect`
+            such as `stan_code_map_rect.txt`. The model is then compiled with
+            `STAN_THREADS`. `max_cores` is shared out, so
+            `max_cores//threads_per_chain` chains run at once.
+
+        mu_table (str):
+            A text file of redshift and distance modulus, relative to the cwd,
+            to interpolate `model_mu` from, replacing any in the data file. By
+            default `model_mu` is taken from the data file, or else from
+            `cosmology.distance_modulus`.
+
+        pars, summarize (str or list of str):
+            The Stan outputs saved as draws, and those kept only as streamed
+            summaries, see `resolve_pars`.
+
+        rerun (bool):
+            Sample even if an identical fit is in the result cache, see `results.py`.
+
+        seed (int):
+            The seed of the fit, each chain gets a seed derived from it, see
+            `sampler.chain_seed`. Random if None. The seeds used are saved in
+            `{data}_fitparams/meta.json`.
+
+        progress (bool):
+            Print each chain's step rate, divergences, tree depth and step
+            size after every chunk. These are saved in
+            `{data}_fitparams/telemetry.json` either way, see `telemetry.py`.
+
+        init (str):
+            Where the chains start: `random`, `map`, `advi` or a previous
+            fit's `*_fitparams`, relative to the cwd, see `inits.py`.
+
+        init_jitter (float):
+            How far apart the chains start around `init`, see `inits.jitter`.
+
+        warmup (int):
+            Warmup iterations per chain, out of `steps`. By default half of
+            `steps`, a good `init` needs much less.
         
     Returns:
+        (draws.Draws):
+            The draws of every chain, memory-mapped from `{data}_fitparams/`.
     """
 
-    sm, stan_data = load(UNITY_DIR/model, CWD/data)
-    
-    # todo protect the user by filtering keys in stan_data. Remove any unneaded? Romove any with sting data? Any other tests?
-    stan_vars = ['n_sne', 'n_props', 'n_non_gaus_props', 'n_sn_set', 'sn_set_inds',
-                 'z_helio', 'z_CMB', 'obs_mBx1c', 'obs_mBx1c_cov', 'n_age_mix', 'age_gaus_mean',
-                 'age_gaus_std', 'age_gaus_A', 'do_fullDint', 'outl_frac_prior_lnmean',
-                 'outl_frac_prior_lnwidth', 'lognormal_intr_prior', 'allow_alpha_S_N']
-    stan_data = dict((i, stan_data[i]) for i in stan_vars)
-    for key in stan_data:
-        if np.isnan(stan_data[key]).any() or np.isinf(stan_data[key]).any():
-            sys.exit(f"{key} contains an infinity or NaN value.")
-    # Why these setting?
-    #
-    # * Using `n_jobs=1` so that the chains run in series not parallel.
-    # There is a bug in multiprocess and/or pickle. There is a signed integer 32-bit array limit
-    # Looks like Python 3.8 might have a patch for this.
-    # Other patches could be Python 3.9 where they are changing pickle, multiprocessing and the GIL more
-    # Or pystan could check before sampling if they will get an array that is too long.
-    # This is currently not done in pystan 2.19.0.0.
-    # Failures occur with `stan_code_simple_debug.txt` and N_SN = 142. Seems to work with N < 100
-    # CHANGE! when Python fixes limit.
-    #
-    # * Using `par` to only save the data we need for the paper.
-    # This is because with N > 194 (was ok with N = 142) the file size is too large for pickle. Maybe?
-    # Todo(make pars be user definable, but default to what is below.)
-    fit = sm.sampling(data=stan_data, iter=steps, chains=chains, n_jobs=max_cores,
-                      pars=['MB', 'coeff_angles', 'sigma_int', 'outl_frac', 'coeff', 'outl_loglike'])
-    #TODO update to use pathlib
-    save(fit, path.splitext(path.basename(data))[0])
-
-    # Got a strange error: multiprocessing.pool.MaybeEncodingError: Error sending result: '[(0, <stanfit4anon_model_5d703b856fa2f28cab8159e4abe012f4_8855281629809236605.PyStanHolder object at 0x1320cb730>)]'. Reason: 'error("'i' format requires -2147483648 <= number <= 2147483647")'
-    # now changing it to a warning and skipping printing summary.
     try:
-        print(fit)    # before all else, print to screen.
-    except MaybeEncodingError as e:
-        print("An error occurred.\n", e, "\n\nNo summary available.")
+        init = resolve_init(init)
+        sampler.check_warmup(steps, warmup)
+        pars, summarize = resolve_pars(pars, summarize)
+        raw_data = read_data(CWD/data, UNITY_DIR/model)
+        stan_data = prepare_data(raw_data, threads_per_chain, None if mu_table is None else CWD/mu_table)
+    except ValueError as err:
+        sys.exit(str(err))
+
+    store = CWD/f'{Path(data).stem}_fitparams'
+    # Fix the seed now, so an unseeded run is keyed by the seed it samples with, and never reuses
+    # another unseeded run. The start points are reproduced by it too.
+    seed = sampler.fit_seed(seed, store, chains, resume)
+    key = fit_key(model, stan_data, steps, chains, chunk_size, seed, pars, summarize, init, init_jitter, warmup)
+    if not rerun and results.restore(key, results_dir(cache), store):
+        print(f'Reusing the identical fit {key[:12]} from the result cache, use --rerun to sample again.')
+        draws = draw_store.Draws(store)
+    else:
+        sm = load_model(UNITY_DIR/model, cache, threads=threads_per_chain > 1)
+        start = inits.initial_values(init, sm, stan_data, chains, seed, init_jitter)
+        # Each chain runs in its own worker process, see `sampler.py`.
+        # pystan's `n_jobs` sends each chain back to the parent through a pickle, and that pickle
+        # overflows its signed 32-bit length for N_SN > ~150. The workers write their draws to disk instead.
+        draws = sampler.run_chains(sm, stan_data, steps, chains, max_cores, pars=pars, store=store,
+                                   seed=seed, chunk_size=chunk_size, resume=resume,
+                                   threads_per_chain=threads_per_chain, summarize=summarize, progress=progress,
+                                   init=start, warmup=warmup)
+        _save_sn_names(store, raw_data.get('names'))
+        _save_log_lik_info(store, model, stan_data)
+        results.save(key, results_dir(cache), store, dict(model=model, data=str(data)))
+    fit_summary = save(draws, Path(data).stem)
+    print(summary.to_text(fit_summary))    # before all else, print to screen.
+    if draws.telemetry() is not None:
+        print(telemetry.to_text(draws.telemetry()))
+    if draws.seeds is not None:
+        print(f"Seed {draws.seeds['seed']}, use --seed {draws.seeds['seed']} to sample the same draws again.")
 
     if interactive:
         import pdb; pdb.set_trace()    # noqa: E702
-    return fit
+    return draws
 
 
-def compile(stan_model: Path) -> pystan.StanModel:
-    """Compiles, and saves a cache, of a given stan model path.
-    stan_model: pathlib.Path
-        The path to the stan model.
+def sweep(model, datasets, steps, chains, max_cores=1, chunk_size=1000, resume=False, cache=None,
+          threads_per_chain=1, mu_table=None, pars=PARS, summarize=None, rerun=False, seed=None,
+          progress=False, init='random', init_jitter=inits.JITTER, warmup=None) -> dict:
+    """Fit several datasets with the same model and settings.
+
+    The model is loaded once, and every chain of every dataset is sampled in
+    one pool of `max_cores` cores. Each dataset gets its own
+    `{data}_fitparams/` and `{data}_results.txt` in the cwd, written as soon
+    as its chains are done.
+
+    Parameters:
+        model (str):
+            The Stan model, relative to the Unity directory.
+
+        datasets (list of str):
+            The data pickle files or datasets, relative to the cwd. Their file names must differ.
+
+        steps, chains, max_cores, chunk_size, resume, cache, threads_per_chain, mu_table, pars, summarize, rerun:
+            As in `run`, for every dataset.
 
+        seed (int):
+            As in `run`, every dataset is sampled with the same seed.
 
+        progress, init, init_jitter, warmup:
+            As in `run`. A previous fit as `init` is used for every dataset.
+
+    Returns:
+        (dict):
+            Output prefix, `{data}`, to its `draws.Draws`.
+    """
+    jobs = [dict(data=data, model=model, steps=steps, chains=chains, chunk_size=chunk_size, resume=resume,
+                 threads_per_chain=threads_per_chain, mu_table=mu_table, pars=pars, summarize=summarize,
+                 rerun=rerun, seed=seed, init=init, init_jitter=init_jitter, warmup=warmup)
+            for data in datasets]
+    return run_jobs(jobs, max_cores, cache, progress)
+
+
+def update(previous, model, data, steps, chains, max_cores=1, warmup=incremental.WARMUP, chunk_size=1000,
+           cache=None, threads_per_chain=1, mu_table=None, pars=PARS, summarize=None, seed=None, progress=False,
+           max_shift=incremental.MAX_SHIFT):
+    """Update a previous fit with the SNe added to its dataset, see `incremental.py`.
+
+    Parameters:
+        previous (str):
+            The previous fit's `*_fitparams`, relative to the cwd.
+
+        model, data, steps, chains, max_cores, chunk_size, cache, threads_per_chain, mu_table, pars, summarize:
+            As in `run`. `model` must be that of the previous fit, and `data`
+            must have every SN of it, matched by name.
+
+        warmup (int):
+            Warmup iterations per chain, out of `steps`.
+
+        seed (int):
+            As in `run`, also of the start points of the added SNe.
+
+        progress (bool):
+            As in `run`.
+
+        max_shift (float):
+            Warn that a full refit is needed if a hyperparameter moved by more
+            than this many previous posterior standard deviations.
+
+    Returns:
+        (draws.Draws):
+            The draws of every chain, memory-mapped from `{data}_fitparams/`.
+    """
+    store = CWD/f'{Path(data).stem}_fitparams'
+    try:
+        if not (CWD/previous/'meta.json').exists():
+            raise ValueError(f'{previous} is not a finished fit.')
+        if (CWD/previous).resolve() == store.resolve():
+            raise ValueError(f'The update would overwrite {previous}, give the new dataset another file name.')
+        previous = draw_store.Draws(CWD/previous)
+        sampler.check_warmup(steps, warmup)
+        pars, summarize = resolve_pars(pars, summarize)
+        raw_data = read_data(CWD/data, UNITY_DIR/model)
+        stan_data = prepare_data(raw_data, threads_per_chain, None if mu_table is None else CWD/mu_table)
+        sm = load_model(UNITY_DIR/model, cache, threads=threads_per_chain > 1)
+        seed = sampler.fit_seed(seed, store, chains)
+        init, adapt = incremental.start(previous, raw_data.get('names'), sm.model_code, stan_data, chains, seed)
+    except ValueError as err:
+        sys.exit(str(err))
+
+    n_added = stan_data['n_sne'] - len(previous.sn_names())
+    print(f'Updating {previous.path.name} with {n_added} added SNe, {warmup} warmup iterations per chain.')
+    draws = sampler.run_chains(sm, stan_data, steps, chains, max_cores, pars=pars, store=store, seed=seed,
+                               chunk_size=chunk_size, threads_per_chain=threads_per_chain, summarize=summarize,
+                               progress=progress, init=init, warmup=warmup, adapt=adapt)
+    _save_sn_names(store, raw_data.get('names'))
+    _save_log_lik_info(store, model, stan_data)
+    fit_summary = save(draws, Path(data).stem)
+    print(summary.to_text(fit_summary))
+    print(telemetry.to_text(draws.telemetry()))
+    print(f"Seed {draws.seeds['seed']}, use --seed {draws.seeds['seed']} to sample the same draws again.")
+    moved = incremental.needs_refit(incremental.shifts(previous, draws), max_shift)
+    if moved:
+        print('The hyperparameters moved too far for an update, refit with unity run:\n  ' + '\n  '.join(moved))
+    return draws
+
+
+def cross_validate(model, data, steps, chains, folds=cv.K, max_cores=1, chunk_size=1000, cache=None,
+                   threads_per_chain=1, mu_table=None, recenter=(), rerun=False, seed=None, progress=False):
+    """Fit the folds of a dataset, and score each on the SNe it leaves out, see `cv.py`.
+
+    The folds are made in memory and fit at once in one pool of `max_cores`
+    cores, all with the one loaded model. Each fold gets its own
+    `{data}_cv/{fold}_fitparams/` and `{data}_cv/{fold}_results.txt`, and
+    the scores are written to `{data}_cv_results.txt`, all in the cwd.
+    Folds identical to a fit in the result cache are not sampled again.
+
+    Parameters:
+        model, data, steps, chains, max_cores, chunk_size, cache, threads_per_chain, mu_table, rerun, progress:
+            As in `run`.
+
+        folds (int or str):
+            The number of random folds, see `cv.kfold`, or `sample` to leave
+            out one sample at a time, see `cv.by_sample`.
+
+        recenter (list of int):
+            Columns of `obs_mBx1c`, e.g. host mass, shifted by their mean over
+            the training SNe of each fold.
+
+        seed (int):
+            Of the folds and of every fit, see `run`.
+
+    Returns:
+        (cv.Result):
+            The held-out scores and the jackknife of the shared parameters.
+    """
+    # One seed, of the folds and of every fit, so an unseeded run reuses nothing, see `run`.
+    seed = sampler.fit_seed(seed, None, chains)
+    try:
+        raw_data = read_data(CWD/data, UNITY_DIR/model)
+        stan_data = prepare_data(raw_data, threads_per_chain, None if mu_table is None else CWD/mu_table)
+        if folds == 'sample':
+            held_out = cv.by_sample(stan_data['sn_set_inds'])
+            names = [f'sample{i}' for i in range(len(held_out))]
+        else:
+            held_out = cv.kfold(stan_data['sn_set_inds'], int(folds), seed)
+            names = [f'fold{i + 1}' for i in range(len(held_out))]
+        fold_list = [cv.split(stan_data, index, name, recenter) for name, index in zip(names, held_out)]
+        # The shards of stan_code_map_rect.txt depend on the number of SNe.
+        fold_list = [fold._replace(train=prepare_data(fold.train, threads_per_chain)) for fold in fold_list]
+    except ValueError as err:
+        sys.exit(str(err))
+
+    directory = CWD/f'{Path(data).stem}_cv'
+    directory.mkdir(exist_ok=True)
+    model_key = (model, threads_per_chain > 1)
+    fits, keys, reused = [], {}, set()
+    for fold in fold_list:
+        store = directory/f'{fold.name}_fitparams'
+        fit = sampler.Fit(model_key, fold.train, steps, chains, cv.PARS, [], store, seed, chunk_size, False,
+                          threads_per_chain, chains*threads_per_chain)
+        keys[store] = fit_key(model, fold.train, steps, chains, chunk_size, seed, cv.PARS, [])
+        if not rerun and results.restore(keys[store], results_dir(cache), store):
+            reused.add(store)
+        fits.append(fit)
+    todo = [fit for fit in fits if fit.store not in reused]
+    models = {model_key: load_model(UNITY_DIR/model, cache, threads=threads_per_chain > 1)} if todo else {}
+    print(f"Fitting {len(todo)} of {len(fits)} folds, {len(reused)} reused from the result cache.")
+    for fit, draws in sampler.run_fits(models, todo, max_cores, progress) if todo else ():
+        results.save(keys[fit.store], results_dir(cache), fit.store, dict(model=model, data=f'{data} {fit.store.name}'))
+
+    fold_draws = [draw_store.Draws(fit.store) for fit in fits]
+    # Every fold, reused ones too, as `run_jobs` does, so no results file is left from another fit.
+    for fit, draws in zip(fits, fold_draws):
+        save(draws, fit.store.name[:-len('_fitparams')], directory)
+    result = cv.score(fold_list, fold_draws)
+    text = cv.to_text(result, fold_list)
+    print(text)
+    with open(CWD/f'{Path(data).stem}_cv_results.txt', 'w') as f:
+        print(text, file=f)
+    print(f'Seed {seed}, use --seed {seed} to make the same folds and draws again.')
+    return result
+
+
+# The settings of one job for `run_jobs`, e.g. a `[[run]]` table of a config file, and their defaults.
+# `cores` defaults to all of the job's chains at once.
+JOB_DEFAULTS = dict(data=None, model='stan_code_simple.txt', steps=1000, chains=4, cores=None, pars=PARS,
+                    summarize=None, output='.', chunk_size=1000, resume=False, threads_per_chain=1,
+                    mu_table=None, rerun=False, seed=None, init='random', init_jitter=inits.JITTER, warmup=None)
+
+
+def run_jobs(jobs: list, max_cores: int = 1, cache=None, progress: bool = False) -> dict:
+    """Run several fits, each with its own settings, sharing `max_cores` cores.
+
+    Every chain of every job is scheduled in one pool of workers, see
+    `sampler.run_fits`. Each model is loaded once. A job writes
+    `{output}/{data}_fitparams/` and `{output}/{data}_results.txt` as soon as
+    its chains are done. Jobs identical to a fit in the result cache are
+    not sampled again, see `results.py`.
+
+    Parameters:
+        jobs (list of dict):
+            The settings of each job, see `JOB_DEFAULTS`. `data` is required.
+            Paths are relative to the cwd, `model` to the Unity directory.
+
+        max_cores (int):
+            The core budget shared by all jobs.
+
+        cache (str):
+            The compiled model cache directory, see `cache_dir`.
+
+        progress (bool):
+            Print the telemetry of each chain after every chunk, see `run`.
+
+    Returns:
+        (dict):
+            Output prefix, `{output}/{data}`, to its `draws.Draws`.
+    """
+    fits, models, keys, reused, starts, sn_names = [], {}, {}, set(), {}, {}
+    try:
+        for i, job in enumerate(jobs):
+            unknown = set(job) - set(JOB_DEFAULTS)
+            if unknown:
+                raise ValueError(f"unknown settings {', '.join(sorted(unknown))}.")
+            if job.get('data') is None:
+                raise ValueError('no data file given.')
+            job = dict(JOB_DEFAULTS, **job)
+            job['init'] = resolve_init(job['init'])
+            sampler.check_warmup(job['steps'], job['warmup'])
+            threads = job['threads_per_chain']
+            # A threaded model is a different compiled model.
+            model = (job['model'], threads > 1)
+            raw_data = read_data(CWD/job['data'], UNITY_DIR/job['model'])
+            stan_data = prepare_data(raw_data, threads, None if job['mu_table'] is None else CWD/job['mu_table'])
+            store = CWD/job['output']/f"{Path(job['data']).stem}_fitparams"
+            pars, summarize = resolve_pars(job['pars'], job['summarize'])
+            # Keyed by the seed it samples with, see `run`.
+            seed = sampler.fit_seed(job['seed'], store, job['chains'], job['resume'])
+            fit = sampler.Fit(model, stan_data, job['steps'], job['chains'], pars, summarize, store, seed,
+                              job['chunk_size'], job['resume'], threads, job['cores'] or job['chains']*threads,
+                              warmup=job['warmup'])
+            keys[store] = (fit_key(job['model'], stan_data, fit.steps, fit.chains, fit.chunk_size, fit.seed,
+                                   pars, summarize, job['init'], job['init_jitter'], fit.warmup),
+                           job['data'], job['rerun'])
+            starts[store] = job['init'], job['init_jitter']
+            sn_names[store] = raw_data.get('names')
+            fits.append(fit)
+    except ValueError as err:
+        sys.exit(f'Job {i + 1} ({jobs[i].get("data")}): {err}')
+    stores = [fit.store for fit in fits]
+    if len(set(stores)) != len(stores):
+        sys.exit('Jobs with the same output directory need data files with different names, '
+                 'their outputs are named after them.')
+
+    for fit in fits:
+        fit.store.parent.mkdir(parents=True, exist_ok=True)
+        key, _, rerun = keys[fit.store]
+        if not rerun and results.restore(key, results_dir(cache), fit.store):
+            reused.add(fit.store)
+        else:
+            models[fit.model] = None
+    for model, threads in models:
+        models[model, threads] = load_model(UNITY_DIR/model, cache, threads=threads)
+    # Start points need the compiled models, so only the fits to be sampled get them.
+    for i, fit in enumerate(fits):
+        if fit.store not in reused:
+            init, init_jitter = starts[fit.store]
+            fits[i] = fit._replace(init=inits.initial_values(init, models[fit.model], fit.data,
+                                                             fit.chains, fit.seed, init_jitter))
+
+    def finished():
+        # The cached fits, then the others as they finish.
+        for fit in fits:
+            if fit.store in reused:
+                yield fit, draw_store.Draws(fit.store)
+        todo = [fit for fit in fits if fit.store not in reused]
+        for fit, draws in sampler.run_fits(models, todo, max_cores, progress) if todo else ():
+            key, data, _ = keys[fit.store]
+            _save_sn_names(fit.store, sn_names[fit.store])
+            _save_log_lik_info(fit.store, fit.model[0], fit.data)
+            results.save(key, results_dir(cache), fit.store, dict(model=fit.model[0], data=str(data)))
+            yield fit, draws
+
+    done = {}
+    for fit, draws in finished():
+        prefix = fit.store.parent/fit.store.name[:-len('_fitparams')]
+        save(draws, prefix.name, prefix.parent)
+        print(f"{prefix} {'reused from the result cache' if fit.store in reused else 'done'}, see {prefix}_results.txt")
+        done[str(prefix)] = draws
+    return done
+
+
+def fit_key(model: str, stan_data: dict, steps: int, chains: int, chunk_size: int, seed, pars: list,
+            summarize: list, init: str = 'random', init_jitter: float = inits.JITTER, warmup: int = None) -> str:
+    """The result cache key of a fit, see `results.fit_key`.
+
+    `model` is relative to the Unity directory. The chunk size is part of the
+    key, as each chunk is sampled with its own random number stream. A
+    previous fit as `init` is keyed by its posterior means.
+    """
+    with open(UNITY_DIR/model) as f:
+        model_code = f.read()
+    if init not in inits.STRATEGIES:
+        init = dataset.content_hash(inits.from_fit(init))
+    return results.fit_key(model_code, stan_data, steps=steps, chains=chains, chunk_size=chunk_size,
+                           seed=seed, pars=list(pars), summarize=list(summarize), init=init,
+                           init_jitter=init_jitter, warmup=warmup)
+
+
+def _save_sn_names(store: Path, names):
+    # For `unity update`, which matches the SNe of a new dataset to those of this fit.
+    if names is not None:
+        draw_store.save_sn_names(store, names)
+
+
+def _save_log_lik_info(store: Path, model: str, stan_data: dict):
+    # For `unity compare`, which only compares fits of the same observations and kind of log_lik.
+    draw_store.save_log_lik_info(store, loo.log_lik_info(model, stan_data, model in MARGINAL_MODELS))
+
+
+def resolve_init(init: str) -> str:
+    """An init strategy, or the path of a previous fit relative to the cwd, see `inits.initial_values`.
+
+    Raises:
+        ValueError: if `init` is neither.
+    """
+    if init in inits.STRATEGIES:
+        return init
+    if not (CWD/init).exists():
+        raise ValueError(f"init must be one of {', '.join(inits.STRATEGIES)} or a previous fit, "
+                         f'{init} does not exist.')
+    return str(CWD/init)
+
+
+def results_dir(cache: Path = None) -> Path:
+    """Where finished fits are cached, see `results.py`, or None if the cache is off.
+
+    In order of priority: the `UNITY_RESULTS_DIR` environment variable,
+    `results/` in `cache` (`--cache-dir`) or in `UNITY_CACHE_DIR`, then
+    `unity/results/` in `XDG_CACHE_HOME` (`~/.cache`), outside the package.
+    `UNITY_RESULTS_DIR=off` turns the cache off.
+    """
+    directory = os.environ.get('UNITY_RESULTS_DIR')
+    if directory is not None:
+        return None if directory == 'off' else Path(directory)
+    if cache is not None or 'UNITY_CACHE_DIR' in os.environ:
+        return cache_dir(cache)/'results'
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home()/'.cache'))/'unity'/'results'
+
+
+def prepare_data(stan_data: dict, threads_per_chain: int = 1, mu_table: Path = None) -> dict:
+    """The data passed to Stan, from the contents of a data file.
+
+    Checks the data against the Stan `data` block, adds `model_mu` (see
+    `cosmology.model_mu`) and the `map_rect` shards, and drops anything Stan
+    does not use.
+
+    Raises:
+        ValueError: listing every problem with the data, see `validate.validate`.
+    """
+    # Distances only depend on the data, so they are computed here rather than in every gradient.
+    stan_data = validate.validate(stan_data, mu_table)
+    # How stan_code_map_rect.txt splits the SNe, one shard per thread. Other models ignore these.
+    stan_data['n_shards'] = min(threads_per_chain, stan_data['n_sne'])
+    stan_data['shard_size'] = -(-stan_data['n_sne']//stan_data['n_shards'])
+    return stan_data
+
+
+def cache_dir(directory: Path = None) -> Path:
+    """Where compiled models are cached.
+
+    In order of priority: `directory`, the `UNITY_CACHE_DIR` environment
+    variable, then `model_cache/` in the UNITY package.
+    """
+    if directory is not None:
+        return Path(directory)
+    return Path(os.environ.get('UNITY_CACHE_DIR', UNITY_DIR/'model_cache'))
+
+
+def _compiler_version() -> str:
+    """The first line of `$CC --version`, for the compiler pystan will use."""
+    compiler = os.environ.get('CC') or sysconfig.get_config_var('CC') or 'cc'
+    try:
+        return subprocess.run(compiler.split() + ['--version'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.split('\n')[0]
+    except OSError:
+        return compiler
+
+
+def _compile_args(threads: bool = False) -> list:
+    """Extra C++ compiler arguments, `STAN_THREADS` lets `map_rect` use several threads."""
+    return ['-pthread', '-DSTAN_THREADS'] if threads else []
+
+
+def _cache_file(s: str, directory: Path = None, threads: bool = False) -> Path:
+    """The cache file for the Stan model code `s`.
+
+    The key covers the model code, the pystan and Python versions, the C++
+    compiler and its arguments, since a cached model is only usable with all
+    of them unchanged.
     """
-    with open(stan_model) as f:
-        s = f.read()
-    
     # Use SHA1 to get a 7 digit UUID for a specific stan model.
     # This is not secure, but should not clash for our few expected models
-    UUID = sha1(s.encode('utf8')).hexdigest()[:7]
-    sm = pystan.StanModel(file=str(stan_model))
+    key = '\n'.join([s, pystan.__version__, platform.python_version(), _compiler_version()]
+                    + _compile_args(threads))
+    UUID = sha1(key.encode('utf8')).hexdigest()[:7]
+    return cache_dir(directory)/f'Unity_model{UUID}.pickle.txt'
+
+
+@contextmanager
+def _cache_lock(cache_file: Path):
+    """Hold an exclusive lock on `cache_file`, so only one process compiles it."""
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_cache(cache_file: Path, s_current: str) -> pystan.StanModel:
+    """The cached model, or None if there is no usable cache for `s_current`."""
+    try:
+        with open(cache_file, 'rb') as cache:
+            sm, s = pickle.load(cache)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    # This should catch if there was a SHA1 collision.
+    if s != s_current:
+        return None
+    return sm
+
 
-    cache_file = UNITY_DIR/'model_cache'/f'Unity_model{UUID}.pickle.txt'
-    if not cache_file.parent.exists():
-        cache_file.parent.mkdir()
-    with open(cache_file, 'wb') as cache:
+def _compile(stan_model: Path, s: str, cache_file: Path, threads: bool = False) -> pystan.StanModel:
+    sm = pystan.StanModel(file=str(stan_model), extra_compile_args=_compile_args(threads))
+    # write-then-rename so no process ever reads a partially written cache.
+    with open(cache_file.with_suffix('.tmp'), 'wb') as cache:
         pickle.dump((sm, s), cache)
+    os.replace(cache_file.with_suffix('.tmp'), cache_file)
     return sm
 
 
-def load(stan_model: Path, data: Path) -> (pystan.StanModel, dict):
+def compile(stan_model: Path, cache: Path = None, threads: bool = False) -> pystan.StanModel:
+    """Compiles, and saves a cache, of a given stan model path.
+    stan_model: pathlib.Path
+        The path to the stan model.
+    cache: pathlib.Path
+        The cache directory, see `cache_dir`.
+    threads: bool
+        Compile with `STAN_THREADS`, for within-chain `map_rect` threading.
     """
+    with open(stan_model) as f:
+        s = f.read()
+    cache_file = _cache_file(s, cache, threads)
+    with _cache_lock(cache_file):
+        return _compile(stan_model, s, cache_file, threads)
+
+
+def load(stan_model: Path, data: Path, cache: Path = None,
+         threads: bool = False) -> (pystan.StanModel, dict):
+    """Load the compiled model, from the cache if possible, and the data.
+
+    If several processes load the same uncached model at once, one compiles it
+    while the others wait for, and then read, its cache.
+
         stan_model (pathlib.Path):
         data (pathlib.PATH):
+        cache (pathlib.Path):
+            The cache directory, see `cache_dir`.
+        threads (bool):
+            Compile with `STAN_THREADS`, see `compile`.
+    """
+    # Check the data first, so a bad model/data pair does not wait for a compile.
+    stan_data = read_data(data, stan_model)
+    return load_model(stan_model, cache, threads), stan_data
+
+
+def read_data(data: Path, stan_model: Path = None) -> dict:
+    """Read a dataset or a data pickle, and check it can be fit by `stan_model`, see `check_model_data`.
+
+    See `dataset.load_dataset`.
+    """
+    stan_data = dataset.load_dataset(data)
+    if stan_model is not None:
+        check_model_data(Path(stan_model).name, stan_data)
+    return stan_data
+
+
+def load_model(stan_model: Path, cache: Path = None, threads: bool = False) -> pystan.StanModel:
+    """Load the compiled model, from the cache if possible.
+
+    If several processes load the same uncached model at once, one compiles it
+    while the others wait for, and then read, its cache. See `load` for the
+    parameters.
     """
     with open(stan_model) as f:
         s_current = f.read()
-    UUID = sha1(s_current.encode('utf8')).hexdigest()[:7]
-    try:
-        # Will fail if there is no cache file for this UUID.
-        with open(UNITY_DIR/'model_cache'/f'Unity_model{UUID}.pickle.txt', 'rb') as cache:
-            sm, s = pickle.load(cache)
-        # This should catch if there was a SHA1 collision.
-        if s != s_current:
-            raise RuntimeError('Updated Stan model is present.')
-    # No matter what failed, just compile again.
-    except:    # noqa: E722
-        sm = compile(stan_model)
+    cache_file = _cache_file(s_current, cache, threads)
+    sm = _read_cache(cache_file, s_current)
+    if sm is None:
+        with _cache_lock(cache_file):
+            # Another process may have compiled it while we waited for the lock.
+            sm = _read_cache(cache_file, s_current)
+            if sm is None:
+                sm = _compile(stan_model, s_current, cache_file, threads)
+    return sm
+
+
+def check_model_data(model_name: str, stan_data: dict):
+    """Raise a ValueError if `stan_data` can not be fit by the model `model_name`.
+
+    The marginalized models can not fit the non-Gaussian age mixtures, or a
+    skewed population. The rank-1 models need `do_fullDint = 0`.
+    """
+    if model_name in RANK1_MODELS and stan_data.get('do_fullDint', 0) != 0:
+        raise ValueError(f"{model_name} only supports do_fullDint = 0 (it is {stan_data['do_fullDint']}), "
+                         'use stan_code_simple_debug.txt.')
+    if model_name in MARGINAL_MODELS:
+        if stan_data['n_non_gaus_props'] != 0:
+            raise ValueError(f'{model_name} can not fit age mixtures (n_non_gaus_props = '
+                             f"{stan_data['n_non_gaus_props']}), use stan_code_fast.txt.")
+        if stan_data.get('allow_alpha_S_N', 0) != 0:
+            raise ValueError(f'{model_name} can not fit a skewed population (allow_alpha_S_N = 1), '
+                             'use stan_code_fast.txt.')
+
 
-    with open(data, 'rb') as f:
-        stan_data = pickle.load(f)
+def save(draws, data_name='', directory: Path = None):
+    """Save a summary of the draws, as `{data_name}_results.txt` and `{data_name}_summary.csv`.
 
-    return sm, stan_data
+    Only parameters with few values per draw are summarized, see
+    `summary.summarize`. Use `unity summary` for the per-SN ones. The draws
+    themselves are already on disk, in `{data_name}_fitparams/`, see `draws.py`.
 
+        draws (draws.Draws):
+            Parameter name to an array of shape (draws, *dims).
+        data_name (str):
+            Prefix for the output files.
+        directory (pathlib.Path):
+            Where to save them, the cwd by default.
 
-def save(fit, data_name=''):
+    Returns:
+        (summary.Summary):
+            The summary that was saved.
+    """
     # todo Move to fits folder
-    # todo Save more information, https://pystan.readthedocs.io/en/latest/api.html#stanfit4model
-    # e.g. stansummary, plots, get_inits
-    # This object is 5*N_SNe*steps
-    # pickle.dump(fit, gzip.open(f'Unity_{name}_gzip_fit.pickle', 'wb'))
-    # print('Inits: ', fit.get_inits())
-
-    # SAVE RAW DATA FIRST! It takes less processing and less possibilities to fail.
-    # TODO: update to use a context manager, `with`
-    pickle.dump(fit.extract(permuted=True), gzip.open(CWD/f'{data_name}_fitparams.gzip.pkl', 'wb'))
-    with open(CWD/f'{data_name}_results.txt', 'w') as text_file:
-        try:
-            print(fit, file=text_file)
-        except MaybeEncodingError as e:
-            print("An error occurred.\n", e, "\n\nNo summary available.", file=text_file)
+    fit_summary = summary.summarize(draws)
+    with open((directory or CWD)/f'{data_name}_results.txt', 'w') as text_file:
+        print(summary.to_text(fit_summary), file=text_file)
+    with open((directory or CWD)/f'{data_name}_summary.csv', 'w') as csv_file:
+        csv_file.write(summary.to_csv(fit_summary))
+    return fit_summary
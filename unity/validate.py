@@ -0,0 +1,204 @@
+""" validate.py - Check the data of a fit against the Stan `data` block.
+
+Stan only reports bad data, such as a covariance that is not positive
+definite, as a failure to initialize, and only after the model is compiled
+and loaded. `validate` converts the data once to contiguous arrays and checks
+every constraint of the `data` block in bulk, before any of that. It reports
+every problem at once, with the indices of the SNe involved.
+
+`SCHEMA` follows the `data` block of the models, e.g. `stan_code_simple.txt`.
+"""
+import numpy as np
+
+from . import cosmology
+
+# Name to (type, shape, lower bound). Shapes are in terms of the scalar data,
+# with `n_gaus` = n_props - n_non_gaus_props. `model_mu` is added by `validate`
+# when not in the data.
+SCHEMA = {
+    'n_sne': (int, (), 1),
+    'n_props': (int, (), 2),
+    'n_non_gaus_props': (int, (), 0),
+    'n_sn_set': (int, (), 1),
+    'sn_set_inds': (int, ('n_sne',), 0),
+    'z_helio': (float, ('n_sne',), 0),
+    'z_CMB': (float, ('n_sne',), 0),
+    'model_mu': (float, ('n_sne',), None),
+    'obs_mBx1c': (float, ('n_sne', 'n_gaus'), None),
+    'obs_mBx1c_cov': (float, ('n_sne', 'n_gaus', 'n_gaus'), None),
+    'n_age_mix': (int, (), 0),
+    'age_gaus_mean': (float, ('n_non_gaus_props', 'n_sne', 'n_age_mix'), None),
+    'age_gaus_std': (float, ('n_non_gaus_props', 'n_sne', 'n_age_mix'), None),
+    'age_gaus_A': (float, ('n_non_gaus_props', 'n_sne', 'n_age_mix'), 0),
+    'do_fullDint': (int, (), None),
+    'outl_frac_prior_lnmean': (float, (), None),
+    'outl_frac_prior_lnwidth': (float, (), None),
+    'lognormal_intr_prior': (int, (), None),
+    'allow_alpha_S_N': (int, (), None),
+}
+
+# How many SN indices are listed in a message.
+MAX_LISTED = 10
+
+# Stan's tolerance on the sum of a simplex.
+SIMPLEX_TOLERANCE = 1e-8
+
+
+def _sne(bad: np.ndarray) -> str:
+    """The SNe where `bad`, shape (n_sne, ...), is true anywhere."""
+    bad = bad.reshape((bad.shape[0], -1)).any(axis=1)
+    index = np.flatnonzero(bad)
+    listed = ', '.join(map(str, index[:MAX_LISTED])) + (', ...' if index.size > MAX_LISTED else '')
+    return f'SN{"e" if index.size > 1 else ""} {listed} ({index.size} of {bad.size})'
+
+
+def _by_sn(value: np.ndarray, shape: tuple) -> np.ndarray:
+    """`value` with the SNe along the first axis."""
+    return np.moveaxis(value, shape.index('n_sne'), 0)
+
+
+def _convert(name: str, value, kind) -> (np.ndarray, str):
+    """`value` as a contiguous int64 or float64 array, or a problem."""
+    try:
+        array = np.asarray(value, dtype=np.float64, order='C')
+    except (TypeError, ValueError):
+        return None, f'{name} is not numeric.'
+    if kind is int:
+        if not np.all(np.isfinite(array) & (array == np.round(array))):
+            return None, f'{name} must be integers.'
+        array = array.astype(np.int64)
+    return array, None
+
+
+def _ok(arrays: dict, *names) -> bool:
+    """Whether every one of `names` passed the basic checks."""
+    return all(arrays.get(name) is not None for name in names)
+
+
+def _not_positive_definite(cov: np.ndarray) -> np.ndarray:
+    """Which covariances a Cholesky decomposition fails on."""
+    bad = np.zeros(cov.shape[0], dtype=bool)
+    for i, matrix in enumerate(cov):
+        try:
+            np.linalg.cholesky(matrix)
+        except np.linalg.LinAlgError:
+            bad[i] = True
+    return bad
+
+
+def _dims(arrays: dict) -> dict:
+    """The integer scalars that array shapes depend on, if they are usable."""
+    dims = {name: int(arrays[name]) for name, (kind, shape, lower) in SCHEMA.items()
+            if kind is int and shape == () and arrays.get(name) is not None and arrays[name].ndim == 0
+            and (lower is None or arrays[name] >= lower)}
+    if 'n_props' in dims and 'n_non_gaus_props' in dims:
+        dims['n_gaus'] = dims['n_props'] - dims['n_non_gaus_props']
+    return dims
+
+
+def check(stan_data: dict, mu_table=None) -> (dict, list):
+    """Convert and check the data of a fit.
+
+    Parameters:
+        stan_data (dict):
+            The contents of a data file, keys not in `SCHEMA` are ignored.
+
+        mu_table (pathlib.Path):
+            Passed to `cosmology.model_mu`, replacing any `model_mu` of the data.
+
+    Returns:
+        (tuple of dict and list):
+            The data in `SCHEMA`, as arrays, and a list of the problems found.
+    """
+    problems = [f'{name} is missing.' for name in SCHEMA if name != 'model_mu' and name not in stan_data]
+    arrays = {}
+    for name, (kind, _, _) in SCHEMA.items():
+        if name in stan_data:
+            arrays[name], problem = _convert(name, stan_data[name], kind)
+            problems += [problem] if problem else []
+
+    # Shapes, finite values and bounds. The shapes depend on the integer scalars.
+    dims = _dims(arrays)
+    for name, (_, shape, lower) in SCHEMA.items():
+        value = arrays.get(name)
+        if value is None:
+            continue
+        if any(dim not in dims for dim in shape):
+            arrays[name] = None    # can not check it against a bad scalar
+            continue
+        expected = tuple(dims[dim] for dim in shape)
+        if value.shape != expected:
+            problems.append(f'{name} has shape {value.shape}, not {expected} '
+                            f"({', '.join(shape) or 'a scalar'}).")
+            arrays[name] = None
+        elif not np.all(np.isfinite(value)):
+            where = f' for {_sne(_by_sn(~np.isfinite(value), shape))}' if 'n_sne' in shape else ''
+            problems.append(f'{name} contains an infinity or NaN value{where}.')
+            arrays[name] = None
+        elif lower is not None and np.any(value < lower):
+            where = f' for {_sne(_by_sn(value < lower, shape))}' if 'n_sne' in shape else ''
+            problems.append(f'{name} must be at least {lower}{where}.')
+    problems += _constraints(arrays, dims)
+
+    if ('model_mu' not in stan_data or mu_table is not None) and _ok(arrays, 'z_helio', 'z_CMB'):
+        try:
+            arrays['model_mu'] = cosmology.model_mu(arrays, mu_table)
+        except ValueError as err:
+            problems.append(str(err))
+        else:
+            if not np.all(np.isfinite(arrays['model_mu'])):
+                problems.append(f"model_mu is not finite for {_sne(~np.isfinite(arrays['model_mu']))}, "
+                                'check the redshifts.')
+    return arrays, problems
+
+
+def _constraints(arrays: dict, dims: dict) -> list:
+    """The constraints beyond shapes, finite values and lower bounds."""
+    problems = []
+
+    if _ok(arrays, 'sn_set_inds', 'n_sn_set'):
+        bad = arrays['sn_set_inds'] >= dims['n_sn_set']
+        if bad.any():
+            problems.append(f"sn_set_inds must be less than n_sn_set ({dims['n_sn_set']}), python "
+                            f'index numbering, for {_sne(bad)}.')
+
+    if _ok(arrays, 'obs_mBx1c_cov') and arrays['obs_mBx1c_cov'].size:
+        cov = arrays['obs_mBx1c_cov']
+        asymmetric = ~np.isclose(cov, cov.transpose(0, 2, 1), rtol=1e-8, atol=1e-12)
+        if asymmetric.any():
+            problems.append(f'obs_mBx1c_cov is not symmetric for {_sne(asymmetric)}.')
+        elif _ok(arrays, 'do_fullDint') and arrays['do_fullDint'] == 0:
+            # Only mB gets an intrinsic dispersion, so the rest of each covariance must already be
+            # positive definite. One batched Cholesky, only if it fails are the SNe at fault found.
+            try:
+                np.linalg.cholesky(cov)
+            except np.linalg.LinAlgError:
+                problems.append('obs_mBx1c_cov is not positive definite, as needed with do_fullDint = 0, '
+                                f'for {_sne(_not_positive_definite(cov))}.')
+
+    if _ok(arrays, 'age_gaus_A') and arrays['age_gaus_A'].size:
+        shape = SCHEMA['age_gaus_A'][1]
+        bad = _by_sn(np.abs(arrays['age_gaus_A'].sum(axis=-1) - 1) > SIMPLEX_TOLERANCE, shape[:-1])
+        if bad.any():
+            problems.append(f'age_gaus_A must sum to one, it is a simplex, for {_sne(bad)}.')
+    if _ok(arrays, 'age_gaus_std') and arrays['age_gaus_std'].size:
+        bad = _by_sn(arrays['age_gaus_std'] <= 0, SCHEMA['age_gaus_std'][1])
+        if bad.any():
+            problems.append(f'age_gaus_std must be positive for {_sne(bad)}.')
+
+    if _ok(arrays, 'outl_frac_prior_lnwidth') and arrays['outl_frac_prior_lnwidth'] <= 0:
+        problems.append('outl_frac_prior_lnwidth must be positive, it is the width of a lognormal.')
+    return problems
+
+
+def validate(stan_data: dict, mu_table=None) -> dict:
+    """The data of a fit, as arrays and the scalars as Python numbers, see `check`.
+
+    Raises:
+        ValueError: listing every problem found.
+    """
+    arrays, problems = check(stan_data, mu_table)
+    if problems:
+        raise ValueError('The data has {} problem{}:\n  '.format(len(problems), 's' if len(problems) > 1 else '')
+                         + '\n  '.join(problems))
+    return {name: value.item() if value.ndim == 0 else value for name, value in arrays.items()}